@@ -0,0 +1,85 @@
+import gzip
+import json
+import random
+
+# Record kinds that can be generated, and the default share of each
+RECORD_KINDS = ("spdi", "hgvs", "cnc", "cnv")
+DEFAULT_MIX = {"spdi": 0.7, "hgvs": 0.2, "cnc": 0.05, "cnv": 0.05}
+
+COPY_NUMBER_VARIATION_TYPES = ("copy number loss", "copy number gain")
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parses a record mix like "spdi=0.7,hgvs=0.2,cnc=0.05,cnv=0.05" into a map
+    from record kind to its share of the records.
+    """
+    parsed = {}
+    for part in mix.split(","):
+        kind, share = part.split("=")
+        if kind not in RECORD_KINDS:
+            raise ValueError(
+                f"Unknown record kind {kind}, expected one of {RECORD_KINDS}"
+            )
+        parsed[kind] = float(share)
+    return parsed
+
+
+def make_record(variation_id: int, kind: str, rng: random.Random) -> dict:
+    """
+    Returns a synthetic ClinVar variation identity record of the given kind:
+    "spdi" and "hgvs" for Alleles, "cnc" for CopyNumberChange and "cnv" for
+    CopyNumberCount.
+    """
+    chromosome = rng.randint(1, 22)
+    start = rng.randint(10_000, 200_000_000)
+    ref, alt = rng.sample("ACGT", 2)
+    record = {"id": str(variation_id)}
+    if kind == "spdi":
+        record.update(
+            vrs_class="Allele",
+            fmt="spdi",
+            source=f"NC_{chromosome:06d}.11:{start}:{ref}:{alt}",
+            assembly_version="38",
+        )
+    elif kind == "hgvs":
+        record.update(
+            vrs_class="Allele",
+            fmt="hgvs",
+            source=f"NC_{chromosome:06d}.10:g.{start}{ref}>{alt}",
+            assembly_version="37",
+        )
+    else:
+        end = start + rng.randint(1_000, 5_000_000)
+        variation_type = rng.choice(COPY_NUMBER_VARIATION_TYPES)
+        suffix = "del" if variation_type == "copy number loss" else "dup"
+        record.update(
+            fmt="hgvs",
+            source=(
+                f"NC_{chromosome:06d}.11:g.({start}_{start + 1})_({end}_{end + 1})"
+                f"{suffix}"
+            ),
+            assembly_version="38",
+            variation_type=variation_type,
+        )
+        if kind == "cnc":
+            record["vrs_class"] = "CopyNumberChange"
+        else:
+            record["vrs_class"] = "CopyNumberCount"
+            record["absolute_copies"] = "1" if suffix == "del" else "3"
+    return record
+
+
+def write_records(file_name: str, count: int, mix: dict, seed: int = 0):
+    """
+    Writes `count` synthetic records to the GZIP file `file_name`, with kinds
+    chosen randomly according to `mix`.
+    """
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    with gzip.open(file_name, "wt", encoding="utf-8") as f:
+        for variation_id in range(count):
+            kind = rng.choices(kinds, weights)[0]
+            f.write(json.dumps(make_record(variation_id, kind, rng)))
+            f.write("\n")
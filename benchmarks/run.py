@@ -0,0 +1,225 @@
+"""
+Measures the throughput of the clinvar_gk_pilot pipeline on synthetic records,
+with a stand-in for the variation-normalizer QueryHandler, so that no SeqRepo,
+UTA or gene normalizer database is needed.
+
+Example:
+
+    python -m benchmarks.run --records 5000 --parallelism 0 1 2 4 --latency-ms 2
+"""
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+from benchmarks.records import DEFAULT_MIX, parse_mix, write_records
+from benchmarks.stub import make_stub_query_handler
+from clinvar_gk_pilot import main
+from clinvar_gk_pilot.metrics import Histogram
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument(
+        "--mix",
+        default=",".join(f"{kind}={share}" for kind, share in DEFAULT_MIX.items()),
+        help="Share of each record kind: spdi, hgvs, cnc (CopyNumberChange) and "
+        "cnv (CopyNumberCount)",
+    )
+    parser.add_argument(
+        "--parallelism",
+        type=int,
+        nargs="+",
+        default=[0, 1, 2, 4],
+        help="Parallelism levels to run, where 0 runs in a single thread",
+    )
+    parser.add_argument("--latency-ms", type=float, default=1.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--task-timeout", type=int, default=2)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=main.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--async-concurrency", type=int, default=1)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--warm-standby", action="store_true")
+    parser.add_argument("--json-codec", choices=["json", "orjson"], default="json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default=None, help="Also write the results as JSON to this file"
+    )
+    # Internal: run a single configuration and write its results to a file
+    parser.add_argument("--run-one", nargs=2, metavar=("CONFIG", "RESULT"))
+    return parser.parse_args(args)
+
+
+def _record_latencies(metrics_file_name: str) -> Histogram:
+    """
+    Returns the latency histogram of all the records that completed, merged from
+    the per-record histograms of the run's metrics summary.
+    """
+    with open(metrics_file_name, encoding="utf-8") as f:
+        summary = json.load(f)
+    latencies = Histogram()
+    for record in summary["records"]:
+        # Timed out records are recorded with the time limit
+        if record["outcome"] == "timeout":
+            continue
+        latencies.merge(
+            {
+                "buckets": [count for _, count in record["buckets"]],
+                "count": record["count"],
+                "sum": record["sum_seconds"],
+                "max": record["max_seconds"],
+            }
+        )
+    return latencies
+
+
+def run_one(config: dict) -> dict:
+    """
+    Runs the pipeline once with `config`, and returns its throughput, per-record
+    latencies from its metrics, outcome counts and peak memory use.
+    """
+    work_dir = config["work_dir"]
+    metrics_file_name = os.path.join(work_dir, f"metrics_{config['parallelism']}.json")
+    input_file_name = os.path.join(work_dir, "input.json.gz")
+    output_file_name = os.path.join(work_dir, f"output_{config['parallelism']}.json.gz")
+    opts = {
+        "chunk_size": config["chunk_size"],
+        "batch_size": config["batch_size"],
+        "async_concurrency": config["async_concurrency"],
+        "warm_standby": config["warm_standby"],
+        "task_timeout": config["task_timeout"],
+        "json_codec": config["json_codec"],
+        "metrics_file": metrics_file_name,
+        "query_handler_factory": partial(
+            make_stub_query_handler,
+            latency=config["latency_ms"] / 1000,
+            failure_rate=config["failure_rate"],
+            hang_rate=config["hang_rate"],
+            seed=config["seed"],
+        ),
+    }
+
+    start = time.perf_counter()
+    if config["parallelism"] == 0:
+        main.process_as_json_single_thread(input_file_name, output_file_name, opts)
+    elif config["streaming"]:
+        main.process_as_json_streaming(
+            input_file_name, output_file_name, config["parallelism"], opts
+        )
+    else:
+        main.process_as_json(
+            input_file_name, output_file_name, config["parallelism"], opts
+        )
+    seconds = time.perf_counter() - start
+
+    outcomes = {"ok": 0, "error": 0, "timeout": 0}
+    with gzip.open(output_file_name, "rt", encoding="utf-8") as f:
+        for line in f:
+            out = json.loads(line)["out"]
+            if out is None or "errors" not in out:
+                outcomes["ok"] += 1
+            elif "did not complete" in out["errors"]:
+                outcomes["timeout"] += 1
+            else:
+                outcomes["error"] += 1
+    latencies = _record_latencies(metrics_file_name)
+
+    records = sum(outcomes.values())
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "parallelism": config["parallelism"],
+        "records": records,
+        "seconds": seconds,
+        "records_per_second": records / seconds,
+        "latency_p50_ms": latencies.quantile(0.5) * 1000,
+        "latency_p99_ms": latencies.quantile(0.99) * 1000,
+        **outcomes,
+        "peak_rss_main_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_child_mb": (
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        ),
+    }
+
+
+def print_results(results: list):
+    columns = [
+        ("parallelism", "{}"),
+        ("records_per_second", "{:.1f}"),
+        ("latency_p50_ms", "{:.2f}"),
+        ("latency_p99_ms", "{:.2f}"),
+        ("ok", "{}"),
+        ("error", "{}"),
+        ("timeout", "{}"),
+        ("peak_rss_main_mb", "{:.1f}"),
+        ("peak_rss_child_mb", "{:.1f}"),
+    ]
+    rows = [[name for name, _ in columns]]
+    for result in results:
+        rows.append([fmt.format(result[name]) for name, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main_benchmark(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    if args.run_one:
+        config_file_name, result_file_name = args.run_one
+        with open(config_file_name, encoding="utf-8") as f:
+            result = run_one(json.load(f))
+        with open(result_file_name, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_records(
+            os.path.join(work_dir, "input.json.gz"),
+            args.records,
+            parse_mix(args.mix),
+            seed=args.seed,
+        )
+        for parallelism in args.parallelism:
+            if parallelism == 0 and args.hang_rate:
+                print("Skipping parallelism 0, which does not time out hanging records")
+                continue
+            config = {**vars(args), "parallelism": parallelism, "work_dir": work_dir}
+            config_file_name = os.path.join(work_dir, f"config_{parallelism}.json")
+            result_file_name = os.path.join(work_dir, f"result_{parallelism}.json")
+            with open(config_file_name, "w", encoding="utf-8") as f:
+                json.dump(config, f)
+            # A new process for each configuration, so peak memory use is measured
+            # separately for each
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.run",
+                    "--run-one",
+                    config_file_name,
+                    result_file_name,
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            with open(result_file_name, encoding="utf-8") as f:
+                results.append(json.load(f))
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,117 @@
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+from types import SimpleNamespace
+
+
+class StubVariation:
+    """
+    Stands in for a VRS variation model returned by the variation-normalizer.
+    """
+
+    def __init__(self, vrs_type: str, source: str):
+        self.type = vrs_type
+        self.source = source
+        self.location = SimpleNamespace(sequence=None)
+
+    def model_dump(self, exclude_none: bool = False) -> dict:
+        digest = base64.urlsafe_b64encode(
+            hashlib.sha512(self.source.encode("utf-8")).digest()[:24]
+        ).decode("ascii")
+        return {
+            "id": f"ga4gh:{self.type[:2].upper()}.{digest}",
+            "type": self.type,
+            "digest": digest,
+            "location": {
+                "id": f"ga4gh:SL.{digest}",
+                "type": "SequenceLocation",
+                "digest": digest,
+                "sequenceReference": {
+                    "type": "SequenceReference",
+                    "refgetAccession": f"SQ.{digest}",
+                },
+                "start": 1000,
+                "end": 1001,
+            },
+            "state": {"type": "LiteralSequenceExpression", "sequence": "T"},
+        }
+
+    def model_dump_json(self, exclude_none: bool = False) -> str:
+        return json.dumps(self.model_dump(exclude_none), separators=(",", ":"))
+
+
+class StubQueryHandler:
+    """
+    In-process stand-in for the variation-normalizer `QueryHandler`, implementing
+    only the calls made by `clinvar_gk_pilot.main`.
+
+    Each call takes `latency` seconds. A `failure_rate` share of the sources make
+    calls raise an exception, and a `hang_rate` share make them take `hang_seconds`
+    instead. Which sources fail or hang depends only on the source and `seed`, so
+    it is the same across processes and runs.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        hang_rate: float = 0.0,
+        hang_seconds: float = 3600.0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.seed = seed
+        self.vrs_python_tlr = SimpleNamespace(translate_from=self.translate_from)
+        self.normalize_handler = SimpleNamespace(normalize=self.normalize)
+        self.to_copy_number_handler = SimpleNamespace(
+            hgvs_to_copy_number_change=self.hgvs_to_copy_number_change,
+            hgvs_to_copy_number_count=self.hgvs_to_copy_number_count,
+        )
+
+    def _delay(self, source: str) -> float:
+        draw = random.Random(f"{self.seed}:{source}").random()
+        if draw < self.failure_rate:
+            raise RuntimeError(f"Stub failure for {source}")
+        if draw < self.failure_rate + self.hang_rate:
+            return self.hang_seconds
+        return self.latency
+
+    def translate_from(self, source: str, fmt: str = None) -> StubVariation:
+        time.sleep(self._delay(source))
+        return StubVariation("Allele", source)
+
+    async def normalize(self, q: str) -> SimpleNamespace:
+        await asyncio.sleep(self._delay(q))
+        return SimpleNamespace(variation=StubVariation("Allele", q), warnings=[])
+
+    async def hgvs_to_copy_number_change(
+        self, hgvs_expr: str, copy_change=None, do_liftover: bool = False
+    ) -> SimpleNamespace:
+        await asyncio.sleep(self._delay(hgvs_expr))
+        return SimpleNamespace(
+            copy_number_change=StubVariation("CopyNumberChange", hgvs_expr),
+            warnings=[],
+        )
+
+    async def hgvs_to_copy_number_count(
+        self, hgvs_expr: str, baseline_copies: int = None, do_liftover: bool = False
+    ) -> SimpleNamespace:
+        await asyncio.sleep(self._delay(hgvs_expr))
+        return SimpleNamespace(
+            copy_number_count=StubVariation("CopyNumberCount", hgvs_expr),
+            warnings=[],
+        )
+
+
+def make_stub_query_handler(**kwargs) -> StubQueryHandler:
+    """
+    Returns a `StubQueryHandler` created with `kwargs`, for use as the
+    `query_handler_factory` option of `clinvar_gk_pilot.main`.
+    """
+    return StubQueryHandler(**kwargs)
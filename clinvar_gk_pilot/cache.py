@@ -0,0 +1,204 @@
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from importlib import metadata
+
+from clinvar_gk_pilot.codec import RawJSON
+from clinvar_gk_pilot.logger import logger
+
+# Fields of a ClinVar variation record which determine its normalization result
+NORMALIZATION_FIELDS = (
+    "vrs_class",
+    "source",
+    "fmt",
+    "assembly_version",
+    "variation_type",
+    "absolute_copies",
+)
+
+# Distributions whose versions can change normalization results
+NORMALIZATION_PACKAGES = ("ga4gh.vrs", "variation-normalizer", "biocommons.seqrepo")
+
+# Environment variables identifying the reference data used for normalization
+REFERENCE_DATA_ENV_VARS = ("SEQREPO_ROOT_DIR", "SEQREPO_DATAPROXY_URL", "UTA_DB_URL")
+
+# Cache entries are only marked as accessed again after this many seconds,
+# so that most cache hits do not need to write to the database.
+ACCESS_TIME_RESOLUTION = 24 * 60 * 60
+
+# Number of stored results between checks of the total cache size
+EVICTION_CHECK_INTERVAL = 1000
+
+
+def normalization_input(clinvar_json: dict) -> dict:
+    """
+    Returns the fields of `clinvar_json` that are used to normalize it.
+    """
+    return {field: clinvar_json.get(field) for field in NORMALIZATION_FIELDS}
+
+
+@functools.lru_cache(maxsize=None)
+def normalization_environment() -> dict:
+    """
+    Returns the package versions and reference data locations used for
+    normalization in this process.
+    """
+
+    def package_version(name: str) -> str:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            return "unknown"
+
+    return {
+        "packages": {name: package_version(name) for name in NORMALIZATION_PACKAGES},
+        "reference_data": {
+            name: os.environ.get(name) for name in REFERENCE_DATA_ENV_VARS
+        },
+    }
+
+
+def normalization_options(opts: dict) -> dict:
+    """
+    Returns everything other than a record's own fields that can affect its
+    normalization result: the liftover option and the normalization environment.
+    """
+    return {
+        "liftover": bool(opts.get("liftover", False)),
+        "environment": normalization_environment(),
+    }
+
+
+def cache_key(clinvar_json: dict, opts: dict) -> str:
+    """
+    Returns a hash of everything that can affect the normalization result of
+    `clinvar_json`: its normalization input fields and `normalization_options`.
+    """
+    key_content = {
+        "input": normalization_input(clinvar_json),
+        **normalization_options(opts),
+    }
+    return hashlib.sha256(
+        json.dumps(key_content, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class NormalizationCache:
+    """
+    SQLite-backed cache of normalization results, keyed by `cache_key`.
+
+    The database file can be shared by several processes. When `max_bytes` is
+    set, the least recently accessed results are evicted once the total size of
+    stored results exceeds it.
+    """
+
+    def __init__(self, path: str, max_bytes: int | None = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._stores_since_eviction_check = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, "
+            "value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)"
+        )
+
+    def get(self, key: str) -> dict | None:
+        row = self.conn.execute(
+            "SELECT value, accessed_at FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value, accessed_at = row
+        now = time.time()
+        if now - accessed_at > ACCESS_TIME_RESOLUTION:
+            self.conn.execute(
+                "UPDATE results SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def put(self, key: str, result: dict):
+        # A RawJSON result is already encoded
+        value = result if isinstance(result, RawJSON) else json.dumps(result)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results (key, value, size, accessed_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, value, len(key) + len(value), time.time()),
+        )
+        self.stores += 1
+        self._stores_since_eviction_check += 1
+        if (
+            self.max_bytes is not None
+            and self._stores_since_eviction_check >= EVICTION_CHECK_INTERVAL
+        ):
+            self.evict()
+
+    def size_bytes(self) -> int:
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        return total
+
+    def evict(self):
+        """
+        If the total size of the stored results exceeds `max_bytes`, delete the
+        least recently accessed results until it is below 90% of `max_bytes`.
+        """
+        self._stores_since_eviction_check = 0
+        if self.max_bytes is None:
+            return
+        total = self.size_bytes()
+        if total <= self.max_bytes:
+            return
+        excess = total - int(self.max_bytes * 0.9)
+        rows = self.conn.execute("SELECT key, size FROM results ORDER BY accessed_at")
+        evict_keys = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            evict_keys.append((key,))
+            excess -= size
+        rows.close()
+        self.conn.execute("BEGIN")
+        self.conn.executemany("DELETE FROM results WHERE key = ?", evict_keys)
+        self.conn.execute("COMMIT")
+        self.evictions += len(evict_keys)
+        logger.info(f"Evicted {len(evict_keys)} results from {self.path}")
+
+    def clear(self):
+        """
+        Delete all stored results, e.g. after the reference data has changed in
+        a way that is not reflected in `normalization_environment`.
+        """
+        self.conn.execute("DELETE FROM results")
+        self.conn.execute("VACUUM")
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,388 @@
+import json
+import os
+import shutil
+from typing import List
+
+from clinvar_gk_pilot.codec import is_error_output
+from clinvar_gk_pilot.gzipio import (
+    BGZF_EOF,
+    DEFAULT_COMPRESSLEVEL,
+    compress,
+    compress_bgzf,
+    open_gzip,
+)
+from clinvar_gk_pilot.index import OutputIndex, line_offsets
+from clinvar_gk_pilot.logger import logger
+from clinvar_gk_pilot.parquet import ParquetOutputWriter
+
+# Bytes copied at a time when appending a compressed chunk file
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class CheckpointedOutput:
+    """
+    Writes chunks of output lines to a GZIP file, each chunk as one or more
+    separate GZIP members compressed at `compresslevel` on `threads` threads, and
+    records in a checkpoint file how many chunks and lines have been durably
+    written.
+
+    Because each chunk ends with a complete GZIP member, the output file truncated to
+    the size recorded in the checkpoint is a valid GZIP file, and an interrupted
+    run can resume by appending after it. The checkpoint file is removed when the
+    output is complete.
+
+    If `errors_file_name` is given, the output lines with errors are also written
+    to that GZIP file, compressed at `errors_compresslevel` (by default
+    `compresslevel`), which is checkpointed along with the output.
+
+    If `index_file_name` is given, the output is written in BGZF blocks, and the
+    position of each record is written to that `OutputIndex` by ClinVar ID. The
+    IDs of the records of each chunk must then be passed with the chunk.
+
+    If `parquet_file_name` is given, the output lines are also written to that
+    Parquet file, decoded with the `json_codec` codec. A Parquet file cannot be
+    appended to, so when resuming, the lines already written are written to a new
+    Parquet file first.
+
+    `input_bytes` is the size of the input, if the input file is not complete yet
+    because it is still being downloaded.
+
+    `options` are any other run options that determine the output lines, such as
+    the output shape. Like the input, the JSON codec, compression level and
+    `options` must not change when resuming.
+    """
+
+    def __init__(
+        self,
+        output_file_name: str,
+        input_file_name: str,
+        chunk_size: int,
+        errors_file_name: str | None = None,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        threads: int | None = None,
+        index_file_name: str | None = None,
+        input_bytes: int | None = None,
+        parquet_file_name: str | None = None,
+        json_codec: str | None = None,
+        options: dict | None = None,
+        errors_compresslevel: int | None = None,
+    ):
+        self.output_file_name = output_file_name
+        self.checkpoint_file_name = f"{output_file_name}.checkpoint"
+        self.input_file_name = input_file_name
+        self.input_bytes = input_bytes
+        self.chunk_size = chunk_size
+        self.errors_file_name = errors_file_name
+        self.compresslevel = compresslevel
+        self.errors_compresslevel = (
+            errors_compresslevel if errors_compresslevel is not None else compresslevel
+        )
+        self.threads = threads
+        self.index_file_name = index_file_name
+        self.index = None
+        self.parquet_file_name = parquet_file_name
+        self.json_codec = json_codec
+        self.options = options or {}
+        self.parquet = None
+        self.chunks_written = 0
+        self.lines_written = 0
+        self.output_bytes = 0
+        self.errors_written = 0
+        self.errors_bytes = 0
+        self.f = None
+        self.errors_f = None
+
+    @property
+    def result_file_name(self) -> str:
+        """
+        The file to read the completed output from.
+        """
+        return self.output_file_name
+
+    def _input_description(self) -> dict:
+        """
+        Identifies the input, chunking and options of the output, which must not
+        change between runs that write to the same checkpointed output.
+        """
+        return {
+            "input_file": os.path.abspath(self.input_file_name),
+            "input_bytes": (
+                self.input_bytes
+                if self.input_bytes is not None
+                else os.path.getsize(self.input_file_name)
+            ),
+            "chunk_size": self.chunk_size,
+            "json_codec": self.json_codec,
+            "compresslevel": self.compresslevel,
+            "errors_compresslevel": self.errors_compresslevel,
+            "options": self.options,
+        }
+
+    def open(self, resume: bool = False) -> int:
+        """
+        Open the output for writing and return the index of the first chunk to write.
+
+        If `resume` is true and a checkpoint exists, the output is truncated to the
+        checkpointed size and verified against the checkpoint before appending.
+        Otherwise the output is written from the beginning.
+        """
+        if resume and os.path.exists(self.checkpoint_file_name):
+            with open(self.checkpoint_file_name, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint["input"] != self._input_description():
+                raise RuntimeError(
+                    f"Checkpoint {self.checkpoint_file_name} was written for "
+                    f"{checkpoint['input']}, not {self._input_description()}"
+                )
+            self._restore(checkpoint)
+            file_name = self._file_name()
+            file_exists = os.path.exists(file_name)
+            if (os.path.getsize(file_name) if file_exists else 0) < self.output_bytes:
+                raise RuntimeError(
+                    f"{file_name} is shorter than recorded in "
+                    f"{self.checkpoint_file_name}"
+                )
+            self.f = open(file_name, "r+b" if file_exists else "wb")
+            self.f.truncate(self.output_bytes)
+            self.f.seek(self.output_bytes)
+            self._verify(self._file_lines())
+            if self.errors_file_name:
+                mode = "r+b" if os.path.exists(self.errors_file_name) else "wb"
+                self.errors_f = open(self.errors_file_name, mode)
+                self.errors_f.truncate(self.errors_bytes)
+                self.errors_f.seek(self.errors_bytes)
+            if self.index_file_name:
+                self.index = OutputIndex(self.index_file_name, resume=True)
+                self.index.truncate(self.chunks_written)
+            if self.parquet_file_name:
+                self._open_parquet()
+                for file_name in self._written_file_names():
+                    with open_gzip(file_name, "rt", encoding="utf-8") as f_in:
+                        for line in f_in:
+                            self.parquet.write(line)
+            logger.info(
+                f"Resuming {self.output_file_name} at chunk {self.chunks_written} "
+                f"({self.lines_written} lines already written)"
+            )
+        else:
+            if resume:
+                logger.info(
+                    f"No checkpoint found for {self.output_file_name}, "
+                    "starting from the beginning"
+                )
+            self.f = open(self._file_name(), "wb")
+            if self.errors_file_name:
+                self.errors_f = open(self.errors_file_name, "wb")
+            if self.index_file_name:
+                self.index = OutputIndex(self.index_file_name)
+            if self.parquet_file_name:
+                self._open_parquet()
+            self._write_checkpoint()
+        return self.chunks_written
+
+    def _file_name(self) -> str:
+        """
+        Returns the name of the file that chunks are being written to.
+        """
+        return self.output_file_name
+
+    def _file_lines(self) -> int:
+        """
+        Returns the number of lines written to `_file_name()`.
+        """
+        return self.lines_written
+
+    def _written_file_names(self) -> List[str]:
+        """
+        Returns the names of the files holding the lines written so far, in order.
+        """
+        return [self._file_name()]
+
+    def _open_parquet(self):
+        self.parquet = ParquetOutputWriter(
+            self.parquet_file_name, json_codec=self.json_codec
+        )
+
+    def _restore(self, checkpoint: dict):
+        """
+        Restore the counts of what has been written from `checkpoint`.
+        """
+        self.chunks_written = checkpoint["chunks_written"]
+        self.lines_written = checkpoint["lines_written"]
+        self.output_bytes = checkpoint["output_bytes"]
+        if self.errors_file_name:
+            self.errors_written = checkpoint.get("errors_written", 0)
+            self.errors_bytes = checkpoint.get("errors_bytes", 0)
+
+    def _checkpoint_state(self) -> dict:
+        return {
+            "input": self._input_description(),
+            "chunks_written": self.chunks_written,
+            "lines_written": self.lines_written,
+            "output_bytes": self.output_bytes,
+            "errors_written": self.errors_written,
+            "errors_bytes": self.errors_bytes,
+        }
+
+    def _chunk_written(self, line_count: int, record_ids: list | None):
+        """
+        Called after each chunk is written and before it is checkpointed.
+        """
+
+    def _verify(self, expected_lines: int):
+        """
+        Check that the output written so far decompresses to `expected_lines`
+        complete lines.
+        """
+        file_name = self._file_name()
+        line_count = 0
+        last_byte = b"\n"
+        with open_gzip(file_name, "rb") as f_in:
+            while block := f_in.read(1024 * 1024):
+                line_count += block.count(b"\n")
+                last_byte = block[-1:]
+        if line_count != expected_lines or last_byte != b"\n":
+            raise RuntimeError(
+                f"{file_name} does not match its checkpoint: expected "
+                f"{expected_lines} lines but found {line_count}"
+            )
+
+    def _write_checkpoint(self):
+        checkpoint = self._checkpoint_state()
+        tmp_file_name = f"{self.checkpoint_file_name}.tmp"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, self.checkpoint_file_name)
+
+    def write_chunk(self, lines: List[str], record_ids: list | None = None):
+        """
+        Durably append `lines` as one chunk and record it in the checkpoint.
+        `record_ids`, the ClinVar IDs of the records of `lines`, are recorded by
+        outputs that keep track of them.
+        """
+        lines = [line if line.endswith("\n") else f"{line}\n" for line in lines]
+        if self.errors_f is not None:
+            error_lines = [line for line in lines if is_error_output(line)]
+            if error_lines:
+                errors_member = self._compress(
+                    error_lines, compresslevel=self.errors_compresslevel
+                )
+                self.errors_f.write(errors_member)
+                self.errors_f.flush()
+                os.fsync(self.errors_f.fileno())
+                self.errors_written += len(error_lines)
+                self.errors_bytes += len(errors_member)
+        if self.index is not None:
+            encoded_lines = [line.encode("utf-8") for line in lines]
+            blocks = compress_bgzf(
+                b"".join(encoded_lines),
+                compresslevel=self.compresslevel,
+                threads=self.threads,
+            )
+            member = b"".join(blocks)
+            self._index_chunk(
+                record_ids,
+                line_offsets(map(len, encoded_lines), list(map(len, blocks))),
+            )
+        else:
+            member = self._compress(lines)
+        if self.parquet is not None:
+            for line in lines:
+                self.parquet.write(line)
+        self.f.write(member)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.chunks_written += 1
+        self.lines_written += len(lines)
+        self.output_bytes += len(member)
+        self._chunk_written(len(lines), record_ids)
+        self._write_checkpoint()
+
+    def append_chunk(
+        self,
+        chunk_file_name: str,
+        line_count: int,
+        errors_chunk_file_name: str | None = None,
+        error_count: int = 0,
+        record_ids: list | None = None,
+        offsets: list | None = None,
+    ):
+        """
+        Durably append the GZIP file `chunk_file_name`, which holds `line_count`
+        newline terminated lines, as one chunk without decompressing it, and
+        record it in the checkpoint. The GZIP file `errors_chunk_file_name`, which
+        holds the chunk's `error_count` lines with errors, is appended to the
+        errors file the same way. `record_ids` is as for `write_chunk`. If the
+        output is indexed, the chunk file must be in BGZF blocks, and `offsets`
+        are the `line_offsets` of its lines.
+        """
+        if self.errors_f is not None and error_count:
+            self.errors_bytes += self._append_file(
+                self.errors_f, errors_chunk_file_name
+            )
+            self.errors_written += error_count
+        if self.index is not None:
+            self._index_chunk(record_ids, offsets)
+        if self.parquet is not None:
+            with open_gzip(chunk_file_name, "rt", encoding="utf-8") as f_in:
+                for line in f_in:
+                    self.parquet.write(line)
+        self.output_bytes += self._append_file(self.f, chunk_file_name)
+        self.chunks_written += 1
+        self.lines_written += line_count
+        self._chunk_written(line_count, record_ids)
+        self._write_checkpoint()
+
+    def _index_chunk(self, record_ids: list | None, offsets: list):
+        if record_ids is None:
+            raise ValueError("The chunks of an indexed output require record IDs")
+        self.index.add_chunk(
+            self.chunks_written, record_ids, offsets, base_offset=self.output_bytes
+        )
+
+    @staticmethod
+    def _append_file(f, file_name: str) -> int:
+        with open(file_name, "rb") as f_in:
+            shutil.copyfileobj(f_in, f, COPY_BUFFER_SIZE)
+        f.flush()
+        os.fsync(f.fileno())
+        return os.path.getsize(file_name)
+
+    def _compress(self, lines: List[str], compresslevel: int | None = None) -> bytes:
+        return compress(
+            "".join(lines).encode("utf-8"),
+            compresslevel=(
+                compresslevel if compresslevel is not None else self.compresslevel
+            ),
+            threads=self.threads,
+        )
+
+    def close(self):
+        """
+        Close the completed output and remove its checkpoint.
+        """
+        if self.index is not None:
+            self.f.write(BGZF_EOF)
+            self.index.close()
+            logger.info(
+                f"Index of {self.output_file_name} written to {self.index_file_name}"
+            )
+        self.f.close()
+        if self.parquet is not None:
+            self.parquet.close()
+            logger.info(
+                f"Wrote {self.parquet.rows_written} records to "
+                f"{self.parquet_file_name}"
+            )
+        if self.errors_f is not None:
+            if self.errors_bytes == 0:
+                # An empty GZIP member, so that the file is a valid GZIP file
+                self.errors_f.write(self._compress([]))
+            self.errors_f.close()
+            logger.info(
+                f"{self.errors_written} records with errors written to "
+                f"{self.errors_file_name}"
+            )
+        os.remove(self.checkpoint_file_name)
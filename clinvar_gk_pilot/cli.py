@@ -23,4 +23,337 @@ def parse_args(args: List[str]) -> dict:
         action="store_true",
         help="Enable attempting to liftover non-GRCh38 genomic variants to GRCh38",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help=(
+            "Number of lines sent to a worker's background process at a time. "
+            "Several batches are kept in flight per worker."
+        ),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help=(
+            "Number of lines in each chunk of the input file. "
+            "Parallel workers pull the next unprocessed chunk when they finish one."
+        ),
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Stream chunks of the input to parallel workers in memory instead of "
+            "writing chunk files, so the input and output are each read and "
+            "written only once."
+        ),
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=0,
+        help=(
+            "Seconds after a downloaded gs:// file was last checked against its "
+            "object during which it is used without checking again. Default 0, "
+            "checking on every run."
+        ),
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help=(
+            "Use downloaded gs:// files without checking them against their "
+            "objects, and fail instead of downloading files that are missing."
+        ),
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help=(
+            "gs:// URI to upload the output to. It is uploaded in the background "
+            "while it is written, and still written locally as well."
+        ),
+    )
+    parser.add_argument(
+        "--stream-input",
+        action="store_true",
+        help=(
+            "Process a gs:// input while it is still downloading, instead of "
+            "waiting for the download to finish. The download is still kept in "
+            "the buckets directory for later runs."
+        ),
+    )
+    parser.add_argument(
+        "--normalization-cache",
+        default=None,
+        help=(
+            "Path of a SQLite file used to cache normalization results across runs. "
+            "Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--normalization-cache-max-mb",
+        type=int,
+        default=None,
+        help=(
+            "Evict the least recently used normalization results once the cache "
+            "holds more than this many megabytes of results."
+        ),
+    )
+    parser.add_argument(
+        "--normalization-cache-clear",
+        action="store_true",
+        help=(
+            "Delete all results from the normalization cache before processing, "
+            "e.g. after the reference data has changed."
+        ),
+    )
+    parser.add_argument(
+        "--previous-input",
+        default=None,
+        help=(
+            "Input file of a previous release. With --previous-output, records "
+            "whose normalization input fields are unchanged since that release "
+            "reuse its output instead of being normalized again."
+        ),
+    )
+    parser.add_argument(
+        "--previous-output",
+        default=None,
+        help="Output file produced from --previous-input.",
+    )
+    parser.add_argument(
+        "--task-timeout",
+        type=int,
+        default=10,
+        help=(
+            "Seconds a record may take to normalize before its background process "
+            "is terminated and the record gets a timeout error."
+        ),
+    )
+    parser.add_argument(
+        "--async-concurrency",
+        type=int,
+        default=1,
+        help=(
+            "Number of records each worker's background process normalizes "
+            "concurrently on its event loop, overlapping their UTA and gene "
+            "normalizer round trips. Default 1 processes one record at a time."
+        ),
+    )
+    parser.add_argument(
+        "--warm-standby",
+        action="store_true",
+        help=(
+            "Keep an initialized standby background process per worker, so a "
+            "process terminated after a timeout is replaced without waiting for "
+            "initialization. Uses an extra process per worker."
+        ),
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help=(
+            "Normalize each distinct normalization input only once, and copy its "
+            "result to the other records with the same input."
+        ),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Resume an interrupted run from the last checkpoint of its output, "
+            "instead of starting over."
+        ),
+    )
+    parser.add_argument(
+        "--refdata-dir",
+        default=None,
+        help=(
+            "Directory of the variation-normalizer's cool-seq-tool reference data "
+            "files and their manifest. Defaults to $WAGS_TAILS_DIR, or "
+            "~/.local/share/wags_tails."
+        ),
+    )
+    parser.add_argument(
+        "--refdata-seed",
+        default=None,
+        help=(
+            "Directory or tar archive of reference data files and their manifest, "
+            "copied into --refdata-dir when it does not already hold valid "
+            "reference data. Allows running without network access."
+        ),
+    )
+    parser.add_argument(
+        "--record-log",
+        choices=["none", "errors", "trace"],
+        default="errors",
+        help=(
+            "Which records workers log to their log files: only records with "
+            "errors or timeouts (default), every record, or none."
+        ),
+    )
+    parser.add_argument(
+        "--record-log-buffer",
+        type=int,
+        default=100,
+        help=(
+            "Number of most recent records each worker keeps in memory and logs "
+            "only after a timeout or crash. 0 disables it."
+        ),
+    )
+    parser.add_argument(
+        "--output-shape",
+        choices=["full", "keyed"],
+        default="full",
+        help=(
+            "Shape of each output record: the input record under 'in' and its "
+            "result under 'out' (full, default), or only the ClinVar variation ID "
+            "under 'id' and the result under 'out' (keyed)."
+        ),
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["ndjson", "parquet", "both"],
+        default="ndjson",
+        help=(
+            "Format of the output: GZIP compressed NDJSON (default), Parquet with "
+            "key columns and the JSON of each result, or both. Parquet requires "
+            "the 'parquet' extra."
+        ),
+    )
+    parser.add_argument(
+        "--shard-lines",
+        type=int,
+        default=None,
+        help=(
+            "Write the output as GZIP shards of about this many lines, rounded up "
+            "to whole chunks, and a manifest listing them, instead of one file. "
+            "Cannot be used with --previous-input, --dedup or --output-format "
+            "parquet."
+        ),
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help=(
+            "Write the output in BGZF blocks, which are still read by gzip, and an "
+            "index of the records by ClinVar ID to <output>.index.sqlite, for "
+            "the lookup subcommand. Cannot be used with --shard-lines, "
+            "--previous-input, --dedup or --output-format parquet."
+        ),
+    )
+    parser.add_argument(
+        "--errors-file",
+        default=None,
+        help=(
+            "Also write the output records with errors, in the same shape as the "
+            "output, to this GZIP file."
+        ),
+    )
+    parser.add_argument(
+        "--compresslevel",
+        type=int,
+        choices=range(10),
+        default=9,
+        metavar="{0-9}",
+        help=(
+            "GZIP compression level of the output and errors files. Default 9. "
+            "Lower levels compress much faster into slightly larger files."
+        ),
+    )
+    parser.add_argument(
+        "--gzip-threads",
+        type=int,
+        default=None,
+        help=(
+            "Number of threads compressing the output and the input chunk files. "
+            "Default one per core."
+        ),
+    )
+    parser.add_argument(
+        "--json-codec",
+        choices=["json", "orjson"],
+        default="json",
+        help=(
+            "JSON codec for records. json (default) writes the same output as "
+            "earlier versions. orjson is faster: it requires the 'fast' extra, "
+            "copies each input record to the output without encoding it again, "
+            "and writes compact JSON."
+        ),
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help=(
+            "Write a JSON summary of per-record latency histograms, by vrs_class, "
+            "fmt, assembly_version and outcome, and of per-stage latency "
+            "histograms to this file at the end of the run."
+        ),
+    )
+    parser.add_argument(
+        "--prometheus-textfile",
+        default=None,
+        help=(
+            "Write the latency histograms in the Prometheus text format to this "
+            "file after each chunk, e.g. for the node_exporter textfile collector."
+        ),
+    )
+    parser.add_argument(
+        "--report-startup",
+        action="store_true",
+        help=(
+            "Log how long the startup steps of the main process and of each "
+            "background process take, such as imports, downloading the input "
+            "and creating the QueryHandler."
+        ),
+    )
+    parsed = parser.parse_args(args)
+    for name in ("batch_size", "chunk_size", "task_timeout", "async_concurrency"):
+        if getattr(parsed, name) <= 0:
+            parser.error(f"--{name.replace('_', '-')} must be greater than 0")
+    if bool(parsed.previous_input) != bool(parsed.previous_output):
+        parser.error("--previous-input and --previous-output must be used together")
+    if parsed.shard_lines is not None:
+        if parsed.shard_lines <= 0:
+            parser.error("--shard-lines must be greater than 0")
+        if parsed.previous_input or parsed.dedup:
+            parser.error(
+                "--shard-lines cannot be used with --previous-input or --dedup"
+            )
+        if parsed.output_format == "parquet":
+            parser.error("--shard-lines cannot be used with --output-format parquet")
+    if parsed.index:
+        if parsed.shard_lines is not None:
+            parser.error("--index cannot be used with --shard-lines")
+        if parsed.previous_input or parsed.dedup:
+            parser.error("--index cannot be used with --previous-input or --dedup")
+        if parsed.output_format == "parquet":
+            parser.error("--index cannot be used with --output-format parquet")
+    if parsed.cache_ttl < 0:
+        parser.error("--cache-ttl must not be negative")
+    if parsed.output is not None and not parsed.output.startswith("gs://"):
+        parser.error("--output must be a gs:// URI")
+    if parsed.stream_input and (parsed.previous_input or parsed.dedup):
+        parser.error("--stream-input cannot be used with --previous-input or --dedup")
+    return vars(parsed)
+
+
+def parse_lookup_args(args: List[str]) -> dict:
+    """
+    Parse arguments of the lookup subcommand and return as dict.
+    """
+    parser = argparse.ArgumentParser(
+        prog="clinvar-gk-pilot lookup",
+        description="Print the output records of ClinVar IDs from an indexed output.",
+    )
+    parser.add_argument("output", help="Output file written with --index")
+    parser.add_argument("ids", nargs="+", help="ClinVar variation IDs to look up")
+    parser.add_argument(
+        "--index-file",
+        default=None,
+        help="Index of the output. Default <output>.index.sqlite.",
+    )
     return vars(parser.parse_args(args))
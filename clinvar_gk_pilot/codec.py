@@ -0,0 +1,123 @@
+import functools
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Values of the json_codec option
+JSON_CODECS = ("json", "orjson")
+# Values of the output_shape option: the input record and its result, or only
+# the ClinVar ID of the input record and its result
+OUTPUT_SHAPES = ("full", "keyed")
+
+
+class RawJSON(str):
+    """
+    A value that is already encoded as JSON, e.g. by pydantic's
+    `model_dump_json`, and is written to the output verbatim.
+    """
+
+
+def is_error_result(result) -> bool:
+    """
+    Returns true if `result`, as returned by the normalization functions, is an
+    error result.
+    """
+    return isinstance(result, dict) and "errors" in result
+
+
+def is_error_output(output: str) -> bool:
+    """
+    Returns true if the output record `output`, as returned by `encode_output`,
+    has errors. As "out" is the last key of the output, this does not need to
+    decode it.
+    """
+    return output[output.rfind('"out": ') :].startswith('"out": {"errors":')
+
+
+class JsonCodec:
+    """
+    Codec using the standard library `json` module. Its output in the "full"
+    shape is the same as `json.dumps({"in": clinvar_json, "out": result})`, and
+    in the "keyed" shape as `json.dumps({"id": clinvar_json["id"], "out": result})`,
+    byte for byte.
+    """
+
+    name = "json"
+    # Whether the normalization functions should return VRS models as `RawJSON`
+    raw_models = False
+
+    def loads(self, data: str):
+        return json.loads(data)
+
+    def dumps(self, value) -> str:
+        if isinstance(value, RawJSON):
+            return value
+        return json.dumps(value)
+
+    def encode_output(
+        self, line: str, clinvar_json: dict, result, shape: str = "full"
+    ) -> str:
+        """
+        Returns the output record in `shape`, one of `OUTPUT_SHAPES`, for the
+        input record `clinvar_json`, read from `line`, and its normalization
+        `result`.
+        """
+        return self.wrap_output(line, clinvar_json, self.dumps(result), shape)
+
+    def wrap_output(
+        self, line: str, clinvar_json: dict, out: str, shape: str = "full"
+    ) -> str:
+        """
+        Like `encode_output`, for a result `out` that is already encoded.
+        """
+        if shape == "keyed":
+            return f'{{"id": {self.dumps(clinvar_json.get("id"))}, "out": {out}}}'
+        return f'{{"in": {self.dumps(clinvar_json)}, "out": {out}}}'
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Codec using orjson. The input record is written to the output as it was read
+    from `line`, without encoding it again, and VRS models are serialized
+    directly to JSON by pydantic. The output has the same JSON values as
+    `JsonCodec`'s, but without whitespace after separators (except after the
+    keys of the output record itself), and with non-ASCII characters unescaped.
+    """
+
+    name = "orjson"
+    raw_models = True
+
+    def loads(self, data: str):
+        return orjson.loads(data)
+
+    def dumps(self, value) -> str:
+        if isinstance(value, RawJSON):
+            return value
+        return orjson.dumps(value).decode("utf-8")
+
+    def wrap_output(
+        self, line: str, clinvar_json: dict, out: str, shape: str = "full"
+    ) -> str:
+        if shape == "keyed":
+            return super().wrap_output(line, clinvar_json, out, shape)
+        return f'{{"in": {line.strip()}, "out": {out}}}'
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(name: str | None = None) -> JsonCodec:
+    """
+    Returns the codec named `name`, one of `JSON_CODECS`, defaulting to "json".
+    """
+    if name in (None, "json"):
+        return JsonCodec()
+    if name == "orjson":
+        if orjson is None:
+            raise RuntimeError(
+                "The orjson JSON codec requires orjson, which can be installed "
+                "with the 'fast' extra: pip install 'clinvar_gk_pilot[fast]'"
+            )
+        return OrjsonCodec()
+    raise ValueError(f"Unknown JSON codec {name}, expected one of {JSON_CODECS}")
@@ -1,3 +1,8 @@
+import base64
+import concurrent.futures
+import hashlib
+import io
+import json
 import os
 import queue
 import subprocess
@@ -5,12 +10,25 @@ import threading
 import time
 from pathlib import Path, PurePath
 
+import google_crc32c
 import requests
 from google.cloud import storage
+from google.cloud.storage.retry import DEFAULT_RETRY
 
 from clinvar_gk_pilot.logger import logger
 from clinvar_gk_pilot.utils import make_progress_logger
 
+# Bytes fetched by each ranged request of a sliced download
+DOWNLOAD_SLICE_SIZE = 64 * 1024 * 1024
+# Number of slices of a download fetched concurrently
+DOWNLOAD_THREADS = 8
+# Attempts at fetching a slice before the download fails
+DOWNLOAD_SLICE_ATTEMPTS = 4
+# Suffix of the sidecar file of a downloaded blob's metadata
+CACHE_METADATA_SUFFIX = ".metadata.json"
+# Most source objects of a compose request
+COMPOSE_MAX_SOURCES = 32
+
 
 def _get_gcs_client() -> storage.Client:
     if getattr(_get_gcs_client, "client", None) is None:
@@ -18,57 +36,435 @@ def _get_gcs_client() -> storage.Client:
     return getattr(_get_gcs_client, "client")
 
 
-def parse_blob_uri(uri: str, client: storage.Client = None) -> storage.Blob:
+def _split_blob_uri(uri: str) -> tuple[str, str]:
+    """
+    Returns the bucket name and blob name of `uri`, without creating a client.
+    """
     if not uri.startswith("gs://"):
         raise ValueError("Must be a fully qualified URI beginning with gs://")
-    if client is None:
-        client = _get_gcs_client()
     proto, *rest = uri.split("://")
     bucket, *path_segments = rest[0].split("/")
-    return storage.Blob(
-        name="/".join(path_segments), bucket=storage.Bucket(client=client, name=bucket)
-    )
+    return bucket, "/".join(path_segments)
+
+
+def parse_blob_uri(uri: str, client: storage.Client = None) -> storage.Blob:
+    bucket, name = _split_blob_uri(uri)
+    if client is None:
+        client = _get_gcs_client()
+    return storage.Blob(name=name, bucket=storage.Bucket(client=client, name=bucket))
 
 
 def _local_file_path_for(blob_uri: str, root_dir: str = "buckets") -> str:
-    parsed_uri = parse_blob_uri(blob_uri)
-    relpath = f"{root_dir}/{parsed_uri.bucket.name}/{parsed_uri.name}"
+    bucket, name = _split_blob_uri(blob_uri)
+    relpath = f"{root_dir}/{bucket}/{name}"
     return relpath
 
 
-def already_downloaded(blob_uri: str) -> bool:
+def cache_metadata_file_name(local_file_name: str) -> str:
+    """
+    Returns the name of the sidecar file recording the metadata of the blob that
+    the local file `local_file_name` was downloaded from.
+    """
+    return f"{local_file_name}{CACHE_METADATA_SUFFIX}"
+
+
+def read_cache_metadata(local_file_name: str) -> dict | None:
+    """
+    Returns the sidecar metadata of `local_file_name`, or None if it has none.
+    """
+    try:
+        with open(cache_metadata_file_name(local_file_name), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_cache_metadata(local_file_name: str, blob: storage.Blob):
+    """
+    Record in the sidecar of `local_file_name` that it is a verified copy of the
+    current generation of `blob`, as of now.
+    """
+    stat = os.stat(local_file_name)
+    metadata = {
+        "uri": f"gs://{blob.bucket.name}/{blob.name}",
+        "generation": blob.generation,
+        "size": blob.size,
+        "crc32c": blob.crc32c,
+        "md5_hash": blob.md5_hash,
+        "mtime_ns": stat.st_mtime_ns,
+        "checked_at": time.time(),
+    }
+    file_name = cache_metadata_file_name(local_file_name)
+    with open(f"{file_name}.tmp", "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+def _unchanged_since_verified(local_file_name: str, metadata: dict | None) -> bool:
+    if metadata is None:
+        return False
+    stat = os.stat(local_file_name)
+    return stat.st_size == metadata["size"] and stat.st_mtime_ns == metadata["mtime_ns"]
+
+
+def already_downloaded(blob_uri: str, ttl: float = 0, offline: bool = False) -> bool:
     """
-    Returns true if a file at the expected path (using _local_file_path_for)
-    exists locally and has the same size as the remote blob.
+    Returns true if the file at the expected path (using _local_file_path_for) is
+    a complete copy of the current generation of the remote blob.
+
+    A downloaded file has a sidecar recording the generation and checksums of the
+    blob it was verified against. Within `ttl` seconds of the blob's metadata last
+    being checked, or if `offline`, a file that is unchanged since then is used
+    without fetching the blob's metadata again. Otherwise it is used if the blob
+    has the same generation, and a file without a sidecar or of another
+    generation is used only if it has the blob's checksum.
     """
-    expected_local_file = _local_file_path_for(blob_uri)
+    local_file_name = _local_file_path_for(blob_uri)
+    if not os.path.exists(local_file_name):
+        if offline:
+            raise RuntimeError(f"{blob_uri} is not downloaded, and --offline is set")
+        return False
+    metadata = read_cache_metadata(local_file_name)
+    unchanged = _unchanged_since_verified(local_file_name, metadata)
+    if offline:
+        if metadata is None:
+            logger.warning(f"Using {local_file_name}, which has not been verified")
+        elif not unchanged:
+            raise RuntimeError(
+                f"{local_file_name} has changed since it was downloaded, and "
+                "--offline is set"
+            )
+        return True
+    if unchanged and time.time() - metadata["checked_at"] < ttl:
+        return True
     blob = parse_blob_uri(blob_uri)
     # load the blob metadata from the server
     blob.reload()
-    blob_bytes = blob.size
-    return (
-        Path(expected_local_file).exists()
-        and Path(expected_local_file).stat().st_size == blob_bytes
-    )
+    if unchanged and metadata["generation"] == blob.generation:
+        write_cache_metadata(local_file_name, blob)
+        return True
+    if os.path.getsize(local_file_name) != blob.size:
+        return False
+    logger.info(f"Verifying {local_file_name} against the checksum of {blob_uri}")
+    try:
+        verify_checksum(local_file_name, blob)
+    except RuntimeError as e:
+        logger.info(f"Downloading {blob_uri} again: {e}")
+        return False
+    write_cache_metadata(local_file_name, blob)
+    return True
+
+
+def file_checksums(file_name: str) -> dict:
+    """
+    Returns the CRC32C checksum and MD5 hash of the file `file_name`, base64
+    encoded like the `crc32c` and `md5_hash` of a blob.
+    """
+    crc32c = google_crc32c.Checksum()
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as f:
+        while block := f.read(8 * 1024 * 1024):
+            crc32c.update(block)
+            md5.update(block)
+    return {
+        "crc32c": base64.b64encode(crc32c.digest()).decode("ascii"),
+        "md5_hash": base64.b64encode(md5.digest()).decode("ascii"),
+    }
+
+
+def _checksum_name(blob: storage.Blob) -> str:
+    """
+    Returns the checksum of `blob` that copies of it are verified with: "crc32c",
+    or "md5_hash" for a blob without a CRC32C checksum.
+    """
+    for name in ("crc32c", "md5_hash"):
+        if getattr(blob, name) is not None:
+            return name
+    raise RuntimeError(f"gs://{blob.bucket.name}/{blob.name} has no checksum")
 
 
-def download_to_local_file(blob_uri: str) -> str:
+def verify_checksum(file_name: str, blob: storage.Blob, checksum: str | None = None):
     """
-    Expects a blob_uri beginning with "gs://".
-    Downloads to a local file using _local_file_path_for to generate the local path.
+    Raises a RuntimeError unless the local file `file_name` has the size and the
+    CRC32C checksum of `blob`, or its MD5 hash if it has no CRC32C checksum.
+    `checksum` is that checksum of the file, base64 encoded, if it has already
+    been computed.
     """
-    if not blob_uri.startswith("gs://"):
+    if os.path.getsize(file_name) != blob.size:
         raise RuntimeError(
-            "Expecting a google cloud storage URI beginning with 'gs://'."
+            f"{file_name} has {os.path.getsize(file_name)} bytes, but "
+            f"gs://{blob.bucket.name}/{blob.name} has {blob.size}"
+        )
+    name = _checksum_name(blob)
+    if checksum is None:
+        checksum = file_checksums(file_name)[name]
+    expected = getattr(blob, name)
+    if checksum != expected:
+        raise RuntimeError(
+            f"{name} of {file_name} is {checksum}, but "
+            f"gs://{blob.bucket.name}/{blob.name} has {expected}"
         )
-    blob = parse_blob_uri(blob_uri)
-    local_file_name = _local_file_path_for(blob_uri)
-    # Make parents
-    os.makedirs(os.path.dirname(local_file_name), exist_ok=True)
-    with open(local_file_name, "wb") as f:
-        logger.info(f"Downloading {blob_uri} to {local_file_name}")
-        blob.download_to_file(file_obj=f)
-    return local_file_name
+
+
+def _download_slice(
+    blob: storage.Blob,
+    file_name: str,
+    start: int,
+    end: int,
+    client: storage.Client,
+    attempts: int = DOWNLOAD_SLICE_ATTEMPTS,
+):
+    """
+    Write bytes `start` to `end` (inclusive) of `blob` to the same bytes of the
+    existing file `file_name`, retrying up to `attempts` times.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            with open(file_name, "r+b") as f:
+                f.seek(start)
+                # The stored bytes of the generation whose checksum is verified,
+                # even if the blob is replaced or has a Content-Encoding
+                blob.download_to_file(
+                    f,
+                    client=client,
+                    start=start,
+                    end=end,
+                    raw_download=True,
+                    if_generation_match=blob.generation,
+                    checksum=None,
+                )
+                bytes_written = f.tell() - start
+            if bytes_written != end - start + 1:
+                raise RuntimeError(
+                    f"Received {bytes_written} bytes for bytes {start}-{end}"
+                )
+            return
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            wait_time = 2**attempt
+            logger.warning(
+                f"Retrying bytes {start}-{end} of {blob.name} in {wait_time} "
+                f"seconds after {e!r}"
+            )
+            time.sleep(wait_time)
+
+
+class SlicedDownload:
+    """
+    Downloads the blob at `blob_uri`, which must begin with "gs://", to the local
+    path from _local_file_path_for in a background thread.
+
+    Slices of `slice_size` bytes are fetched with ranged requests on `threads`
+    threads into a temporary file of the blob's size, and each slice is retried
+    on its own if it fails. The temporary file is only moved to the local path
+    once it matches the blob's checksum, so an interrupted or corrupt download
+    is never mistaken for a complete one.
+
+    Slices are fetched in file order, and `open` returns a file that reads the
+    download as it is written, so the blob can be processed while it downloads.
+    """
+
+    def __init__(
+        self,
+        blob_uri: str,
+        client: storage.Client | None = None,
+        slice_size: int = DOWNLOAD_SLICE_SIZE,
+        threads: int = DOWNLOAD_THREADS,
+    ):
+        if not blob_uri.startswith("gs://"):
+            raise RuntimeError(
+                "Expecting a google cloud storage URI beginning with 'gs://'."
+            )
+        self.blob_uri = blob_uri
+        self.client = client or _get_gcs_client()
+        self.blob = parse_blob_uri(blob_uri, client=self.client)
+        self.blob.reload(client=self.client)
+        self.size = self.blob.size
+        self.local_file_name = _local_file_path_for(blob_uri)
+        self.tmp_file_name = f"{self.local_file_name}.download"
+        self.slice_size = slice_size
+        self.threads = threads
+        self.condition = threading.Condition()
+        # Bytes downloaded from the start of the blob without any gaps
+        self.bytes_ready = 0
+        self.done = False
+        self.error = None
+        self.thread = None
+
+    def start(self) -> "SlicedDownload":
+        # Make parents
+        os.makedirs(os.path.dirname(self.local_file_name), exist_ok=True)
+        # The sidecar of an earlier download no longer describes the local file
+        metadata_file_name = cache_metadata_file_name(self.local_file_name)
+        if os.path.exists(metadata_file_name):
+            os.remove(metadata_file_name)
+        with open(self.tmp_file_name, "wb") as f:
+            f.truncate(self.size)
+        self.thread = threading.Thread(
+            target=self._run, name="sliced-download", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def _run(self):
+        slices = [
+            (start, min(start + self.slice_size, self.size) - 1)
+            for start in range(0, self.size, self.slice_size)
+        ]
+        logger.info(
+            f"Downloading {self.blob_uri} to {self.local_file_name} in "
+            f"{len(slices)} slices on {self.threads} threads"
+        )
+        log_progress = make_progress_logger(
+            logger=logger,
+            fmt=(
+                "Downloaded {elapsed_value} bytes in {elapsed:.2f} seconds. "
+                "Total bytes downloaded: {current_value}/{max_value}."
+            ),
+            max_value=self.size,
+        )
+        log_progress(0)
+        bytes_downloaded = 0
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix="download"
+        )
+        hash_f = None
+        try:
+            # The checksum is computed as the downloaded bytes become contiguous,
+            # while they are likely still in the page cache, instead of in a
+            # separate pass
+            hasher = (
+                google_crc32c.Checksum()
+                if _checksum_name(self.blob) == "crc32c"
+                else hashlib.md5()
+            )
+            # Unbuffered, as a buffered file would read ahead into bytes that
+            # have not been downloaded yet
+            hash_f = open(self.tmp_file_name, "rb", buffering=0)
+            futures = {
+                executor.submit(
+                    _download_slice,
+                    self.blob,
+                    self.tmp_file_name,
+                    start,
+                    end,
+                    self.client,
+                ): (start, end)
+                for start, end in slices
+            }
+            # Ends of the finished slices after the first gap, by start
+            finished = {}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                start, end = futures[future]
+                finished[start] = end + 1
+                bytes_downloaded += end - start + 1
+                with self.condition:
+                    hashed_bytes = self.bytes_ready
+                    while self.bytes_ready in finished:
+                        self.bytes_ready = finished.pop(self.bytes_ready)
+                    self.condition.notify_all()
+                while hashed_bytes < self.bytes_ready:
+                    block = hash_f.read(
+                        min(self.bytes_ready - hashed_bytes, 8 * 1024 * 1024)
+                    )
+                    hasher.update(block)
+                    hashed_bytes += len(block)
+                log_progress(bytes_downloaded)
+            verify_checksum(
+                self.tmp_file_name,
+                self.blob,
+                checksum=base64.b64encode(hasher.digest()).decode("ascii"),
+            )
+            os.replace(self.tmp_file_name, self.local_file_name)
+            write_cache_metadata(self.local_file_name, self.blob)
+            logger.info(f"Downloaded and verified {self.blob_uri}")
+        except BaseException as e:
+            executor.shutdown(cancel_futures=True)
+            os.remove(self.tmp_file_name)
+            self.error = e
+        finally:
+            if hash_f is not None:
+                hash_f.close()
+            executor.shutdown()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def wait(self) -> str:
+        """
+        Waits for the download to finish and returns the local path, or raises
+        the error it failed with.
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.local_file_name
+
+    def wait_for(self, offset: int) -> int:
+        """
+        Waits until the byte at `offset` has been downloaded and returns the
+        number of bytes downloaded, which is only the size of the blob once it
+        has been verified. Raises a RuntimeError if the download failed.
+        """
+        with self.condition:
+            while not self.done and self.bytes_ready <= offset:
+                self.condition.wait()
+            error = self.error
+        if error is not None:
+            raise RuntimeError(f"Download of {self.blob_uri} failed") from error
+        return self.bytes_ready
+
+    def open(self) -> "DownloadReader":
+        """
+        Returns a binary file reading the download from the start, whose reads
+        wait for the bytes to be downloaded. Must be called after `start`.
+        """
+        return DownloadReader(self)
+
+
+class DownloadReader(io.RawIOBase):
+    """
+    Reads the temporary file of a `SlicedDownload` as it is written.
+    """
+
+    def __init__(self, download: SlicedDownload):
+        super().__init__()
+        self.download = download
+        # Unbuffered, as a buffered file would read ahead into bytes that have
+        # not been downloaded yet
+        self.f = open(download.tmp_file_name, "rb", buffering=0)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        bytes_ready = self.download.wait_for(self.position)
+        if bytes_ready <= self.position:
+            return 0
+        n = self.f.readinto(memoryview(b)[: bytes_ready - self.position])
+        self.position += n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def download_to_local_file(
+    blob_uri: str,
+    client: storage.Client | None = None,
+    slice_size: int = DOWNLOAD_SLICE_SIZE,
+    threads: int = DOWNLOAD_THREADS,
+) -> str:
+    """
+    Expects a blob_uri beginning with "gs://".
+    Downloads to a local file using _local_file_path_for to generate the local path,
+    in verified slices with `SlicedDownload`.
+    """
+    return SlicedDownload(blob_uri, client, slice_size, threads).start().wait()
 
 
 def copy_file_to_bucket(
@@ -85,6 +481,70 @@ def copy_file_to_bucket(
     logger.info(f"Finished uploading {local_file_uri} to {remote_blob_uri}")
 
 
+def upload_file(
+    file_name: str,
+    blob_uri: str,
+    client: storage.Client | None = None,
+    start: int = 0,
+    end: int | None = None,
+) -> storage.Blob:
+    """
+    Upload bytes `start` to `end` (exclusive, default the end of the file) of the
+    local file `file_name` to `blob_uri`, verified by its CRC32C checksum.
+    Failed requests are retried, as uploading the same bytes again is harmless.
+    """
+    if client is None:
+        client = _get_gcs_client()
+    if end is None:
+        end = os.path.getsize(file_name)
+    blob = parse_blob_uri(blob_uri, client=client)
+    with open(file_name, "rb") as f:
+        f.seek(start)
+        blob.upload_from_file(
+            f,
+            size=end - start,
+            client=client,
+            checksum="crc32c",
+            retry=DEFAULT_RETRY,
+        )
+    return blob
+
+
+def compose_blobs(
+    source_uris: list[str], blob_uri: str, client: storage.Client | None = None
+) -> storage.Blob:
+    """
+    Concatenate the blobs `source_uris` into the blob at `blob_uri`. More than
+    `COMPOSE_MAX_SOURCES` blobs are composed in a tree of intermediate blobs
+    named `<blob>.compose/...`, which are deleted afterwards.
+    """
+    if client is None:
+        client = _get_gcs_client()
+    blob = parse_blob_uri(blob_uri, client=client)
+    sources = [parse_blob_uri(uri, client=client) for uri in source_uris]
+    intermediates = []
+    level = 0
+    while len(sources) > COMPOSE_MAX_SOURCES:
+        composed = []
+        for i in range(0, len(sources), COMPOSE_MAX_SOURCES):
+            intermediate = blob.bucket.blob(f"{blob.name}.compose/{level}-{i:05d}")
+            intermediate.compose(
+                sources[i : i + COMPOSE_MAX_SOURCES], client=client, retry=DEFAULT_RETRY
+            )
+            composed.append(intermediate)
+        intermediates.extend(composed)
+        sources = composed
+        level += 1
+    if sources:
+        blob.compose(sources, client=client, retry=DEFAULT_RETRY)
+    else:
+        blob.upload_from_string(b"", client=client)
+    for intermediate in intermediates:
+        intermediate.delete(client=client)
+    blob.reload(client=client)
+    return blob
+
+
 def blob_writer(
     blob_uri: str, client: storage.Client = None, binary=True
 ) -> storage.Blob:
@@ -0,0 +1,330 @@
+"""
+GZIP reading and writing that uses more than one core per file.
+
+Files are written as a series of independent GZIP members of `DEFAULT_BLOCK_SIZE`
+uncompressed bytes each, compressed in a thread pool (like pigz), and read with
+decompression running ahead in a separate thread. zlib releases the GIL while it
+compresses and decompresses, so these threads run in parallel with each other and
+with the thread using the file. Multi-member GZIP files are standard, and can be
+read by `gzip.open`, `zcat` and BigQuery.
+
+Files can also be written in BGZF blocks, as used by htslib for indexed files:
+GZIP members of at most `BGZF_BLOCK_SIZE` uncompressed bytes whose header records
+the member's compressed size, so a record can be read by seeking to the start of
+the member holding it and decompressing just that member.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+# Compression level of final outputs, the default of gzip.open
+DEFAULT_COMPRESSLEVEL = 9
+# Compression level of intermediate files that are read back and removed
+INTERMEDIATE_COMPRESSLEVEL = 1
+# Uncompressed bytes in each GZIP member written
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Compressed bytes read at a time, and number of decompressed blocks buffered
+# by the read-ahead thread
+READ_BLOCK_SIZE = 1024 * 1024
+READ_AHEAD_BLOCKS = 8
+# Uncompressed bytes in each BGZF block, as in htslib, so that a compressed block
+# always fits in the 64 KiB that its header can describe
+BGZF_BLOCK_SIZE = 65280
+# The empty block that ends a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Compression thread pools of this process, by number of threads
+_executors = {}
+
+
+def default_threads() -> int:
+    return os.cpu_count() or 1
+
+
+def _executor(threads: int) -> concurrent.futures.ThreadPoolExecutor:
+    if threads not in _executors:
+        _executors[threads] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="gzip"
+        )
+    return _executors[threads]
+
+
+# The threads of a pool do not exist in a forked child process
+os.register_at_fork(after_in_child=_executors.clear)
+
+
+def _compress_block(block: bytes, compresslevel: int) -> bytes:
+    # mtime=0 so that the same data always compresses to the same bytes
+    return gzip.compress(block, compresslevel=compresslevel, mtime=0)
+
+
+def _compress_bgzf_block(block: bytes, compresslevel: int) -> bytes:
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(block) + compressor.flush()
+    # GZIP header with mtime=0 and the "BC" extra subfield holding the total
+    # block size minus 1, then the deflated data, CRC32 and uncompressed size
+    header = struct.pack(
+        "<4BI2BH2BHH", 0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, 66, 67, 2, len(deflated) + 25
+    )
+    return header + deflated + struct.pack("<2I", zlib.crc32(block), len(block))
+
+
+def compress_bgzf(
+    data: bytes,
+    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+    threads: int | None = None,
+) -> list[bytes]:
+    """
+    Returns `data` compressed as a list of BGZF blocks of `BGZF_BLOCK_SIZE`
+    uncompressed bytes each, which are compressed in parallel on `threads`
+    threads (default: one per core).
+    """
+    threads = threads or default_threads()
+    blocks = [
+        data[i : i + BGZF_BLOCK_SIZE] for i in range(0, len(data), BGZF_BLOCK_SIZE)
+    ]
+    if len(blocks) <= 1 or threads == 1:
+        return [_compress_bgzf_block(block, compresslevel) for block in blocks]
+    return list(
+        _executor(threads).map(
+            _compress_bgzf_block, blocks, [compresslevel] * len(blocks)
+        )
+    )
+
+
+def compress(
+    data: bytes,
+    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+    threads: int | None = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> bytes:
+    """
+    Returns `data` compressed as GZIP members of `block_size` bytes each, which
+    are compressed in parallel on `threads` threads (default: one per core).
+    """
+    threads = threads or default_threads()
+    blocks = [data[i : i + block_size] for i in range(0, len(data), block_size)]
+    if len(blocks) <= 1 or threads == 1:
+        return b"".join(
+            _compress_block(block, compresslevel) for block in blocks or [b""]
+        )
+    return b"".join(
+        _executor(threads).map(_compress_block, blocks, [compresslevel] * len(blocks))
+    )
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """
+    Writable binary file that compresses what is written to it as GZIP members
+    of `block_size` bytes, on `threads` threads (default: one per core), and
+    writes them to `fileobj` in order. If `bgzf` is true, the members are BGZF
+    blocks of `BGZF_BLOCK_SIZE` bytes, and their sizes are kept in
+    `member_sizes`.
+    """
+
+    def __init__(
+        self,
+        fileobj,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        threads: int | None = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        bgzf: bool = False,
+    ):
+        super().__init__()
+        self.owns_fileobj = isinstance(fileobj, (str, os.PathLike))
+        self.fileobj = open(fileobj, "wb") if self.owns_fileobj else fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads or default_threads()
+        self.block_size = BGZF_BLOCK_SIZE if bgzf else block_size
+        self.compress_block = _compress_bgzf_block if bgzf else _compress_block
+        self.bgzf = bgzf
+        self.buffer = bytearray()
+        # Futures of compressed members not yet written, in file order
+        self.pending = collections.deque()
+        self.members_written = 0
+        self.member_sizes = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = memoryview(data).cast("B")
+        size = len(data)
+        if self.buffer:
+            fill = self.block_size - len(self.buffer)
+            self.buffer += data[:fill]
+            data = data[fill:]
+            if len(self.buffer) < self.block_size:
+                return size
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while len(data) >= self.block_size:
+            self._submit(bytes(data[: self.block_size]))
+            data = data[self.block_size :]
+        self.buffer += data
+        return size
+
+    def _submit(self, block: bytes):
+        if self.threads == 1:
+            self._write_member(self.compress_block(block, self.compresslevel))
+            return
+        self.pending.append(
+            _executor(self.threads).submit(
+                self.compress_block, block, self.compresslevel
+            )
+        )
+        # Bound the memory held by compressed members waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self._write_member(self.pending.popleft().result())
+
+    def _write_member(self, member: bytes):
+        self.fileobj.write(member)
+        self.members_written += 1
+        if self.bgzf:
+            self.member_sizes.append(len(member))
+
+    def flush(self):
+        """
+        Write all complete blocks to `fileobj`. The data after the last complete
+        block stays buffered, so that flushing does not produce small members.
+        """
+        while self.pending:
+            self._write_member(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # An empty file is still written as one (empty) member
+            if self.buffer or (self.members_written == 0 and not self.pending):
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+        finally:
+            # Flushes the pending members
+            super().close()
+            if self.owns_fileobj:
+                self.fileobj.close()
+
+
+class ReadAheadGzipReader(io.RawIOBase):
+    """
+    Readable binary file of the decompressed content of the GZIP file `fileobj`,
+    which may have several members. A separate thread reads and decompresses up
+    to `READ_AHEAD_BLOCKS` blocks ahead of the reader.
+    """
+
+    def __init__(self, fileobj):
+        super().__init__()
+        self.owns_fileobj = isinstance(fileobj, (str, os.PathLike))
+        self.fileobj = open(fileobj, "rb") if self.owns_fileobj else fileobj
+        self.blocks = queue.Queue(maxsize=READ_AHEAD_BLOCKS)
+        self.block = memoryview(b"")
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+            target=self._read_ahead, name="gzip-read-ahead", daemon=True
+        )
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_ahead(self):
+        try:
+            decompressor = zlib.decompressobj(wbits=31)
+            started = False
+            while not self.stop.is_set():
+                data = self.fileobj.read(READ_BLOCK_SIZE)
+                if not data:
+                    break
+                while data:
+                    if decompressor.eof:
+                        # Trailing zero padding after the last member is allowed
+                        if not data.lstrip(b"\0"):
+                            break
+                        decompressor = zlib.decompressobj(wbits=31)
+                    started = True
+                    output = decompressor.decompress(data)
+                    data = decompressor.unused_data
+                    if output and not self._put(output):
+                        return
+            if started and not decompressor.eof:
+                raise EOFError(
+                    "Compressed file ended before the end-of-stream marker was reached"
+                )
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.block:
+            if self.eof:
+                return 0
+            item = self.blocks.get()
+            if item is None:
+                self.eof = True
+                return 0
+            if isinstance(item, BaseException):
+                self.eof = True
+                raise item
+            self.block = memoryview(item)
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.stop.set()
+        self.thread.join()
+        if self.owns_fileobj:
+            self.fileobj.close()
+        super().close()
+
+
+def open_gzip(
+    file,
+    mode: str = "rt",
+    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+    threads: int | None = None,
+    encoding: str | None = None,
+    bgzf: bool = False,
+):
+    """
+    Opens the GZIP file `file`, a path or a binary file object, for reading
+    ("r", "rb", "rt") with `ReadAheadGzipReader` or writing ("w", "wb", "wt")
+    with `ParallelGzipWriter`, in BGZF blocks if `bgzf` is true. Like
+    `gzip.open`, "r" and "w" are binary and text modes return a
+    `io.TextIOWrapper`.
+    """
+    if mode in ("r", "rb", "rt"):
+        binary_file = io.BufferedReader(ReadAheadGzipReader(file), READ_BLOCK_SIZE)
+    elif mode in ("w", "wb", "wt"):
+        binary_file = ParallelGzipWriter(
+            file, compresslevel=compresslevel, threads=threads, bgzf=bgzf
+        )
+    else:
+        raise ValueError(f"Invalid mode: {mode!r}")
+    if "t" in mode:
+        return io.TextIOWrapper(binary_file, encoding=encoding)
+    return binary_file
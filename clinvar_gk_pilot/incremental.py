@@ -0,0 +1,319 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Callable, Iterable, Tuple
+
+from clinvar_gk_pilot.cache import normalization_input, normalization_options
+from clinvar_gk_pilot.codec import get_codec, is_error_output
+from clinvar_gk_pilot.gzipio import (
+    DEFAULT_COMPRESSLEVEL,
+    INTERMEDIATE_COMPRESSLEVEL,
+    open_gzip,
+)
+from clinvar_gk_pilot.logger import logger
+from clinvar_gk_pilot.parquet import ParquetOutputWriter
+from clinvar_gk_pilot.shards import MANIFEST_SUFFIX, iter_output_lines
+
+# Suffix of the file recording the normalization options of an output, written
+# next to it so that a later release can check them before reusing its results
+RUN_OPTIONS_SUFFIX = ".options.json"
+
+
+def record_key(clinvar_json: dict) -> bytes:
+    """
+    Returns a compact hash of the fields of `clinvar_json` used to normalize it.
+    """
+    return hashlib.blake2b(
+        json.dumps(normalization_input(clinvar_json), sort_keys=True).encode("utf-8"),
+        digest_size=16,
+    ).digest()
+
+
+def run_options_file_name(output_file_name: str) -> str:
+    """
+    Returns the name of the file recording the normalization options of the
+    output `output_file_name`, which can also be the manifest of a sharded output.
+    """
+    for suffix in (MANIFEST_SUFFIX, ".json.gz", ".ndjson.gz", ".gz"):
+        if output_file_name.endswith(suffix):
+            return output_file_name[: -len(suffix)] + RUN_OPTIONS_SUFFIX
+    return output_file_name + RUN_OPTIONS_SUFFIX
+
+
+def write_run_options(output_file_name: str, opts: dict):
+    """
+    Records the `normalization_options` of `opts` next to the output
+    `output_file_name`.
+    """
+    with open(run_options_file_name(output_file_name), "w", encoding="utf-8") as f:
+        json.dump(normalization_options(opts), f, indent=2, sort_keys=True)
+
+
+def previous_results_reusable(previous_output_file_name: str, opts: dict) -> bool:
+    """
+    Returns whether the previous output `previous_output_file_name` was produced
+    with the same `normalization_options` as `opts`, as recorded by
+    `write_run_options`. Outputs without a record of their options are not
+    reused, as their results might differ from those of this run.
+    """
+    file_name = run_options_file_name(previous_output_file_name)
+    if not os.path.exists(file_name):
+        logger.warning(
+            f"Not reusing previous results, as {file_name} recording the "
+            "options they were produced with does not exist"
+        )
+        return False
+    with open(file_name, "r", encoding="utf-8") as f:
+        previous_options = json.load(f)
+    options = normalization_options(opts)
+    if previous_options != options:
+        logger.warning(
+            f"Not reusing previous results, as they were produced with "
+            f"{previous_options} instead of {options}"
+        )
+        return False
+    return True
+
+
+class PreviousResults:
+    """
+    Map from the `record_key` of each record of a previous release to the JSON
+    of its `"out"` value, kept in a SQLite file at `path` rather than in memory,
+    as a full release has millions of results.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute(
+            "CREATE TABLE results (key BLOB PRIMARY KEY, out TEXT NOT NULL) "
+            "WITHOUT ROWID"
+        )
+
+    def add(self, results: Iterable[Tuple[bytes, str]]):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (key, out) VALUES (?, ?)", results
+            )
+
+    def get(self, key: bytes) -> str | None:
+        row = self.conn.execute(
+            "SELECT out FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def __contains__(self, key: bytes) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+
+def load_previous_results(
+    previous_input_file_name: str,
+    previous_output_file_name: str,
+    path: str,
+    json_codec: str | None = None,
+) -> PreviousResults:
+    """
+    Reads a previous release's input file and the output produced from it, which
+    can be the manifest of a sharded output, into a `PreviousResults` at `path`,
+    with each `"out"` value encoded with the `json_codec` codec. Records whose
+    previous output was an error are left out so that they are normalized again.
+
+    The input and output must have the same number of lines, in the same order.
+    """
+    codec = get_codec(json_codec)
+
+    def reusable_results():
+        with open_gzip(previous_input_file_name, "rt", encoding="utf-8") as f_in:
+            for in_line, out_line in zip(
+                f_in, iter_output_lines(previous_output_file_name), strict=True
+            ):
+                out = codec.loads(out_line)["out"]
+                if out is None or "errors" in out:
+                    continue
+                yield record_key(codec.loads(in_line)), codec.dumps(out)
+
+    previous_results = PreviousResults(path)
+    previous_results.add(reusable_results())
+    logger.info(
+        f"Loaded {len(previous_results)} reusable results from "
+        f"{previous_output_file_name}"
+    )
+    return previous_results
+
+
+def process_incremental(
+    input_file_name: str,
+    output_file_name: str,
+    process_fn: Callable[[str, str], None],
+    previous_input_file_name: str | None = None,
+    previous_output_file_name: str | None = None,
+    dedup: bool = False,
+    output_shape: str = "full",
+    errors_file_name: str | None = None,
+    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+    threads: int | None = None,
+    json_codec: str | None = None,
+    parquet_file_name: str | None = None,
+    liftover: bool = False,
+    errors_compresslevel: int | None = None,
+) -> dict:
+    """
+    Write the output for `input_file_name` to `output_file_name`, running only
+    the records that need to be normalized through
+    `process_fn(input_file_name, output_file_name)`.
+
+    If a previous release's input and output files are given, and the output was
+    produced with the same `liftover` option and normalization environment as
+    this run, every record whose normalization input fields are unchanged gets
+    the previous release's result. The previous output can be the manifest of a
+    sharded output.
+    If `dedup` is true, only the first record with each distinct normalization
+    input is normalized, and its result is copied to the later records.
+    Reused results are written in `output_shape` with the `json_codec` codec,
+    which must be the shape and codec `process_fn` writes with. If
+    `errors_file_name` is given, the output lines with errors are also written to
+    it. The output file is compressed at `compresslevel` and the errors file at
+    `errors_compresslevel` (by default `compresslevel`), on `threads` threads. If `parquet_file_name` is given, the output lines are also
+    written to that Parquet file.
+
+    Returns counts of the reused, deduplicated and normalized records.
+    """
+    previous_results = {}
+    if previous_input_file_name and previous_results_reusable(
+        previous_output_file_name, {"liftover": liftover}
+    ):
+        previous_results = load_previous_results(
+            previous_input_file_name,
+            previous_output_file_name,
+            f"{output_file_name}.previous.sqlite",
+            json_codec,
+        )
+
+    pending_input_file_name = f"{output_file_name}.pending"
+    pending_output_file_name = f"{output_file_name}.pending.out"
+
+    codec = get_codec(json_codec)
+    reused_count = 0
+    pending_count = 0
+    # record key -> number of later records with the same key, for deduplication
+    duplicate_counts = {}
+    with (
+        open_gzip(input_file_name, "rt", encoding="utf-8") as f_in,
+        open_gzip(
+            pending_input_file_name,
+            "wt",
+            compresslevel=INTERMEDIATE_COMPRESSLEVEL,
+            threads=threads,
+            encoding="utf-8",
+        ) as f_pending,
+    ):
+        for line in f_in:
+            key = record_key(codec.loads(line))
+            if key in previous_results:
+                reused_count += 1
+            elif key in duplicate_counts:
+                duplicate_counts[key] += 1
+            else:
+                f_pending.write(line)
+                pending_count += 1
+                if dedup:
+                    duplicate_counts[key] = 0
+    duplicate_counts = {key: n for key, n in duplicate_counts.items() if n > 0}
+    deduplicated_count = sum(duplicate_counts.values())
+    logger.info(
+        f"Reusing previous results for {reused_count} records, "
+        f"reusing results of earlier records for {deduplicated_count} records, "
+        f"normalizing {pending_count} records"
+    )
+
+    process_fn(pending_input_file_name, pending_output_file_name)
+
+    # key -> "out" JSON of the first record with that key, while later records
+    # with the same key remain
+    duplicate_results = {}
+    parquet = (
+        ParquetOutputWriter(parquet_file_name, json_codec=json_codec)
+        if parquet_file_name
+        else None
+    )
+    with (
+        open_gzip(input_file_name, "rt", encoding="utf-8") as f_in,
+        open_gzip(pending_output_file_name, "rt", encoding="utf-8") as f_pending,
+        open_gzip(
+            output_file_name,
+            "wt",
+            compresslevel=compresslevel,
+            threads=threads,
+            encoding="utf-8",
+        ) as f_out,
+        (
+            open_gzip(
+                errors_file_name,
+                "wt",
+                compresslevel=(
+                    errors_compresslevel
+                    if errors_compresslevel is not None
+                    else compresslevel
+                ),
+                threads=threads,
+                encoding="utf-8",
+            )
+            if errors_file_name
+            else contextlib.nullcontext()
+        ) as f_errors,
+    ):
+        for line in f_in:
+            clinvar_json = codec.loads(line)
+            key = record_key(clinvar_json)
+            out = previous_results.get(key)
+            if out is None and key in duplicate_results:
+                out = duplicate_results[key]
+                duplicate_counts[key] -= 1
+                if duplicate_counts[key] == 0:
+                    del duplicate_results[key]
+            if out is not None:
+                output_line = codec.wrap_output(line, clinvar_json, out, output_shape)
+            else:
+                output_line = next(f_pending).rstrip("\n")
+                if key in duplicate_counts:
+                    duplicate_results[key] = codec.dumps(
+                        codec.loads(output_line)["out"]
+                    )
+            f_out.write(output_line)
+            f_out.write("\n")
+            if parquet is not None:
+                parquet.write(output_line)
+            if f_errors is not None and is_error_output(output_line):
+                f_errors.write(output_line)
+                f_errors.write("\n")
+
+    if parquet is not None:
+        parquet.close()
+    if isinstance(previous_results, PreviousResults):
+        previous_results.close()
+    os.remove(pending_input_file_name)
+    os.remove(pending_output_file_name)
+    logger.info(
+        f"Saved {reused_count + deduplicated_count} normalization calls "
+        f"({reused_count} from the previous release, "
+        f"{deduplicated_count} duplicates within this release)"
+    )
+    print(f"Output written to {output_file_name}")
+    return {
+        "reused": reused_count,
+        "deduplicated": deduplicated_count,
+        "normalized": pending_count,
+    }
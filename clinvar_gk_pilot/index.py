@@ -0,0 +1,136 @@
+"""
+Index of the records of an output written in BGZF blocks, by ClinVar ID.
+
+The index is a SQLite file next to the output, `<output>.index.sqlite`, holding
+for each record its ClinVar ID, the offset in the output of the BGZF block its
+line starts in, and the offset of the line in the block's uncompressed data. A
+record is read by seeking to its block and decompressing from there, without
+reading the rest of the output.
+"""
+
+import gzip
+import itertools
+import os
+import sqlite3
+from typing import Iterable, List, Tuple
+
+from clinvar_gk_pilot.gzipio import BGZF_BLOCK_SIZE
+
+INDEX_SUFFIX = ".index.sqlite"
+
+
+def index_file_name(output_file_name: str) -> str:
+    """
+    Returns the name of the index of the output `output_file_name`.
+    """
+    return f"{output_file_name}{INDEX_SUFFIX}"
+
+
+def line_offsets(
+    line_lengths: Iterable[int], block_sizes: List[int]
+) -> List[Tuple[int, int]]:
+    """
+    Returns `(block_offset, in_block_offset)` of the start of each line of
+    `line_lengths` bytes, for data compressed as BGZF blocks of `block_sizes`
+    compressed bytes each.
+    """
+    block_offsets = list(itertools.accumulate(block_sizes, initial=0))
+    offsets = []
+    position = 0
+    for line_length in line_lengths:
+        block, in_block_offset = divmod(position, BGZF_BLOCK_SIZE)
+        offsets.append((block_offsets[block], in_block_offset))
+        position += line_length
+    return offsets
+
+
+class OutputIndex:
+    """
+    Writes the index of an output as its chunks are written. The rows of each
+    chunk are committed before the chunk is checkpointed, and `truncate` removes
+    the rows of chunks written after the checkpoint when resuming.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "id TEXT NOT NULL, "
+            "chunk INTEGER NOT NULL, "
+            "block_offset INTEGER NOT NULL, "
+            "in_block_offset INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    def truncate(self, chunks_written: int):
+        self.conn.execute("DELETE FROM records WHERE chunk >= ?", (chunks_written,))
+        self.conn.commit()
+
+    def add_chunk(
+        self,
+        chunk_index: int,
+        record_ids: List,
+        offsets: List[Tuple[int, int]],
+        base_offset: int,
+    ):
+        """
+        Add the records of chunk `chunk_index`, whose lines start at `offsets`
+        relative to `base_offset`, the offset of the chunk in the output.
+        """
+        if len(record_ids) != len(offsets):
+            raise ValueError(
+                f"Chunk {chunk_index} has {len(record_ids)} IDs for "
+                f"{len(offsets)} lines"
+            )
+        self.conn.executemany(
+            "INSERT INTO records (id, chunk, block_offset, in_block_offset) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                (str(record_id), chunk_index, base_offset + block_offset, offset)
+                for record_id, (block_offset, offset) in zip(record_ids, offsets)
+                if record_id is not None
+            ),
+        )
+        self.conn.commit()
+
+    def close(self):
+        """
+        Index the completed records by ID for lookups.
+        """
+        self.conn.execute("CREATE INDEX IF NOT EXISTS records_id ON records (id)")
+        self.conn.commit()
+        self.conn.close()
+
+
+def lookup(
+    output_file_name: str, variation_id: str, index_path: str | None = None
+) -> List[str]:
+    """
+    Returns the output lines of the records with ClinVar ID `variation_id`, in
+    output order, using the index `index_path` (default: `index_file_name`).
+    """
+    index_path = index_path or index_file_name(output_file_name)
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"No index {index_path} for {output_file_name}")
+    conn = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT block_offset, in_block_offset FROM records WHERE id = ? "
+            "ORDER BY block_offset, in_block_offset",
+            (str(variation_id),),
+        ).fetchall()
+    finally:
+        conn.close()
+    lines = []
+    with open(output_file_name, "rb") as f:
+        for block_offset, in_block_offset in rows:
+            f.seek(block_offset)
+            # Reads the block and, if the line continues past it, the next ones
+            with gzip.GzipFile(fileobj=f, mode="rb") as records:
+                records.read(in_block_offset)
+                lines.append(records.readline().decode("utf-8"))
+    return lines
@@ -1,100 +1,336 @@
 import asyncio
+import collections
+import concurrent.futures
 import contextlib
-import gzip
-import importlib.util
+import functools
+import itertools
 import json
 import logging
+import logging.handlers
 import multiprocessing
 import os
 import pathlib
+import posixpath
 import queue
 import sys
-import tempfile
+import threading
+import time
 from functools import partial
-from typing import List
-
-import requests
-from ga4gh.vrs.dataproxy import create_dataproxy
-from ga4gh.vrs.extras.translator import AlleleTranslator, CnvTranslator
-from ga4gh.vrs.models import CopyChange
-
-from clinvar_gk_pilot.cli import parse_args
-from clinvar_gk_pilot.gcs import (
-    _local_file_path_for,
-    already_downloaded,
-    download_to_local_file,
+from typing import Iterable, Iterator, List, Tuple
+
+from clinvar_gk_pilot.cache import NormalizationCache, cache_key
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput
+from clinvar_gk_pilot.cli import parse_args, parse_lookup_args
+from clinvar_gk_pilot.codec import RawJSON, get_codec, is_error_output, is_error_result
+from clinvar_gk_pilot.gzipio import (
+    DEFAULT_COMPRESSLEVEL,
+    INTERMEDIATE_COMPRESSLEVEL,
+    open_gzip,
 )
+from clinvar_gk_pilot.incremental import (
+    process_incremental,
+    run_options_file_name,
+    write_run_options,
+)
+from clinvar_gk_pilot.index import index_file_name, line_offsets, lookup
 from clinvar_gk_pilot.logger import logger
-
-# TODO - implement as separate strategy class for using vrs_python
-#        vs. another for anyvar vs. another for variation_normalizer
-#        Encapsulate translators and data_proxy in strategy class
-seqrepo_dataproxy_url = os.environ.get(
-    "SEQREPO_DATAPROXY_URL", "seqrepo+file:///Users/toneill/dev/seqrepo-2024-02-20/"
+from clinvar_gk_pilot.metrics import (
+    Metrics,
+    observe_record,
+    observe_stage,
+    record_labels,
+    take_observations,
 )
-if not seqrepo_dataproxy_url:
-    raise RuntimeError("'SEQREPO_DATAPROXY_URL' must be defined in the environment.")
-data_proxy = create_dataproxy(seqrepo_dataproxy_url)
-allele_translators = {
-    "36": AlleleTranslator(data_proxy=data_proxy, default_assembly_name="GRCh36"),
-    "37": AlleleTranslator(data_proxy=data_proxy, default_assembly_name="GRCh37"),
-    "38": AlleleTranslator(data_proxy=data_proxy),
-}
-
-cnv_translators = {
-    "36": CnvTranslator(data_proxy=data_proxy, default_assembly_name="GRCh36"),
-    "37": CnvTranslator(data_proxy=data_proxy, default_assembly_name="GRCh37"),
-    "38": CnvTranslator(data_proxy=data_proxy),
-}
+from clinvar_gk_pilot.parquet import parquet_file_name, require_pyarrow
+from clinvar_gk_pilot.refdata import ensure_refdata
+from clinvar_gk_pilot.shards import MANIFEST_SUFFIX, ShardedOutput, read_manifest
+
+# Heavy dependencies (ga4gh.vrs, variation-normalizer, google-cloud-storage) are
+# imported where they are first used, so that importing this module, e.g. in
+# every worker process, stays cheap.
+
+# Downloads of gs:// inputs that are processed while they are still downloading,
+# by local file name (--stream-input)
+_input_downloads = {}
+
+
+# Per-process variation-normalizer QueryHandler (or a stand-in for it, see
+# init_query_handler) and persistent event loop, created by init_query_handler
+query_handler = None
+event_loop = None
+
+# Per-process normalization cache, opened by _get_normalization_cache
+normalization_cache = None
+
+# Seconds a record may take before its background process is replaced
+DEFAULT_TASK_TIMEOUT = 10
+# Number of lines sent to a background process in each task
+DEFAULT_BATCH_SIZE = 100
+# Seconds before the parent's task timeout at which a background process running
+# records concurrently cancels a record, so it can report the timeout itself
+ASYNC_TIMEOUT_MARGIN = 1
+# Seconds to wait for a background process to initialize before giving up
+INIT_TIMEOUT = 600
+# Number of most recently sent records each worker keeps, to log them after a
+# timeout or crash
+DEFAULT_RECORD_LOG_BUFFER = 100
+# Number of lines in each unit of work shared between parallel workers
+DEFAULT_CHUNK_SIZE = 10000
+# Chunks read but not yet written per worker, when streaming without chunk files
+STREAMING_CHUNKS_IN_FLIGHT_PER_WORKER = 2
+# Seconds between checks that the workers, or a background process's parent, are
+# still alive while waiting for them
+LIVENESS_CHECK_SECONDS = 5
 
 
 def process_line(line: str, opts: dict = None) -> str:
     """
     Takes a line of JSON, processes it, and returns the result as a JSON string.
     """
-    clinvar_json = json.loads(line)
+    return run_async_with_persistent_loop(process_line_async(line, opts))
+
+
+async def process_line_async(line: str, opts: dict = None) -> str:
+    """
+    Coroutine version of `process_line`.
+
+    The record is decoded with the codec selected by the "json_codec" option, and
+    encoded with it in the shape selected by the "output_shape" option. Records
+    the time spent decoding, normalizing and encoding the record, and the total
+    time for the record, with `observe_stage` and `observe_record`.
+    """
+    opts = opts or {}
+    codec = get_codec(opts.get("json_codec"))
+    start = time.perf_counter()
+    clinvar_json = codec.loads(line)
+    decoded = time.perf_counter()
+    observe_stage("decode", decoded - start)
     result = None
     # if clinvar_json.get("issue") is None:
     if True:
         cls = clinvar_json["vrs_class"]
         if cls == "Allele":
-            result = allele(clinvar_json, opts or {})
+            result = await allele_async(clinvar_json, opts)
         elif cls == "CopyNumberChange":
-            result = copy_number_change(clinvar_json, opts or {})
+            result = await copy_number_change_async(clinvar_json, opts)
         elif cls == "CopyNumberCount":
-            result = copy_number_count(clinvar_json, opts or {})
-    content = {"in": clinvar_json, "out": result}
-    return json.dumps(content)
+            result = await copy_number_count_async(clinvar_json, opts)
+    normalized = time.perf_counter()
+    observe_stage("normalize", normalized - decoded)
+    output = codec.encode_output(
+        line, clinvar_json, result, opts.get("output_shape", "full")
+    )
+    end = time.perf_counter()
+    observe_stage("encode", end - normalized)
+    outcome = "ok" if result is not None and not is_error_result(result) else "error"
+    observe_record(record_labels(clinvar_json, outcome), end - start)
+    return output
+
+
+def timeout_output(line: str, timeout: float, opts: dict = None) -> str:
+    """
+    Returns the output for the record in `line` when it did not complete in
+    `timeout` seconds.
+    """
+    opts = opts or {}
+    return get_codec(opts.get("json_codec")).encode_output(
+        line,
+        json.loads(line),
+        {"errors": f"Task did not complete in {timeout} seconds."},
+        opts.get("output_shape", "full"),
+    )
+
+
+def process_lines(
+    batch: List[Tuple[int, str]], opts: dict = None
+) -> Iterator[Tuple[int, str]]:
+    """
+    Runs `process_line` on each `(index, line)` pair in `batch`, yielding
+    `(index, result, observations)` as soon as each record has been processed,
+    where `observations` are the metrics observations made since the last result.
+    """
+    for index, line in batch:
+        yield index, process_line(line, opts), take_observations()
+
+
+def process_lines_concurrently(
+    batch: List[Tuple[int, str]],
+    opts: dict,
+    concurrency: int,
+    record_timeout: float,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Runs `process_line_async` on the records of `batch` on this process's persistent
+    event loop, with up to `concurrency` records in flight at once, so that one
+    record's database and network round trips overlap with the others'.
+
+    A record that does not complete in `record_timeout` seconds is cancelled and
+    gets a timeout error as its output. Yields `(index, result, observations)` in
+    batch order, like `process_lines`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process_record(line: str) -> str:
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(
+                    process_line_async(line, opts), record_timeout
+                )
+            except asyncio.TimeoutError:
+                logger.error(
+                    f"Record did not complete in {record_timeout} seconds: {line}"
+                )
+                observe_record(
+                    record_labels(json.loads(line), "timeout"), record_timeout
+                )
+                return timeout_output(line, record_timeout, opts)
+
+    tasks = [event_loop.create_task(process_record(line)) for _, line in batch]
+    for (index, _), task in zip(batch, tasks):
+        yield index, run_async_with_persistent_loop(task), take_observations()
 
 
 def _task_worker(
-    task_queue: multiprocessing.Queue, return_queue: multiprocessing.Queue, init_fn=None
+    task_queue: multiprocessing.Queue,
+    return_queue: multiprocessing.Queue,
+    init_fn=None,
+    exit_fn=None,
 ):
     """
     Worker function that processes tasks from a queue.
+
+    Once any per-process initialization is done, the number of seconds it took
+    is put on `return_queue` to signal that the process is ready. After that,
+    each task returns an iterable of results, and each result is put on
+    `return_queue` individually so the parent can attribute a timeout to the
+    exact task element that did not complete.
     """
     # Run any per-process initialization
+    init_start = time.perf_counter()
     if init_fn:
         init_fn()
+    return_queue.put(time.perf_counter() - init_start)
 
+    parent = multiprocessing.parent_process()
     while True:
-        task = task_queue.get()
+        try:
+            task = task_queue.get(timeout=LIVENESS_CHECK_SECONDS)
+        except queue.Empty:
+            # e.g. the worker was killed for running out of memory
+            if parent is not None and not parent.is_alive():
+                break
+            continue
         if task is None:
             break
-        return_queue.put(task())
+        for result in task():
+            return_queue.put(result)
+
+    # Run any per-process cleanup
+    if exit_fn:
+        exit_fn()
+
+
+@contextlib.contextmanager
+def _startup_step(timings: dict, name: str):
+    """
+    Records the seconds spent in the body of the `with` block as `timings[name]`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
+def _log_startup(description: str, timings: dict):
+    steps = ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in timings.items())
+    logger.info(f"Startup of {description} (pid {os.getpid()}): {steps}")
 
 
 # Define init function to set up QueryHandler and event loop in this process
-def init_query_handler():
-    from variation.query import QueryHandler
+def init_query_handler(report_startup: bool = False, query_handler_factory=None):
+    """
+    Creates this process's QueryHandler and event loop.
 
+    `query_handler_factory` is a picklable callable returning an object to use in
+    place of the variation-normalizer QueryHandler, e.g. a stand-in for benchmarks.
+    """
     global query_handler, event_loop
-    query_handler = QueryHandler()
+    timings = {}
+    if query_handler_factory is None:
+        with _startup_step(timings, "import variation-normalizer"):
+            from variation.query import QueryHandler
+        query_handler_factory = QueryHandler
+    with _startup_step(timings, "create QueryHandler"):
+        query_handler = query_handler_factory()
 
     # Create a persistent event loop for this worker process
     event_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(event_loop)
 
+    if report_startup:
+        _log_startup("QueryHandler", timings)
+
+
+def _get_normalization_cache(opts: dict) -> NormalizationCache | None:
+    """
+    Returns the normalization cache for this process, opening it on first use.
+    Returns None if no cache file was configured in `opts`.
+    """
+    global normalization_cache
+    if not opts.get("normalization_cache"):
+        return None
+    if normalization_cache is None:
+        max_mb = opts.get("normalization_cache_max_mb")
+        normalization_cache = NormalizationCache(
+            opts["normalization_cache"],
+            max_bytes=max_mb * 1024 * 1024 if max_mb else None,
+        )
+    return normalization_cache
+
+
+def close_normalization_cache():
+    """
+    Log the hit/miss statistics of this process's normalization cache and close it.
+    """
+    global normalization_cache
+    if normalization_cache is None:
+        return
+    stats = normalization_cache.stats()
+    logger.info(
+        f"Normalization cache {normalization_cache.path}: "
+        f"{stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['stores']} stored, {stats['evictions']} evicted"
+    )
+    normalization_cache.close()
+    normalization_cache = None
+
+
+def cached_normalization(fn):
+    """
+    Decorator for a normalization coroutine function taking `(clinvar_json, opts)`.
+
+    If a normalization cache is configured, a result already stored for the
+    record's `cache_key` is returned without calling `fn`, and successful
+    results of `fn` are stored for later records and runs.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(clinvar_json: dict, opts: dict) -> dict:
+        cache = _get_normalization_cache(opts)
+        if cache is None:
+            return await fn(clinvar_json, opts)
+        key = cache_key(clinvar_json, opts)
+        result = cache.get(key)
+        if result is not None:
+            return result
+        result = await fn(clinvar_json, opts)
+        if result is not None and not is_error_result(result):
+            cache.put(key, result)
+        return result
+
+    return wrapper
+
 
 def run_async_with_persistent_loop(coro):
     """
@@ -105,15 +341,325 @@ def run_async_with_persistent_loop(coro):
     return event_loop.run_until_complete(coro)
 
 
-def worker(file_name_gz: str, output_file_name: str, opts: dict = None) -> None:
+class _BackgroundProcess:
+    """
+    A `_task_worker` process for `process_line`, with its own task and return queues.
+
+    Each process gets new queues so that results from a terminated process can
+    never be read as results of its replacement.
+    """
+
+    def __init__(self, init_fn):
+        self.task_queue = multiprocessing.Queue()
+        self.return_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_task_worker,
+            args=(
+                self.task_queue,
+                self.return_queue,
+                init_fn,
+                close_normalization_cache,
+            ),
+        )
+        self.process.start()
+        # Set when the process reports that its initialization has finished
+        self.init_seconds = None
+
+    def wait_ready(self, timeout: float) -> float:
+        """
+        Wait for the process to finish initializing, and return the number of
+        seconds spent waiting. Raises `queue.Empty` after `timeout` seconds.
+        """
+        if self.init_seconds is not None:
+            return 0.0
+        wait_start = time.perf_counter()
+        self.init_seconds = self.return_queue.get(timeout=timeout)
+        return time.perf_counter() - wait_start
+
+    def stop(self):
+        self.task_queue.put(None)
+        self.process.join()
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+
+
+# Values of the record_log option of BackgroundProcessor
+RECORD_LOG_MODES = ("none", "errors", "trace")
+
+
+def _record_id(line: str):
+    """
+    Returns the ClinVar ID of the record in `line`, or None if it has none.
+    """
+    try:
+        return json.loads(line).get("id")
+    except (ValueError, AttributeError):
+        return None
+
+
+def _tracks_record_ids(opts: dict) -> bool:
+    """
+    Returns true if the output configured in `opts` needs the ClinVar IDs of the
+    records of each chunk.
+    """
+    return bool(opts.get("shard_lines") or opts.get("index"))
+
+
+def _output_compresslevel(opts: dict) -> int:
     """
-    Takes an input file (a GZIP file of newline delimited), runs `process_line`
-    on each line, and writes the output to a new GZIP file called `output_file_name`.
+    Returns the compression level of the NDJSON output configured in `opts`. With
+    `output_format` "parquet", the NDJSON output is only kept until the Parquet
+    file is complete, so it is compressed at the fastest level.
     """
+    if opts.get("output_format") == "parquet":
+        return INTERMEDIATE_COMPRESSLEVEL
+    return opts.get("compresslevel", DEFAULT_COMPRESSLEVEL)
+
 
-    # Set up file-specific logger
-    log_file_name = f"{file_name_gz}.log"
-    file_logger = logging.getLogger(f"worker_{os.path.basename(file_name_gz)}")
+def _with_record_ids(lines: Iterable[str], record_ids: list) -> Iterator[str]:
+    """
+    Yields `lines`, appending the ClinVar ID of each line to `record_ids`.
+    """
+    for line in lines:
+        record_ids.append(_record_id(line))
+        yield line
+
+
+class BackgroundProcessor:
+    """
+    Runs `process_line` in a background `_task_worker` process.
+
+    Lines are sent to the background process in batches of `batch_size`, and up
+    to `batches_in_flight` batches are outstanding at once so the background
+    process is not left idle while the caller reads input and writes output.
+    Results are returned in input order. If any single record takes longer than
+    `task_timeout` seconds, the background process is terminated and replaced,
+    a timeout error is returned for that record, and the records after it are
+    resent to the new process. The time a background process spends
+    initializing does not count towards the timeout of its first record.
+
+    With `warm_standby`, a second, already initialized background process is kept
+    ready, so that a timed out process is replaced without waiting for a new
+    process to initialize. A new standby is then started in the background.
+
+    With a `concurrency` above 1, the background process runs up to that many
+    records of a batch at once on its event loop, and cancels any record that
+    runs for longer than `task_timeout` minus `ASYNC_TIMEOUT_MARGIN` seconds.
+
+    With `report_startup`, each background process logs how long importing and
+    creating its QueryHandler took.
+
+    Records are logged to `file_logger` as JSON objects with an "event", the
+    record's "index" and its ClinVar "id". With `record_log` "errors", only
+    records with errors or timeouts are logged, with "trace" every record is
+    logged as it is sent, and with "none" no records are logged. The last
+    `record_log_buffer` records whose results came back are kept in memory and
+    logged only after a timeout, or by the caller with `log_recent_records` after
+    a crash. The timeout event itself includes the timed out record.
+    """
+
+    def __init__(
+        self,
+        opts: dict = None,
+        task_timeout: int = DEFAULT_TASK_TIMEOUT,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batches_in_flight: int = 4,
+        file_logger: logging.Logger = None,
+        concurrency: int = 1,
+        warm_standby: bool = False,
+        report_startup: bool = False,
+        record_log: str = "errors",
+        record_log_buffer: int = DEFAULT_RECORD_LOG_BUFFER,
+    ):
+        assert batch_size > 0, "Batch size must be greater than 0"
+        assert record_log in RECORD_LOG_MODES, f"Unknown record log mode {record_log}"
+        assert concurrency > 0, "Concurrency must be greater than 0"
+        self.opts = opts
+        self.task_timeout = task_timeout
+        self.batch_size = batch_size
+        self.batches_in_flight = batches_in_flight
+        self.concurrency = concurrency
+        self.warm_standby = warm_standby
+        self.init_fn = partial(
+            init_query_handler,
+            report_startup=report_startup,
+            query_handler_factory=(opts or {}).get("query_handler_factory"),
+        )
+        self.file_logger = file_logger or logger
+        self.record_log = record_log
+        # (index, line) of the records whose results most recently came back
+        self.recent_records = collections.deque(maxlen=record_log_buffer)
+        self.active = None
+        self.standby = None
+        # Number of background processes replaced after a timeout
+        self.restarts = 0
+        # Total initialization time reported by the background processes used
+        self.init_seconds = 0.0
+        # Time spent waiting for background processes to finish initializing
+        self.init_wait_seconds = 0.0
+        # Observations sent by the background processes with their results,
+        # timeouts, and the restart and initialization counters, for the caller
+        # to report
+        self.metrics = Metrics()
+
+    def start(self):
+        self.active = _BackgroundProcess(self.init_fn)
+        if self.warm_standby:
+            self.standby = _BackgroundProcess(self.init_fn)
+
+    def stop(self):
+        self.active.stop()
+        if self.standby is not None:
+            # The standby never received any tasks
+            self.standby.terminate()
+        message = (
+            f"Background process restarts: {self.restarts}, "
+            f"seconds waiting for initialization: {self.init_wait_seconds:.2f}, "
+            f"seconds of initialization: {self.init_seconds:.2f}"
+        )
+        print(message)
+        self.file_logger.info(message)
+
+    def _log_record(self, level: int, event: str, index: int, line: str, **fields):
+        record_event = {"event": event, "index": index, "id": _record_id(line)}
+        self.file_logger.log(level, json.dumps({**record_event, **fields}))
+
+    def log_recent_records(self):
+        """
+        Log the records whose results most recently came back, to show what a
+        background process was working on before a timeout or crash.
+        """
+        self.file_logger.warning(
+            json.dumps({"event": "recent_records", "count": len(self.recent_records)})
+        )
+        for index, line in self.recent_records:
+            self._log_record(
+                logging.WARNING, "recent_record", index, line, record=line.rstrip("\n")
+            )
+
+    def _restart(self):
+        self.active.terminate()
+        self.restarts += 1
+        self.metrics.count("background_restarts")
+        if self.standby is not None:
+            print("Switching to standby background process")
+            self.active = self.standby
+            self.standby = _BackgroundProcess(self.init_fn)
+        else:
+            print("Restarting background process")
+            self.active = _BackgroundProcess(self.init_fn)
+
+    def _wait_active_ready(self):
+        try:
+            init_wait_seconds = self.active.wait_ready(INIT_TIMEOUT)
+        except queue.Empty as e:
+            raise RuntimeError(
+                f"Background process did not initialize in {INIT_TIMEOUT} seconds"
+            ) from e
+        self.init_wait_seconds += init_wait_seconds
+        self.init_seconds += self.active.init_seconds
+        self.metrics.count("background_init_wait_seconds", init_wait_seconds)
+        self.metrics.count("background_init_seconds", self.active.init_seconds)
+
+    def _send(self, batch: List[Tuple[int, str]]):
+        if self.concurrency > 1:
+            self.active.task_queue.put(
+                partial(
+                    process_lines_concurrently,
+                    batch,
+                    self.opts or {},
+                    self.concurrency,
+                    max(self.task_timeout - ASYNC_TIMEOUT_MARGIN, 1),
+                )
+            )
+        else:
+            self.active.task_queue.put(partial(process_lines, batch, self.opts))
+
+    def _next_result(self, pending: collections.deque) -> str:
+        """
+        Wait for the result of the oldest pending record and remove it from `pending`.
+        """
+        index, line = pending[0]
+        if self.active.init_seconds is None:
+            self._wait_active_ready()
+        try:
+            ret_index, ret, observations = self.active.return_queue.get(
+                timeout=self.task_timeout
+            )
+        except queue.Empty:
+            print(
+                f"Task for line (index: {index}) did not complete in time, "
+                "terminating it."
+            )
+            pending.popleft()
+            if self.record_log != "none":
+                self._log_record(
+                    logging.ERROR,
+                    "timeout",
+                    index,
+                    line,
+                    seconds=self.task_timeout,
+                    record=line.rstrip("\n"),
+                )
+            self.log_recent_records()
+            self.recent_records.append((index, line))
+            self._restart()
+            # Everything after the timed out record was lost with the old process
+            remaining = list(pending)
+            for i in range(0, len(remaining), self.batch_size):
+                self._send(remaining[i : i + self.batch_size])
+            self.metrics.observe_record(
+                record_labels(json.loads(line), "timeout"), self.task_timeout
+            )
+            return timeout_output(line, self.task_timeout, self.opts)
+        if ret_index != index:
+            raise RuntimeError(
+                f"Received result for line {ret_index} while expecting line {index}"
+            )
+        pending.popleft()
+        self.recent_records.append((index, line))
+        self.metrics.add_observations(observations)
+        if self.record_log != "none" and is_error_output(ret):
+            errors = json.loads(ret)["out"]["errors"]
+            self._log_record(logging.ERROR, "error", index, line, errors=errors)
+        return ret
+
+    def process(self, lines: Iterable[str], first_index: int = 0) -> Iterator[str]:
+        """
+        Process `lines` in the background process, yielding the output for each
+        line in the same order as the input. Lines are numbered from `first_index`
+        in log messages.
+        """
+        max_pending = self.batch_size * self.batches_in_flight
+        pending = collections.deque()
+        batch = []
+        for index, line in enumerate(lines, start=first_index):
+            if self.record_log == "trace":
+                self._log_record(
+                    logging.INFO, "record", index, line, record=line.rstrip("\n")
+                )
+            batch.append((index, line))
+            if len(batch) == self.batch_size:
+                self._send(batch)
+                pending.extend(batch)
+                batch = []
+                while len(pending) >= max_pending:
+                    yield self._next_result(pending)
+        if batch:
+            self._send(batch)
+            pending.extend(batch)
+        while pending:
+            yield self._next_result(pending)
+
+
+def _make_file_logger(log_file_name: str) -> logging.Logger:
+    """
+    Returns a logger that writes only to `log_file_name`. Messages are queued and
+    written by a background thread, so logging does not wait for the file.
+    """
+    file_logger = logging.getLogger(f"worker_{os.path.basename(log_file_name)}")
     file_logger.setLevel(logging.INFO)
 
     # Create file handler with the same format as log_conf.json
@@ -123,70 +669,436 @@ def worker(file_name_gz: str, output_file_name: str, opts: dict = None) -> None:
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     file_handler.setFormatter(formatter)
-    file_logger.addHandler(file_handler)
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.listener = logging.handlers.QueueListener(log_queue, file_handler)
+    queue_handler.listener.start()
+    file_logger.addHandler(queue_handler)
     file_logger.propagate = False  # Prevent duplicate logs
+    return file_logger
+
+
+def _close_file_logger(file_logger: logging.Logger):
+    for handler in list(file_logger.handlers):
+        listener = getattr(handler, "listener", None)
+        if listener is not None:
+            # Writes any queued messages before returning
+            listener.stop()
+            for listener_handler in listener.handlers:
+                listener_handler.close()
+        handler.close()
+        file_logger.removeHandler(handler)
+
+
+def _make_background_processor(
+    opts: dict, file_logger: logging.Logger
+) -> BackgroundProcessor:
+    return BackgroundProcessor(
+        opts,
+        task_timeout=opts.get("task_timeout", DEFAULT_TASK_TIMEOUT),
+        batch_size=opts.get("batch_size", DEFAULT_BATCH_SIZE),
+        file_logger=file_logger,
+        concurrency=opts.get("async_concurrency", 1),
+        warm_standby=opts.get("warm_standby", False),
+        report_startup=opts.get("report_startup", False),
+        record_log=opts.get("record_log", "errors"),
+        record_log_buffer=opts.get("record_log_buffer", DEFAULT_RECORD_LOG_BUFFER),
+    )
 
-    with (
-        gzip.open(file_name_gz, "rt", encoding="utf-8") as input_file,
-        gzip.open(output_file_name, "wt", encoding="utf-8") as output_file,
-    ):
-        task_queue = multiprocessing.Queue()
-        return_queue = multiprocessing.Queue()
-        task_timeout = 10
-
-        def make_background_process():
-            p = multiprocessing.Process(
-                target=_task_worker,
-                args=(task_queue, return_queue, init_query_handler),
-            )
-            return p
 
-        print("Making background process _task_worker")
-        background_process = make_background_process()
-        background_process.start()
+def worker(
+    worker_index: int,
+    task_queue: multiprocessing.Queue,
+    done_queue: multiprocessing.Queue,
+    log_file_name: str,
+    opts: dict = None,
+) -> None:
+    """
+    Pulls `(chunk_index, chunk_file_name)` tasks from `task_queue` until it receives
+    None. Each chunk file (a GZIP file of newline delimited JSON) is run through
+    `process_line` in a background process, and the output is written to a new
+    GZIP file called `f"{chunk_file_name}.out"`, compressed at the final output's
+    compression level, and in BGZF blocks if the output is indexed, so that it
+    can be appended to the output as it is. Every output line is terminated by a
+    newline. If an errors file is configured, the output lines with errors are
+    also written to `f"{chunk_file_name}.errors"`.
+
+    Puts `("started", worker_index, chunk_index, None)`,
+    `("metrics", worker_index, chunk_index, metrics_snapshot)` and
+    `("finished", worker_index, chunk_index, {"lines": ..., "errors": ...,
+    "record_ids": ..., "offsets": ...})` on `done_queue` for each chunk, with the
+    numbers of lines written to the output and errors files, the ClinVar IDs of
+    the records if the output is sharded or indexed, and the `line_offsets` of
+    the lines if it is indexed.
+    """
+    opts = opts or {}
+    chunk_size = opts.get("chunk_size", DEFAULT_CHUNK_SIZE)
+    compresslevel = opts.get("compresslevel", DEFAULT_COMPRESSLEVEL)
+    file_logger = _make_file_logger(log_file_name)
+
+    processor = _make_background_processor(opts, file_logger)
+    print(f"Worker {worker_index}: making background process _task_worker")
+    processor.start()
 
-        line_number = -1
-        for line in input_file:
-            line_number += 1
-            file_logger.info(f"Processing line (index: {line_number}): {line}")
-            task_queue.put(partial(process_line, line, opts))
-            try:
-                ret = return_queue.get(timeout=task_timeout)
-            except queue.Empty:
-                print("Task did not complete in time, terminating it.")
-                background_process.terminate()
-                background_process.join()
-                ret = json.dumps(
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            chunk_index, chunk_file_name = task
+            done_queue.put(("started", worker_index, chunk_index, None))
+            line_count = 0
+            error_count = 0
+            record_ids = [] if _tracks_record_ids(opts) else None
+            line_lengths = [] if opts.get("index") else None
+            # Workers already run in parallel, so each compresses on one thread
+            with (
+                open_gzip(chunk_file_name, "rt", encoding="utf-8") as input_file,
+                open_gzip(
+                    f"{chunk_file_name}.out",
+                    "wt",
+                    compresslevel=_output_compresslevel(opts),
+                    threads=1,
+                    encoding="utf-8",
+                    bgzf=line_lengths is not None,
+                ) as output_file,
+                (
+                    open_gzip(
+                        f"{chunk_file_name}.errors",
+                        "wt",
+                        compresslevel=compresslevel,
+                        threads=1,
+                        encoding="utf-8",
+                    )
+                    if opts.get("errors_file")
+                    else contextlib.nullcontext()
+                ) as errors_file,
+            ):
+                output_writer = output_file.buffer
+                if record_ids is not None:
+                    input_file = _with_record_ids(input_file, record_ids)
+                for ret in processor.process(
+                    input_file, first_index=chunk_index * chunk_size
+                ):
+                    write_start = time.perf_counter()
+                    # The output is appended to the final output without being
+                    # read, so each output must be exactly one line
+                    if "\n" in ret:
+                        raise ValueError(
+                            f"Output for line {chunk_index * chunk_size + line_count} "
+                            "contains a newline"
+                        )
+                    output_file.write(ret)
+                    output_file.write("\n")
+                    line_count += 1
+                    if line_lengths is not None:
+                        line_lengths.append(len(ret.encode("utf-8")) + 1)
+                    if errors_file is not None and is_error_output(ret):
+                        errors_file.write(ret)
+                        errors_file.write("\n")
+                        error_count += 1
+                    processor.metrics.observe_stage(
+                        "write", time.perf_counter() - write_start
+                    )
+            done_queue.put(
+                (
+                    "metrics",
+                    worker_index,
+                    chunk_index,
+                    processor.metrics.take_snapshot(),
+                )
+            )
+            done_queue.put(
+                (
+                    "finished",
+                    worker_index,
+                    chunk_index,
                     {
-                        "in": json.loads(line),
-                        "out": {
-                            "errors": f"Task did not complete in {task_timeout} seconds.",
-                        },
-                    }
+                        "lines": line_count,
+                        "errors": error_count,
+                        "record_ids": record_ids,
+                        "offsets": (
+                            line_offsets(line_lengths, output_writer.member_sizes)
+                            if line_lengths is not None
+                            else None
+                        ),
+                    },
                 )
-                print("Restarting background process")
-                background_process = make_background_process()
-                background_process.start()
-            output_file.write(ret)
-            output_file.write("\n")
+            )
+    except BaseException:
+        file_logger.exception(f"Worker {worker_index} failed")
+        processor.log_recent_records()
+        _close_file_logger(file_logger)
+        raise
+
+    processor.stop()
+    _close_file_logger(file_logger)
+
+
+def streaming_worker(
+    worker_index: int,
+    task_queue: multiprocessing.Queue,
+    done_queue: multiprocessing.Queue,
+    log_file_name: str,
+    opts: dict = None,
+) -> None:
+    """
+    Pulls `(chunk_index, lines)` tasks from `task_queue` until it receives None,
+    runs `process_line` on each of the lines in a background process, and puts
+    `("finished", worker_index, chunk_index, (output_lines, record_ids))` on
+    `done_queue`, where `record_ids` are the ClinVar IDs of the lines if the
+    output is sharded or indexed.
+
+    Also puts `("started", worker_index, chunk_index, None)` on `done_queue` when
+    it begins a chunk, and `("metrics", worker_index, chunk_index, metrics_snapshot)`
+    before the chunk's output.
+    """
+    opts = opts or {}
+    chunk_size = opts.get("chunk_size", DEFAULT_CHUNK_SIZE)
+    file_logger = _make_file_logger(log_file_name)
+
+    processor = _make_background_processor(opts, file_logger)
+    print(f"Worker {worker_index}: making background process _task_worker")
+    processor.start()
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            chunk_index, lines = task
+            done_queue.put(("started", worker_index, chunk_index, None))
+            output_lines = list(
+                processor.process(lines, first_index=chunk_index * chunk_size)
+            )
+            record_ids = (
+                list(map(_record_id, lines)) if _tracks_record_ids(opts) else None
+            )
+            done_queue.put(
+                (
+                    "metrics",
+                    worker_index,
+                    chunk_index,
+                    processor.metrics.take_snapshot(),
+                )
+            )
+            done_queue.put(
+                ("finished", worker_index, chunk_index, (output_lines, record_ids))
+            )
+    except BaseException:
+        file_logger.exception(f"Worker {worker_index} failed")
+        processor.log_recent_records()
+        _close_file_logger(file_logger)
+        raise
+
+    processor.stop()
+    _close_file_logger(file_logger)
+
+
+def _finished_chunks_in_order(
+    done_queue: multiprocessing.Queue,
+    workers: List[multiprocessing.Process],
+    producer: concurrent.futures.Future,
+    first_chunk: int = 0,
+    metrics: Metrics = None,
+) -> Iterator[Tuple[int, object]]:
+    """
+    Reads the events that workers put on `done_queue` and yields
+    `(chunk_index, result)` for each finished chunk in chunk index order, holding
+    back any chunk that finishes before the chunks preceding it.
+
+    `producer` is the future for the thread putting chunks on the workers' task
+    queue, starting from chunk `first_chunk`. Its result is the total number of
+    chunks. Metrics snapshots sent by the workers are merged into `metrics`.
+
+    Raises RuntimeError if a worker dies, as its chunk would never finish.
+    """
+    running_chunks = {}  # worker index -> chunk index
+    finished_chunks = {}  # chunk index -> result, for chunks not yet yielded
+    next_chunk = first_chunk
+    while not (producer.done() and next_chunk == producer.result()):
+        try:
+            event, worker_index, chunk_index, result = done_queue.get(
+                timeout=LIVENESS_CHECK_SECONDS
+            )
+        except queue.Empty:
+            if producer.done() and next_chunk == producer.result():
+                break
+            for idx, w in enumerate(workers):
+                if w.is_alive():
+                    continue
+                if idx in running_chunks:
+                    raise RuntimeError(
+                        f"Worker {idx} exited with code {w.exitcode} while "
+                        f"processing chunk {running_chunks[idx]}"
+                    )
+                if w.exitcode != 0:
+                    raise RuntimeError(f"Worker {idx} exited with code {w.exitcode}")
+            if not any(w.is_alive() for w in workers):
+                raise RuntimeError(
+                    "All workers exited before all chunks were processed"
+                )
+            still_running = [
+                f"Worker {idx} (chunk {running_chunk})"
+                for idx, running_chunk in sorted(running_chunks.items())
+            ]
+            print(f"Still running: {', '.join(still_running)}", flush=True)
+            continue
 
-        task_queue.put(None)
-        background_process.join()
+        if event == "started":
+            running_chunks[worker_index] = chunk_index
+            continue
+        if event == "metrics":
+            if metrics is not None:
+                metrics.merge(result)
+            continue
+        running_chunks.pop(worker_index, None)
+        finished_chunks[chunk_index] = result
 
-        # Clean up logger handler
-        file_handler.close()
-        file_logger.removeHandler(file_handler)
+        while next_chunk in finished_chunks:
+            yield next_chunk, finished_chunks.pop(next_chunk)
+            next_chunk += 1
+
+
+@contextlib.contextmanager
+def _open_input(input_file_name: str) -> Iterator:
+    """
+    Opens the GZIP input `input_file_name` for reading text, following its
+    download if it is still being downloaded.
+    """
+    download = _input_downloads.get(input_file_name)
+    if download is None:
+        with open_gzip(input_file_name, "rt", encoding="utf-8") as f:
+            yield f
+    else:
+        with download.open() as raw, open_gzip(raw, "rt", encoding="utf-8") as f:
+            yield f
+
+
+def _make_output(
+    input_file_name: str, output_file_name: str, opts: dict
+) -> CheckpointedOutput:
+    """
+    Returns the checkpointed output for `output_file_name`, which is sharded if
+    `shard_lines` is set in `opts`, indexed if `index` is, and also written to a
+    Parquet file if `output_format` is "parquet" or "both".
+    """
+    output_opts = {
+        "errors_file_name": opts.get("errors_file"),
+        "compresslevel": _output_compresslevel(opts),
+        "errors_compresslevel": opts.get("compresslevel", DEFAULT_COMPRESSLEVEL),
+        "threads": opts.get("gzip_threads"),
+        "json_codec": opts.get("json_codec"),
+        # Also determine the output lines, so a run cannot resume with others
+        "options": {
+            "output_shape": opts.get("output_shape", "full"),
+            "liftover": bool(opts.get("liftover", False)),
+        },
+    }
+    if opts.get("output_format", "ndjson") != "ndjson":
+        output_opts["parquet_file_name"] = parquet_file_name(output_file_name)
+    download = _input_downloads.get(input_file_name)
+    if download is not None:
+        output_opts["input_bytes"] = download.size
+    chunk_size = opts.get("chunk_size", DEFAULT_CHUNK_SIZE)
+    if opts.get("shard_lines"):
+        return ShardedOutput(
+            output_file_name,
+            input_file_name,
+            chunk_size,
+            opts["shard_lines"],
+            **output_opts,
+        )
+    return CheckpointedOutput(
+        output_file_name,
+        input_file_name,
+        chunk_size,
+        index_file_name=(
+            index_file_name(output_file_name) if opts.get("index") else None
+        ),
+        **output_opts,
+    )
+
+
+def _make_upload(output: CheckpointedOutput, opts: dict):
+    """
+    Returns an `OutputUpload` of `output` to the `output` URI in `opts`, or None
+    if the output is not uploaded.
+    """
+    if not opts.get("output"):
+        return None
+    from clinvar_gk_pilot.upload import OutputUpload
+
+    return OutputUpload(output, opts["output"])
+
+
+def _finish_output(output: CheckpointedOutput, upload):
+    """
+    Close `output`, and finish its upload if it is uploaded.
+    """
+    output.close()
+    if upload is not None:
+        upload.finish()
+        print(f"Output uploaded to {upload.result_uri}", flush=True)
+
+
+def _write_chunk(
+    output: CheckpointedOutput,
+    lines: List[str],
+    run_metrics: Metrics,
+    opts: dict,
+    record_ids: list | None = None,
+):
+    """
+    Write a chunk of output lines, recording the time taken in `run_metrics`, and
+    update the Prometheus textfile if one was configured in `opts`.
+    """
+    write_start = time.perf_counter()
+    output.write_chunk(lines, record_ids=record_ids)
+    run_metrics.observe_stage("write_chunk", time.perf_counter() - write_start)
+    _write_metrics(run_metrics, opts)
+
+
+def _write_metrics(run_metrics: Metrics, opts: dict, final: bool = False):
+    """
+    Write `run_metrics` to the Prometheus textfile configured in `opts`, and if
+    this is the `final` call for the run, to the JSON metrics summary file.
+    """
+    if opts.get("prometheus_textfile"):
+        run_metrics.write_prometheus(opts["prometheus_textfile"])
+    if final and opts.get("metrics_file"):
+        run_metrics.write_summary(opts["metrics_file"])
+        logger.info(f"Metrics summary written to {opts['metrics_file']}")
 
 
 def process_as_json_single_thread(
     input_file_name: str, output_file_name: str, opts: dict = None
 ) -> None:
-    with gzip.open(input_file_name, "rt", encoding="utf-8") as f_in:
-        with gzip.open(output_file_name, "wt", encoding="utf-8") as f_out:
-            for line in f_in:
-                f_out.write(process_line(line, opts))
-                f_out.write("\n")
-    print(f"Output written to {output_file_name}")
+    opts = opts or {}
+    chunk_size = opts.get("chunk_size", DEFAULT_CHUNK_SIZE)
+    if query_handler is None:
+        init_query_handler(
+            report_startup=opts.get("report_startup", False),
+            query_handler_factory=opts.get("query_handler_factory"),
+        )
+    output = _make_output(input_file_name, output_file_name, opts)
+    first_chunk = output.open(resume=opts.get("resume", False))
+    upload = _make_upload(output, opts)
+    run_metrics = Metrics()
+    with _open_input(input_file_name) as f_in:
+        for _, lines in iter_line_chunks(f_in, chunk_size, first_chunk):
+            output_lines = [process_line(line, opts) for line in lines]
+            run_metrics.add_observations(take_observations())
+            record_ids = (
+                list(map(_record_id, lines)) if _tracks_record_ids(opts) else None
+            )
+            _write_chunk(output, output_lines, run_metrics, opts, record_ids)
+            if upload is not None:
+                upload.chunk_written()
+    _finish_output(output, upload)
+    _write_metrics(run_metrics, opts, final=True)
+    close_normalization_cache()
+    print(f"Output written to {output.result_file_name}")
 
 
 def process_as_json(
@@ -194,56 +1106,250 @@ def process_as_json(
 ) -> None:
     """
     Process `input_file_name` in parallel and write the results to `output_file_name`.
+
+    The input is split into chunk files of `chunk_size` lines which are put on a
+    shared queue, and each of the `parallelism` workers pulls the next chunk as
+    soon as it finishes its current one. Finished chunks are appended to the
+    output in input order, holding back any chunk that finishes before the
+    chunks preceding it. The workers' compressed chunk outputs are appended as
+    they are, without decompressing and compressing them again.
     """
     assert parallelism > 0, "Parallelism must be greater than 0"
-    part_input_file_names = partition_file_lines_gz(input_file_name, parallelism)
+    opts = opts or {}
+    chunk_size = opts.get("chunk_size", DEFAULT_CHUNK_SIZE)
 
-    part_output_file_names = [f"{ofn}.out" for ofn in part_input_file_names]
-    print(f"Partitioned filenames: {part_output_file_names}")
+    # Opening the output can fail, e.g. when resuming from a mismatched
+    # checkpoint, so it is opened before any workers are started
+    output = _make_output(input_file_name, output_file_name, opts)
+    first_chunk = output.open(resume=opts.get("resume", False))
+    upload = _make_upload(output, opts)
 
+    task_queue = multiprocessing.Queue()
+    done_queue = multiprocessing.Queue()
     workers = []
-    worker_info = []
-    # Start a worker per file name
-    for i, (part_ifn, part_ofn) in enumerate(
-        zip(part_input_file_names, part_output_file_names)
-    ):
-        w = multiprocessing.Process(target=worker, args=(part_ifn, part_ofn, opts))
+    for i in range(parallelism):
+        w = multiprocessing.Process(
+            target=worker,
+            args=(i, task_queue, done_queue, f"{input_file_name}.worker_{i}.log", opts),
+        )
         w.start()
         workers.append(w)
-        worker_info.append((i, w, part_ifn))
 
     print(f"Started {len(workers)} workers", flush=True)
 
-    # Wait for all workers to finish
-    remaining_workers = worker_info.copy()
-    while remaining_workers:
-        for worker_idx, w, part_ifn in remaining_workers.copy():
-            w.join(timeout=5)
-            if not w.is_alive():
-                remaining_workers.remove((worker_idx, w, part_ifn))
+    run_metrics = Metrics()
+    chunk_file_names = {}
+    chunk_line_counts = {}
+
+    def split_input() -> int:
+        chunk_count = first_chunk
+        for chunk_index, chunk_file_name, line_count in iter_chunk_files_gz(
+            input_file_name, chunk_size, first_chunk, threads=opts.get("gzip_threads")
+        ):
+            chunk_file_names[chunk_index] = chunk_file_name
+            chunk_line_counts[chunk_index] = line_count
+            task_queue.put((chunk_index, chunk_file_name))
+            chunk_count += 1
+        for _ in workers:
+            task_queue.put(None)
+        print(f"Split {input_file_name} into {chunk_count} chunks", flush=True)
+        return chunk_count
 
-        if remaining_workers:
-            still_running = [
-                f"Worker {idx} ({part_ifn})" for idx, w, part_ifn in remaining_workers
-            ]
-            print(f"Still running: {', '.join(still_running)}", flush=True)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as splitter_executor:
+            splitter = splitter_executor.submit(split_input)
+
+            for chunk_index, counts in _finished_chunks_in_order(
+                done_queue, workers, splitter, first_chunk, run_metrics
+            ):
+                chunk_file_name = chunk_file_names.pop(chunk_index)
+                line_count = chunk_line_counts.pop(chunk_index)
+                if counts["lines"] != line_count:
+                    raise RuntimeError(
+                        f"Worker wrote {counts['lines']} lines for chunk "
+                        f"{chunk_index} of {line_count} lines"
+                    )
+                # Append the compressed chunk outputs without decompressing them
+                write_start = time.perf_counter()
+                output.append_chunk(
+                    f"{chunk_file_name}.out",
+                    counts["lines"],
+                    errors_chunk_file_name=f"{chunk_file_name}.errors",
+                    error_count=counts["errors"],
+                    record_ids=counts["record_ids"],
+                    offsets=counts["offsets"],
+                )
+                run_metrics.observe_stage(
+                    "write_chunk", time.perf_counter() - write_start
+                )
+                _write_metrics(run_metrics, opts)
+                if upload is not None:
+                    upload.chunk_written()
+                os.remove(chunk_file_name)
+                os.remove(f"{chunk_file_name}.out")
+                if os.path.exists(f"{chunk_file_name}.errors"):
+                    os.remove(f"{chunk_file_name}.errors")
+        _finish_output(output, upload)
+    except BaseException:
+        # Chunks still queued for the workers would otherwise be flushed to them
+        # when this process exits, and never be read
+        task_queue.cancel_join_thread()
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        raise
+
+    for w in workers:
+        w.join()
+
+    _write_metrics(run_metrics, opts, final=True)
+    print(f"Lines written: {output.lines_written}")
+    print(f"Output written to {output.result_file_name}")
+
+
+def process_as_json_streaming(
+    input_file_name: str, output_file_name: str, parallelism: int, opts: dict = None
+) -> None:
+    """
+    Process `input_file_name` in parallel and write the results to `output_file_name`
+    without writing any intermediate files.
+
+    A reader thread puts chunks of `chunk_size` lines on a queue shared by the
+    `parallelism` workers, the workers send the output lines of each chunk back
+    to this process, and chunks are written to the output in input order. At most
+    `STREAMING_CHUNKS_IN_FLIGHT_PER_WORKER * parallelism` chunks are held in memory
+    at once, even when one chunk is much slower than the chunks after it.
+    """
+    assert parallelism > 0, "Parallelism must be greater than 0"
+    opts = opts or {}
+    chunk_size = opts.get("chunk_size", DEFAULT_CHUNK_SIZE)
+    assert chunk_size > 0, "Chunk size must be greater than 0"
+
+    # Opening the output can fail, e.g. when resuming from a mismatched
+    # checkpoint, so it is opened before any workers are started
+    output = _make_output(input_file_name, output_file_name, opts)
+    first_chunk = output.open(resume=opts.get("resume", False))
+    upload = _make_upload(output, opts)
+
+    task_queue = multiprocessing.Queue()
+    done_queue = multiprocessing.Queue()
+    workers = []
+    for i in range(parallelism):
+        w = multiprocessing.Process(
+            target=streaming_worker,
+            args=(i, task_queue, done_queue, f"{input_file_name}.worker_{i}.log", opts),
+        )
+        w.start()
+        workers.append(w)
 
-    with gzip.open(output_file_name, "wt", encoding="utf-8") as f_out:
-        for part_ofn in part_output_file_names:
-            print(f"Writing output from {part_ofn} to {output_file_name}")
-            line_counter = 0
-            with gzip.open(part_ofn, "rt", encoding="utf-8") as f_in:
-                for line in f_in:
-                    f_out.write(line)
-                    if not line.endswith("\n"):
-                        f_out.write("\n")
-                    line_counter += 1
-            print(f"Lines written: {line_counter}")
+    print(f"Started {len(workers)} workers", flush=True)
 
-    print(f"Output written to {output_file_name}")
+    run_metrics = Metrics()
+    chunks_in_flight = threading.BoundedSemaphore(
+        STREAMING_CHUNKS_IN_FLIGHT_PER_WORKER * parallelism
+    )
+    stop_reading = threading.Event()
+
+    def read_input() -> int:
+        chunk_count = first_chunk
+        with _open_input(input_file_name) as f_in:
+            for chunk_index, lines in iter_line_chunks(f_in, chunk_size, first_chunk):
+                while not chunks_in_flight.acquire(timeout=1):
+                    if stop_reading.is_set():
+                        return chunk_count
+                task_queue.put((chunk_index, lines))
+                chunk_count += 1
+        for _ in workers:
+            task_queue.put(None)
+        print(f"Read {chunk_count} chunks from {input_file_name}", flush=True)
+        return chunk_count
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader_executor:
+            reader = reader_executor.submit(read_input)
+            try:
+                for _, (output_lines, record_ids) in _finished_chunks_in_order(
+                    done_queue, workers, reader, first_chunk, run_metrics
+                ):
+                    _write_chunk(output, output_lines, run_metrics, opts, record_ids)
+                    if upload is not None:
+                        upload.chunk_written()
+                    chunks_in_flight.release()
+            finally:
+                stop_reading.set()
+        _finish_output(output, upload)
+    except BaseException:
+        # Chunks still queued for the workers would otherwise be flushed to them
+        # when this process exits, and never be read
+        task_queue.cancel_join_thread()
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        raise
+
+    for w in workers:
+        w.join()
+
+    _write_metrics(run_metrics, opts, final=True)
+    print(f"Lines written: {output.lines_written}")
+    print(f"Output written to {output.result_file_name}")
+
+
+def _set_future_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_future_exception(future: asyncio.Future, exception: BaseException):
+    if not future.done():
+        future.set_exception(exception)
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    """
+    Awaits the blocking call `fn(*args, **kwargs)` made on a new daemon thread,
+    so that the event loop keeps running the other records meanwhile.
+
+    A thread of its own, rather than one of a fixed pool, means that a call that
+    hangs after its record has timed out cannot hold up the calls of later
+    records.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def run():
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            complete = partial(_set_future_exception, future, e)
+        else:
+            complete = partial(_set_future_result, future, result)
+        try:
+            loop.call_soon_threadsafe(complete)
+        except RuntimeError:
+            # The record timed out and its loop was closed while the call hung
+            pass
+
+    threading.Thread(target=run, name="blocking-call", daemon=True).start()
+    return await future
+
+
+def _model_dump(vrs_variant, opts: dict) -> dict:
+    """
+    Returns `vrs_variant` as a dict, or as `RawJSON` if the JSON codec encodes
+    VRS models directly.
+    """
+    start = time.perf_counter()
+    if get_codec(opts.get("json_codec")).raw_models:
+        dumped = RawJSON(vrs_variant.model_dump_json(exclude_none=True))
+    else:
+        dumped = vrs_variant.model_dump(exclude_none=True)
+    observe_stage("model_dump", time.perf_counter() - start)
+    return dumped
 
 
-def allele(clinvar_json: dict, opts: dict) -> dict:
+@cached_normalization
+async def allele_async(clinvar_json: dict, opts: dict) -> dict:
     try:
         assembly_version = clinvar_json.get("assembly_version", "38")
         source = clinvar_json["source"]
@@ -254,23 +1360,27 @@ def allele(clinvar_json: dict, opts: dict) -> dict:
                 raise ValueError(
                     f"Unexpected assembly '{assembly_version}' for SPDI expression {source}"
                 )
-            vrs_variant = query_handler.vrs_python_tlr.translate_from(source, fmt=fmt)
+            translate_from = query_handler.vrs_python_tlr.translate_from
+            if opts.get("async_concurrency", 1) > 1:
+                # The translation is synchronous, and would otherwise block the
+                # records running concurrently with it on the event loop
+                vrs_variant = await _run_blocking(translate_from, source, fmt=fmt)
+            else:
+                vrs_variant = translate_from(source, fmt=fmt)
             if vrs_variant.location.sequence:
                 vrs_variant.location.sequence = None
-            return vrs_variant.model_dump(exclude_none=True)
+            return _model_dump(vrs_variant, opts)
         elif fmt == "hgvs":
             if opts.get("liftover", False):
                 # do /normalize. This also automatically tries to liftover to GRCh38
-                result = run_async_with_persistent_loop(
-                    query_handler.normalize_handler.normalize(
-                        q=source,
-                    )
+                result = await query_handler.normalize_handler.normalize(
+                    q=source,
                 )
                 if result.variation:
                     vrs_variant = result.variation
                     if vrs_variant.location.sequence:
                         vrs_variant.location.sequence = None
-                    return vrs_variant.model_dump(exclude_none=True)
+                    return _model_dump(vrs_variant, opts)
                 else:
                     return {"errors": json.dumps(result.warnings)}
         else:
@@ -281,7 +1391,8 @@ def allele(clinvar_json: dict, opts: dict) -> dict:
         return {"errors": error_msg}
 
 
-def copy_number_change(clinvar_json: dict, opts: dict) -> dict:
+@cached_normalization
+async def copy_number_change_async(clinvar_json: dict, opts: dict) -> dict:
     """
     Create a VRS CopyNumberChange variation using the variation-normalization module.
 
@@ -292,6 +1403,8 @@ def copy_number_change(clinvar_json: dict, opts: dict) -> dict:
         # Extract required parameters from clinvar_json
         hgvs_expr = clinvar_json["source"]
 
+        from ga4gh.vrs.models import CopyChange
+
         # Get baseline_copies by offsetting by one from absolute_copies
         if clinvar_json["variation_type"] in ["Deletion", "copy number loss"]:
             copy_change = CopyChange.LOSS
@@ -300,18 +1413,16 @@ def copy_number_change(clinvar_json: dict, opts: dict) -> dict:
         else:
             return {"errors": f"Unknown variation_type: {clinvar_json}"}
 
-        result = run_async_with_persistent_loop(
-            query_handler.to_copy_number_handler.hgvs_to_copy_number_change(
-                hgvs_expr=hgvs_expr,
-                copy_change=copy_change,
-                do_liftover=opts.get("liftover", False),
-            )
+        result = await query_handler.to_copy_number_handler.hgvs_to_copy_number_change(
+            hgvs_expr=hgvs_expr,
+            copy_change=copy_change,
+            do_liftover=opts.get("liftover", False),
         )
         if result.copy_number_change:
             vrs_variant = result.copy_number_change
             if vrs_variant.location.sequence:
                 vrs_variant.location.sequence = None
-            return vrs_variant.model_dump(exclude_none=True)
+            return _model_dump(vrs_variant, opts)
         else:
             return {"errors": json.dumps(result.warnings)}
 
@@ -321,7 +1432,8 @@ def copy_number_change(clinvar_json: dict, opts: dict) -> dict:
         return {"errors": error_msg}
 
 
-def copy_number_count(clinvar_json: dict, opts: dict) -> dict:
+@cached_normalization
+async def copy_number_count_async(clinvar_json: dict, opts: dict) -> dict:
     """
     Create a VRS CopyNumberCount variation using the variation-normalization service.
 
@@ -341,18 +1453,16 @@ def copy_number_count(clinvar_json: dict, opts: dict) -> dict:
         else:
             return {"errors": f"Unknown variation_type: {clinvar_json}"}
 
-        result = run_async_with_persistent_loop(
-            query_handler.to_copy_number_handler.hgvs_to_copy_number_count(
-                hgvs_expr=hgvs_expr,
-                baseline_copies=baseline_copies,
-                do_liftover=opts.get("liftover", False),
-            )
+        result = await query_handler.to_copy_number_handler.hgvs_to_copy_number_count(
+            hgvs_expr=hgvs_expr,
+            baseline_copies=baseline_copies,
+            do_liftover=opts.get("liftover", False),
         )
         if result.copy_number_count:
             vrs_variant = result.copy_number_count
             if vrs_variant.location.sequence:
                 vrs_variant.location.sequence = None
-            return vrs_variant.model_dump(exclude_none=True)
+            return _model_dump(vrs_variant, opts)
         else:
             return {"errors": json.dumps(result.warnings)}
 
@@ -362,86 +1472,245 @@ def copy_number_count(clinvar_json: dict, opts: dict) -> dict:
         return {"errors": error_msg}
 
 
-def partition_file_lines_gz(local_file_path_gz: str, partitions: int) -> List[str]:
+def iter_line_chunks(
+    f: Iterable[str], chunk_size: int, first_chunk: int = 0
+) -> Iterator[Tuple[int, List[str]]]:
     """
-    Split `local_file_path_gz` into `partitions` roughly equal parts by line count.
-
-    Return a list of `partitions` file names that are a roughly equal
-    number of lines from `local_file_path_gz`.
+    Yields `(chunk_index, lines)` for consecutive chunks of at most `chunk_size`
+    lines of `f`, skipping the lines of the chunks before `first_chunk`.
     """
-    filenames = [f"{local_file_path_gz}.part_{i + 1}" for i in range(partitions)]
+    assert chunk_size > 0, "Chunk size must be greater than 0"
+    lines_iter = iter(f)
+    # Advance past the skipped lines without keeping them
+    collections.deque(itertools.islice(lines_iter, first_chunk * chunk_size), maxlen=0)
+    chunk_index = first_chunk
+    while True:
+        lines = list(itertools.islice(lines_iter, chunk_size))
+        if not lines:
+            break
+        yield chunk_index, lines
+        chunk_index += 1
 
-    # Read the file and write each line to a file, looping through the output files
-    with gzip.open(local_file_path_gz, "rt") as f:
-        # Open output files
-        with contextlib.ExitStack() as stack:
-            files = [
-                stack.enter_context(gzip.open(filename, "wt", encoding="utf-8"))
-                for filename in filenames
-            ]
-            for i, line in enumerate(f):
-                file_idx = i % partitions
-                files[file_idx].write(line)
 
-    return filenames
+def iter_chunk_files_gz(
+    local_file_path_gz: str,
+    chunk_size: int,
+    first_chunk: int = 0,
+    threads: int | None = None,
+) -> Iterator[Tuple[int, str, int]]:
+    """
+    Split `local_file_path_gz` into GZIP files of at most `chunk_size` lines,
+    starting from chunk `first_chunk`, compressed quickly on `threads` threads.
 
+    Yields `(chunk_index, chunk_file_name, line_count)` as soon as each chunk file
+    has been completely written, so chunks can be processed while the rest of the
+    file is still being split.
+    """
+    with _open_input(local_file_path_gz) as f:
+        for chunk_index, lines in iter_line_chunks(f, chunk_size, first_chunk):
+            chunk_file_name = f"{local_file_path_gz}.chunk_{chunk_index}"
+            with open_gzip(
+                chunk_file_name,
+                "wt",
+                compresslevel=INTERMEDIATE_COMPRESSLEVEL,
+                threads=threads,
+                encoding="utf-8",
+            ) as f_out:
+                f_out.writelines(lines)
+            yield chunk_index, chunk_file_name, len(lines)
+
+
+def _local_input_file(filename: str, opts: dict, stream: bool = False) -> str:
+    """
+    Returns the local path of `filename`, downloading it first if it is a
+    `gs://` URI that has not already been downloaded, checked with the
+    `cache_ttl` and `offline` options in `opts`.
 
-def initialize_variation_normalizer_ref_data():
-    """Download and import the variation normalizer reference data script at runtime"""
-    # URL to the script
-    script_url = "https://raw.githubusercontent.com/GenomicMedLab/variation-normalizer-manuscript/a5b4f40e696c3c607e770e48e66efcf03a56336f/analysis/download_cool_seq_tool_files.py"
+    If `stream` is true, the download is started in the background instead, and
+    the input is read as it downloads by `_open_input`.
+    """
+    if filename.startswith("gs://"):
+        from clinvar_gk_pilot.gcs import (
+            SlicedDownload,
+            _local_file_path_for,
+            already_downloaded,
+            download_to_local_file,
+        )
 
-    # Download the script
-    response = requests.get(script_url, timeout=10)
-    response.raise_for_status()
+        if already_downloaded(
+            filename, ttl=opts.get("cache_ttl", 0), offline=opts.get("offline", False)
+        ):
+            return _local_file_path_for(filename)
+        if stream:
+            download = SlicedDownload(filename).start()
+            _input_downloads[download.local_file_name] = download
+            return download.local_file_name
+        return download_to_local_file(filename)
+    return filename
 
-    # Create a temporary file and write the script content
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as temp_file:
-        temp_file.write(response.text)
-        temp_file_path = temp_file.name
 
-    try:
-        # Import the module from the temporary file
-        spec = importlib.util.spec_from_file_location(
-            "download_cool_seq_tool_files", temp_file_path
-        )
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+def _local_previous_output(filename: str, opts: dict) -> str:
+    """
+    Returns the local path of the previous output `filename`, downloading it
+    first with `_local_input_file`, along with the record of its options if one
+    exists and the shards listed in it if it is a manifest, if it is a `gs://`
+    URI.
+    """
+    if not filename.startswith("gs://"):
+        return filename
+    from clinvar_gk_pilot.gcs import parse_blob_uri
+
+    options_uri = run_options_file_name(filename)
+    if parse_blob_uri(options_uri).exists():
+        _local_input_file(options_uri, opts)
+    local_file_name = _local_input_file(filename, opts)
+    if filename.endswith(MANIFEST_SUFFIX):
+        manifest_dir = os.path.dirname(local_file_name)
+        for shard_file_name in read_manifest(local_file_name):
+            shard_path = os.path.relpath(shard_file_name, manifest_dir)
+            _local_input_file(
+                posixpath.join(posixpath.dirname(filename), shard_path), opts
+            )
+    return local_file_name
 
-        # Call the download function
-        module.download_cool_seq_tool_files(is_docker_env=False)
 
-    finally:
-        # Clean up the temporary file
-        os.unlink(temp_file_path)
+def lookup_main(argv: List[str]) -> int:
+    """
+    Print the output records of the ClinVar IDs given in `argv`, read from an
+    indexed output. Returns 1 if any of them are not found.
+    """
+    opts = parse_lookup_args(argv)
+    status = 0
+    for variation_id in opts["ids"]:
+        lines = lookup(opts["output"], variation_id, index_path=opts["index_file"])
+        if not lines:
+            print(f"{variation_id} not found in {opts['output']}", file=sys.stderr)
+            status = 1
+        for line in lines:
+            sys.stdout.write(line)
+    return status
 
 
 def main(argv=sys.argv[1:]):
     """
     Process the --filename argument (expected as 'gs://..../filename.json.gz')
     and returns contents in file 'output-filename.ndjson'
+
+    `lookup` as the first argument runs `lookup_main` with the remaining arguments.
     """
+    if argv[:1] == ["lookup"]:
+        return lookup_main(argv[1:])
     opts = parse_args(argv)
-    filename = opts["filename"]
-    if filename.startswith("gs://"):
-        if not already_downloaded(filename):
-            local_file_name = download_to_local_file(filename)
-        else:
-            local_file_name = _local_file_path_for(filename)
-    else:
-        local_file_name = filename
+    # Fail before downloading anything if the JSON codec or pyarrow is not installed
+    get_codec(opts["json_codec"])
+    if opts["output_format"] != "ndjson":
+        require_pyarrow()
+    startup_timings = {}
+    with _startup_step(startup_timings, "input file"):
+        local_file_name = _local_input_file(
+            opts["filename"], opts, stream=opts["stream_input"]
+        )
 
     outfile = str(pathlib.Path("output") / local_file_name)
     # Make parents
     os.makedirs(os.path.dirname(outfile), exist_ok=True)
 
     # Initialize the variation-normalizer to use specific snapshotted reference data.
-    initialize_variation_normalizer_ref_data()
+    with _startup_step(startup_timings, "reference data"):
+        ensure_refdata(opts["refdata_dir"], seed_path=opts["refdata_seed"])
+    if opts["report_startup"]:
+        _log_startup("main process", startup_timings)
+
+    if opts["normalization_cache"] and opts["normalization_cache_clear"]:
+        cache = NormalizationCache(opts["normalization_cache"])
+        logger.info(f"Clearing normalization cache {opts['normalization_cache']}")
+        cache.clear()
+        cache.close()
+
+    def process_fn(input_file_name: str, output_file_name: str, opts: dict = opts):
+        if opts["parallelism"] == 0:
+            process_as_json_single_thread(input_file_name, output_file_name, opts)
+        elif opts["streaming"]:
+            process_as_json_streaming(
+                input_file_name, output_file_name, opts["parallelism"], opts
+            )
+        else:
+            process_as_json(
+                input_file_name, output_file_name, opts["parallelism"], opts
+            )
 
-    if opts["parallelism"] == 0:
-        process_as_json_single_thread(local_file_name, outfile, opts)
+    if opts["previous_input"] or opts["dedup"]:
+        # The errors file and Parquet file are written from the combined output
+        # instead, and the combined output is uploaded once it is complete
+        pending_opts = {
+            **opts,
+            "errors_file": None,
+            "output": None,
+            "output_format": "ndjson",
+        }
+        process_incremental(
+            local_file_name,
+            outfile,
+            partial(process_fn, opts=pending_opts),
+            previous_input_file_name=(
+                _local_input_file(opts["previous_input"], opts)
+                if opts["previous_input"]
+                else None
+            ),
+            previous_output_file_name=(
+                _local_previous_output(opts["previous_output"], opts)
+                if opts["previous_output"]
+                else None
+            ),
+            dedup=opts["dedup"],
+            output_shape=opts["output_shape"],
+            errors_file_name=opts["errors_file"],
+            compresslevel=_output_compresslevel(opts),
+            errors_compresslevel=opts["compresslevel"],
+            threads=opts["gzip_threads"],
+            json_codec=opts["json_codec"],
+            parquet_file_name=(
+                parquet_file_name(outfile)
+                if opts["output_format"] != "ndjson"
+                else None
+            ),
+            liftover=opts["liftover"],
+        )
+        if opts["output"] and opts["output_format"] != "parquet":
+            from clinvar_gk_pilot.gcs import upload_file
+
+            upload_file(outfile, opts["output"])
+            print(f"Output uploaded to {opts['output']}")
+    elif opts["output_format"] == "parquet":
+        # Only the Parquet file is uploaded, as the NDJSON output is removed
+        process_fn(local_file_name, outfile, opts={**opts, "output": None})
     else:
-        process_as_json(local_file_name, outfile, opts["parallelism"], opts)
+        process_fn(local_file_name, outfile)
+    # The input has been read to the end, so this only waits for its verification
+    download = _input_downloads.pop(local_file_name, None)
+    if download is not None:
+        download.wait()
+
+    if opts["output_format"] != "ndjson":
+        # Written along with the NDJSON output
+        parquet_outfile = parquet_file_name(outfile)
+        print(f"Output written to {parquet_outfile}")
+        if opts["output"]:
+            from clinvar_gk_pilot.gcs import upload_file
+
+            upload_file(parquet_outfile, parquet_file_name(opts["output"]))
+            print(f"Output uploaded to {parquet_file_name(opts['output'])}")
+        if opts["output_format"] == "parquet":
+            os.remove(outfile)
+
+    # Checked by later runs before reusing results of this one
+    write_run_options(outfile, opts)
+    if opts["output"]:
+        from clinvar_gk_pilot.gcs import upload_file
+
+        upload_file(
+            run_options_file_name(outfile), run_options_file_name(opts["output"])
+        )
 
 
 if __name__ == "__main__":
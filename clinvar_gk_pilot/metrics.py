@@ -0,0 +1,293 @@
+import bisect
+import json
+import os
+import time
+from typing import List, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets, besides +Inf
+BUCKET_BOUNDS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# Labels of the per-record latency histograms
+RECORD_LABELS = ("vrs_class", "fmt", "assembly_version", "outcome")
+
+# Help text of the counters kept in a `Metrics`, by name
+COUNTERS = {
+    "background_restarts": "Background processes replaced after a timeout.",
+    "background_init_seconds": "Seconds background processes took to initialize.",
+    "background_init_wait_seconds": (
+        "Seconds spent waiting for background processes to initialize."
+    ),
+}
+
+# Observations made in this process and not yet taken by take_observations.
+# Each is ("record", record_labels, seconds) or ("stage", stage_name, seconds).
+_observations = []
+
+
+def record_labels(clinvar_json: dict, outcome: str) -> Tuple[str, ...]:
+    """
+    Returns the values of `RECORD_LABELS` for a record with the given outcome
+    ("ok", "error" or "timeout").
+    """
+    return (
+        str(clinvar_json.get("vrs_class", "")),
+        str(clinvar_json.get("fmt", "")),
+        str(clinvar_json.get("assembly_version", "")),
+        outcome,
+    )
+
+
+def observe_record(labels: Tuple[str, ...], seconds: float):
+    _observations.append(("record", labels, seconds))
+
+
+def observe_stage(stage: str, seconds: float):
+    _observations.append(("stage", stage, seconds))
+
+
+def take_observations() -> List[tuple]:
+    """
+    Returns the observations made in this process since the last call, so they
+    can be sent to and added to a `Metrics` in another process.
+    """
+    global _observations
+    observations, _observations = _observations, []
+    return observations
+
+
+class Histogram:
+    """
+    Latency histogram with fixed `BUCKET_BOUNDS`, which can be merged across
+    processes.
+    """
+
+    def __init__(self):
+        # The last bucket counts observations above all of BUCKET_BOUNDS
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, snapshot: dict):
+        for i, count in enumerate(snapshot["buckets"]):
+            self.buckets[i] += count
+        self.count += snapshot["count"]
+        self.sum += snapshot["sum"]
+        self.max = max(self.max, snapshot["max"])
+
+    def snapshot(self) -> dict:
+        return {
+            "buckets": list(self.buckets),
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+        }
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns an upper bound of the `q` quantile: the upper bound of the bucket
+        containing it, or the maximum for the last bucket.
+        """
+        if self.count == 0:
+            return 0.0
+        cumulative = 0
+        for i, count in enumerate(self.buckets):
+            cumulative += count
+            if cumulative >= q * self.count:
+                if i == len(BUCKET_BOUNDS):
+                    return self.max
+                return min(BUCKET_BOUNDS[i], self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_seconds": self.sum,
+            "mean_seconds": self.sum / self.count if self.count else 0.0,
+            "p50_seconds": self.quantile(0.5),
+            "p90_seconds": self.quantile(0.9),
+            "p99_seconds": self.quantile(0.99),
+            "max_seconds": self.max,
+            "buckets": [
+                [bound, count]
+                for bound, count in zip(list(BUCKET_BOUNDS) + ["+Inf"], self.buckets)
+            ],
+        }
+
+
+class Metrics:
+    """
+    Per-record latency histograms keyed by `RECORD_LABELS`, per-stage latency
+    histograms keyed by stage name, e.g. "decode", "normalize", "model_dump",
+    "encode" and "write", and the `COUNTERS`.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.stages = {}
+        self.counters = {}
+        self.start_time = time.time()
+
+    def add_observations(self, observations: List[tuple]):
+        for kind, key, seconds in observations:
+            histograms = self.records if kind == "record" else self.stages
+            if key not in histograms:
+                histograms[key] = Histogram()
+            histograms[key].observe(seconds)
+
+    def observe_record(self, labels: Tuple[str, ...], seconds: float):
+        self.add_observations([("record", labels, seconds)])
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.add_observations([("stage", stage, seconds)])
+
+    def count(self, counter: str, amount: float = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def snapshot(self) -> dict:
+        return {
+            "records": [
+                [list(labels), histogram.snapshot()]
+                for labels, histogram in self.records.items()
+            ],
+            "stages": [
+                [stage, histogram.snapshot()]
+                for stage, histogram in self.stages.items()
+            ],
+            "counters": dict(self.counters),
+        }
+
+    def take_snapshot(self) -> dict:
+        """
+        Returns a snapshot of the histograms and counters and resets them, so that
+        snapshots taken periodically can be merged into a `Metrics` in another
+        process.
+        """
+        snapshot = self.snapshot()
+        self.records = {}
+        self.stages = {}
+        self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot: dict):
+        for labels, histogram in snapshot["records"]:
+            self.records.setdefault(tuple(labels), Histogram()).merge(histogram)
+        for stage, histogram in snapshot["stages"]:
+            self.stages.setdefault(stage, Histogram()).merge(histogram)
+        for counter, amount in snapshot["counters"].items():
+            self.count(counter, amount)
+
+    def summary(self) -> dict:
+        return {
+            "start_time": self.start_time,
+            "elapsed_seconds": time.time() - self.start_time,
+            "records": [
+                {**dict(zip(RECORD_LABELS, labels)), **histogram.summary()}
+                for labels, histogram in sorted(self.records.items())
+            ],
+            "stages": [
+                {"stage": stage, **histogram.summary()}
+                for stage, histogram in sorted(self.stages.items())
+            ],
+            "counters": {
+                counter: self.counters.get(counter, 0) for counter in COUNTERS
+            },
+        }
+
+    def write_summary(self, file_name: str):
+        _write_atomically(file_name, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, file_name: str):
+        """
+        Write the histograms in the Prometheus text format, e.g. for the
+        node_exporter textfile collector.
+        """
+        lines = [
+            "# HELP clinvar_gk_record_seconds Seconds to normalize a record.",
+            "# TYPE clinvar_gk_record_seconds histogram",
+        ]
+        for labels, histogram in sorted(self.records.items()):
+            label_text = ",".join(
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(RECORD_LABELS, labels)
+            )
+            lines.extend(
+                _prometheus_histogram(
+                    "clinvar_gk_record_seconds", label_text, histogram
+                )
+            )
+        lines.extend(
+            [
+                "# HELP clinvar_gk_stage_seconds Seconds spent in a processing stage.",
+                "# TYPE clinvar_gk_stage_seconds histogram",
+            ]
+        )
+        for stage, histogram in sorted(self.stages.items()):
+            lines.extend(
+                _prometheus_histogram(
+                    "clinvar_gk_stage_seconds", f'stage="{_escape(stage)}"', histogram
+                )
+            )
+        for counter, help_text in COUNTERS.items():
+            name = f"clinvar_gk_{counter}_total"
+            lines.extend(
+                [
+                    f"# HELP {name} {help_text}",
+                    f"# TYPE {name} counter",
+                    f"{name} {self.counters.get(counter, 0)}",
+                ]
+            )
+        lines.extend(
+            [
+                "# HELP clinvar_gk_start_time_seconds Start time of the run.",
+                "# TYPE clinvar_gk_start_time_seconds gauge",
+                f"clinvar_gk_start_time_seconds {self.start_time}",
+            ]
+        )
+        _write_atomically(file_name, "\n".join(lines) + "\n")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_histogram(name: str, label_text: str, histogram: Histogram):
+    cumulative = 0
+    for bound, count in zip(list(BUCKET_BOUNDS) + ["+Inf"], histogram.buckets):
+        cumulative += count
+        yield f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}'
+    yield f"{name}_sum{{{label_text}}} {histogram.sum}"
+    yield f"{name}_count{{{label_text}}} {histogram.count}"
+
+
+def _write_atomically(file_name: str, content: str):
+    """
+    Replace `file_name` with `content`, so that readers never see a partial file.
+    """
+    tmp_file_name = f"{file_name}.tmp"
+    with open(tmp_file_name, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_file_name, file_name)
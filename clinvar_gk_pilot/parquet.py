@@ -0,0 +1,151 @@
+import json
+import os
+
+from clinvar_gk_pilot.codec import get_codec
+
+# Values of the output_format option
+OUTPUT_FORMATS = ("ndjson", "parquet", "both")
+
+# Rows in each Parquet row group, which are held in memory until written
+DEFAULT_ROW_GROUP_SIZE = 50000
+
+# Columns of the Parquet output and their Arrow types. "out_json" and "in_json"
+# hold the "out" and "in" values of the output record as JSON text.
+PARQUET_COLUMNS = (
+    ("variation_id", "string"),
+    ("vrs_class", "string"),
+    ("vrs_type", "string"),
+    ("vrs_id", "string"),
+    ("location_id", "string"),
+    ("sequence_accession", "string"),
+    ("start", "int64"),
+    ("end", "int64"),
+    ("errors", "string"),
+    ("out_json", "string"),
+    ("in_json", "string"),
+)
+
+
+def require_pyarrow():
+    """
+    Returns the pyarrow module, with a helpful error if it is not installed.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError(
+            "Parquet output requires pyarrow, which can be installed with the "
+            "'parquet' extra: pip install 'clinvar_gk_pilot[parquet]'"
+        ) from e
+    return pyarrow
+
+
+def parquet_file_name(output_file_name: str) -> str:
+    """
+    Returns the name of the Parquet file for the NDJSON output `output_file_name`.
+    """
+    for suffix in (".json.gz", ".ndjson.gz", ".gz"):
+        if output_file_name.endswith(suffix):
+            return output_file_name[: -len(suffix)] + ".parquet"
+    return output_file_name + ".parquet"
+
+
+def _position(value):
+    # Locations of copy number variations can have ranges as start and end,
+    # which are only kept in out_json
+    return value if isinstance(value, int) else None
+
+
+def record_row(line: str, codec=None) -> dict:
+    """
+    Returns the values of `PARQUET_COLUMNS` for the output record `line`, in
+    either output shape.
+    """
+    line = line.rstrip("\n")
+    record = (codec or get_codec()).loads(line)
+    # "out" is the last key of the output record, and "in" the first if present,
+    # so their JSON can be sliced out of the line instead of encoded again
+    out_start = line.rfind('"out": ')
+    out_json = line[out_start + len('"out": ') : -1]
+    clinvar_json = record.get("in")
+    in_json = None
+    if clinvar_json is not None:
+        in_json = line[len('{"in": ') : out_start - len(", ")]
+
+    out = record.get("out") or {}
+    errors = out.get("errors")
+    location = out.get("location") or {}
+    sequence_reference = location.get("sequenceReference") or {}
+    return {
+        "variation_id": (
+            clinvar_json.get("id") if clinvar_json is not None else record.get("id")
+        ),
+        "vrs_class": clinvar_json.get("vrs_class") if clinvar_json else None,
+        "vrs_type": out.get("type"),
+        "vrs_id": out.get("id"),
+        "location_id": location.get("id"),
+        "sequence_accession": sequence_reference.get("refgetAccession"),
+        "start": _position(location.get("start")),
+        "end": _position(location.get("end")),
+        "errors": (
+            errors if errors is None or isinstance(errors, str) else json.dumps(errors)
+        ),
+        "out_json": out_json,
+        "in_json": in_json,
+    }
+
+
+class ParquetOutputWriter:
+    """
+    Writes output records to a Parquet file with `PARQUET_COLUMNS`, a row group
+    of `row_group_size` records at a time, so that memory use stays bounded.
+    """
+
+    def __init__(
+        self,
+        file_name: str,
+        row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+        json_codec: str | None = None,
+    ):
+        pyarrow = require_pyarrow()
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [
+                (name, getattr(pyarrow, type_name)())
+                for name, type_name in PARQUET_COLUMNS
+            ]
+        )
+        self.file_name = file_name
+        self.tmp_file_name = f"{file_name}.tmp"
+        self.writer = pyarrow.parquet.ParquetWriter(
+            self.tmp_file_name, self.schema, compression="zstd"
+        )
+        self.row_group_size = row_group_size
+        self.codec = get_codec(json_codec)
+        self.columns = {name: [] for name, _ in PARQUET_COLUMNS}
+        self.rows_buffered = 0
+        self.rows_written = 0
+
+    def write(self, line: str):
+        for name, value in record_row(line, self.codec).items():
+            self.columns[name].append(value)
+        self.rows_buffered += 1
+        if self.rows_buffered >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        table = self.pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.rows_written += self.rows_buffered
+        self.columns = {name: [] for name, _ in PARQUET_COLUMNS}
+        self.rows_buffered = 0
+
+    def close(self):
+        """
+        Write the remaining records and move the completed file into place.
+        """
+        if self.rows_buffered:
+            self._write_row_group()
+        self.writer.close()
+        os.replace(self.tmp_file_name, self.file_name)
@@ -0,0 +1,232 @@
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import tarfile
+from pathlib import Path
+
+from clinvar_gk_pilot.logger import logger
+
+# Script that downloads the snapshotted cool-seq-tool reference data files used
+# by the variation-normalizer, pinned to a commit
+REFDATA_SCRIPT_URL = "https://raw.githubusercontent.com/GenomicMedLab/variation-normalizer-manuscript/a5b4f40e696c3c607e770e48e66efcf03a56336f/analysis/download_cool_seq_tool_files.py"
+
+# Files kept in the reference data directory by this module
+MANIFEST_FILE_NAME = "clinvar-gk-pilot-refdata.json"
+SCRIPT_FILE_NAME = "clinvar-gk-pilot-download_cool_seq_tool_files.py"
+
+
+def default_refdata_dir() -> str:
+    """
+    Returns the directory that cool-seq-tool reads its data files from, and that
+    the reference data script downloads them to.
+    """
+    return os.environ.get(
+        "WAGS_TAILS_DIR", str(Path.home() / ".local" / "share" / "wags_tails")
+    )
+
+
+def _file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _file_stat(path: Path) -> dict:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _snapshot(refdata_dir: Path) -> dict:
+    """
+    Returns the `_file_stat` of every file under `refdata_dir`, by relative path,
+    other than the files kept there by this module.
+    """
+    snapshot = {}
+    for path in refdata_dir.rglob("*"):
+        if path.is_file() and path.name not in (MANIFEST_FILE_NAME, SCRIPT_FILE_NAME):
+            snapshot[path.relative_to(refdata_dir).as_posix()] = _file_stat(path)
+    return snapshot
+
+
+def load_manifest(refdata_dir: str) -> dict | None:
+    manifest_path = Path(refdata_dir) / MANIFEST_FILE_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_manifest(refdata_dir: str, manifest: dict):
+    manifest_path = Path(refdata_dir) / MANIFEST_FILE_NAME
+    tmp_path = manifest_path.with_name(f"{MANIFEST_FILE_NAME}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def verify_manifest(refdata_dir: str, manifest: dict) -> bool:
+    """
+    Returns true if every file listed in `manifest` exists in `refdata_dir` with
+    its recorded checksum.
+
+    Files whose size and modification time match the manifest are not hashed
+    again. Files with a different modification time but the recorded checksum,
+    e.g. after being copied, get their new modification time recorded.
+    """
+    if manifest.get("script_url") != REFDATA_SCRIPT_URL:
+        logger.info("Reference data manifest was written for a different script")
+        return False
+    updated = False
+    for relpath, entry in manifest["files"].items():
+        path = Path(refdata_dir) / relpath
+        if not path.is_file():
+            logger.info(f"Reference data file {path} is missing")
+            return False
+        stat = _file_stat(path)
+        if stat == {"size": entry["size"], "mtime_ns": entry["mtime_ns"]}:
+            continue
+        if stat["size"] != entry["size"] or _file_sha256(path) != entry["sha256"]:
+            logger.info(f"Reference data file {path} does not match its manifest")
+            return False
+        entry["mtime_ns"] = stat["mtime_ns"]
+        updated = True
+    if updated:
+        _write_manifest(refdata_dir, manifest)
+    return True
+
+
+def seed_refdata(seed_path: str, refdata_dir: str):
+    """
+    Copy reference data files and their manifest into `refdata_dir` from
+    `seed_path`, which is either a directory or a (optionally compressed) tar
+    archive of a reference data directory prepared on another machine.
+    """
+    os.makedirs(refdata_dir, exist_ok=True)
+    logger.info(f"Seeding reference data in {refdata_dir} from {seed_path}")
+    if os.path.isdir(seed_path):
+        shutil.copytree(seed_path, refdata_dir, dirs_exist_ok=True)
+    else:
+        with tarfile.open(seed_path, "r:*") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(refdata_dir, filter="data")
+            else:
+                # Extraction filters were added in Python 3.11.4
+                tar.extractall(refdata_dir, members=_checked_members(tar, refdata_dir))
+
+
+def _checked_members(tar: tarfile.TarFile, refdata_dir: str) -> list:
+    """
+    Returns the members of `tar` after checking, like the "data" extraction
+    filter, that they are regular files and directories that extract inside
+    `refdata_dir`, and clearing their special permission bits.
+    """
+    root = os.path.realpath(refdata_dir)
+    members = tar.getmembers()
+    for member in members:
+        if not (member.isfile() or member.isdir()):
+            raise ValueError(
+                f"{member.name} in {tar.name} is not a regular file or directory"
+            )
+        path = os.path.realpath(os.path.join(root, member.name))
+        if os.path.commonpath([root, path]) != root:
+            raise ValueError(f"{member.name} in {tar.name} is outside {refdata_dir}")
+        member.mode &= 0o755
+    return members
+
+
+def _fetch_script(refdata_dir: str, manifest: dict | None) -> Path:
+    """
+    Returns the path of a local copy of the reference data script, downloading it
+    unless a copy matching the checksum in `manifest` is already cached.
+    """
+    script_path = Path(refdata_dir) / SCRIPT_FILE_NAME
+    if (
+        manifest is not None
+        and manifest.get("script_url") == REFDATA_SCRIPT_URL
+        and script_path.exists()
+        and _file_sha256(script_path) == manifest["script_sha256"]
+    ):
+        return script_path
+
+    import requests
+
+    logger.info(f"Downloading {REFDATA_SCRIPT_URL}")
+    response = requests.get(REFDATA_SCRIPT_URL, timeout=10)
+    response.raise_for_status()
+    with open(script_path, "w", encoding="utf-8") as f:
+        f.write(response.text)
+    return script_path
+
+
+def _run_script(script_path: Path):
+    spec = importlib.util.spec_from_file_location(
+        "download_cool_seq_tool_files", script_path
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.download_cool_seq_tool_files(is_docker_env=False)
+
+
+def ensure_refdata(
+    refdata_dir: str | None = None, seed_path: str | None = None
+) -> dict:
+    """
+    Make sure the variation-normalizer reference data files are present in
+    `refdata_dir` and return its manifest.
+
+    `refdata_dir` is exported as WAGS_TAILS_DIR, so that the script and the
+    variation-normalizer in processes started later use it. If the manifest in
+    `refdata_dir` matches the files, nothing is downloaded or run. Otherwise,
+    `refdata_dir` is first seeded from `seed_path` if given, and if the manifest
+    still does not match, the reference data script is run and every data file in
+    `refdata_dir` after it ran is recorded in a new manifest, with its checksum.
+    """
+    refdata_dir = refdata_dir or default_refdata_dir()
+    os.environ["WAGS_TAILS_DIR"] = str(refdata_dir)
+    manifest = load_manifest(refdata_dir)
+    if manifest is not None and verify_manifest(refdata_dir, manifest):
+        logger.info(f"Using cached reference data in {refdata_dir}")
+        return manifest
+
+    if seed_path:
+        seed_refdata(seed_path, refdata_dir)
+        manifest = load_manifest(refdata_dir)
+        if manifest is not None and verify_manifest(refdata_dir, manifest):
+            return manifest
+        logger.warning(f"Reference data seeded from {seed_path} is not valid")
+
+    os.makedirs(refdata_dir, exist_ok=True)
+    script_path = _fetch_script(refdata_dir, manifest)
+    _run_script(script_path)
+
+    # Including files that were already present, which the script does not fetch
+    # again. Files unchanged since an earlier manifest are not hashed again.
+    previous = manifest["files"] if manifest is not None else {}
+    files = {}
+    for relpath, stat in _snapshot(Path(refdata_dir)).items():
+        entry = previous.get(relpath)
+        if entry is not None and stat == {
+            "size": entry["size"],
+            "mtime_ns": entry["mtime_ns"],
+        }:
+            files[relpath] = entry
+        else:
+            files[relpath] = {
+                **stat,
+                "sha256": _file_sha256(Path(refdata_dir) / relpath),
+            }
+    manifest = {
+        "script_url": REFDATA_SCRIPT_URL,
+        "script_sha256": _file_sha256(script_path),
+        "files": files,
+    }
+    _write_manifest(refdata_dir, manifest)
+    logger.info(
+        f"Recorded {len(files)} reference data files in "
+        f"{Path(refdata_dir) / MANIFEST_FILE_NAME}"
+    )
+    return manifest
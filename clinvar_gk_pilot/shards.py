@@ -0,0 +1,257 @@
+"""
+Output written as a series of GZIP shard files with a manifest, instead of one
+file, so that downstream tools can load the shards in parallel and a single
+shard can be reprocessed on its own.
+
+The shards of the output `vi.json.gz` are called `vi-00000.json.gz`,
+`vi-00001.json.gz`, ..., and its manifest `vi.manifest.json` lists them in input
+order, with their line counts, sizes, SHA-256 checksums, the input lines they
+were produced from and the range of ClinVar IDs in each. The manifest is only
+written once all the shards are complete.
+"""
+
+import hashlib
+import json
+import os
+from typing import Iterable, Iterator
+
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput
+from clinvar_gk_pilot.gzipio import DEFAULT_COMPRESSLEVEL, open_gzip
+from clinvar_gk_pilot.logger import logger
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_VERSION = 1
+
+
+def _split_suffix(output_file_name: str) -> tuple[str, str]:
+    for suffix in (".json.gz", ".ndjson.gz", ".gz"):
+        if output_file_name.endswith(suffix):
+            return output_file_name[: -len(suffix)], suffix
+    return output_file_name, ""
+
+
+def manifest_file_name(output_file_name: str) -> str:
+    """
+    Returns the name of the manifest of the sharded output `output_file_name`.
+    """
+    return _split_suffix(output_file_name)[0] + MANIFEST_SUFFIX
+
+
+def shard_file_name(output_file_name: str, shard_index: int) -> str:
+    """
+    Returns the name of shard `shard_index` of the sharded output `output_file_name`.
+    """
+    stem, suffix = _split_suffix(output_file_name)
+    return f"{stem}-{shard_index:05d}{suffix}"
+
+
+def _id_sort_key(variation_id) -> tuple:
+    # ClinVar variation IDs are numeric strings, which are ordered numerically
+    variation_id = str(variation_id)
+    if variation_id.isdigit():
+        return (0, int(variation_id), variation_id)
+    return (1, 0, variation_id)
+
+
+def key_range(variation_ids: Iterable) -> list | None:
+    """
+    Returns `[smallest, largest]` of the ClinVar IDs `variation_ids`, ignoring
+    None, or None if there are none.
+    """
+    variation_ids = [i for i in variation_ids if i is not None]
+    if not variation_ids:
+        return None
+    return [min(variation_ids, key=_id_sort_key), max(variation_ids, key=_id_sort_key)]
+
+
+def merge_key_ranges(a: list | None, b: list | None) -> list | None:
+    """
+    Returns the key range covering the key ranges `a` and `b`.
+    """
+    return key_range((a or []) + (b or []))
+
+
+def _sha256(file_name: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_name, "rb") as f:
+        while block := f.read(1024 * 1024):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ShardedOutput(CheckpointedOutput):
+    """
+    Like `CheckpointedOutput`, but writes the chunks of the output to shard files
+    of `shard_lines` lines, rounded up to whole chunks, and the manifest of the
+    shards when the output is closed. The errors file is not sharded.
+
+    The completed shards are recorded in the checkpoint, so an interrupted run
+    resumes in the shard it was writing.
+    """
+
+    def __init__(
+        self,
+        output_file_name: str,
+        input_file_name: str,
+        chunk_size: int,
+        shard_lines: int,
+        errors_file_name: str | None = None,
+        compresslevel: int = DEFAULT_COMPRESSLEVEL,
+        threads: int | None = None,
+        input_bytes: int | None = None,
+        parquet_file_name: str | None = None,
+        json_codec: str | None = None,
+        options: dict | None = None,
+        errors_compresslevel: int | None = None,
+    ):
+        super().__init__(
+            output_file_name,
+            input_file_name,
+            chunk_size,
+            errors_file_name=errors_file_name,
+            compresslevel=compresslevel,
+            threads=threads,
+            input_bytes=input_bytes,
+            parquet_file_name=parquet_file_name,
+            json_codec=json_codec,
+            options=options,
+            errors_compresslevel=errors_compresslevel,
+        )
+        self.manifest_file_name = manifest_file_name(output_file_name)
+        self.chunks_per_shard = max(1, -(-shard_lines // chunk_size))
+        # Manifest entries of the completed shards
+        self.shards = []
+        self.shard_key_range = None
+
+    @property
+    def result_file_name(self) -> str:
+        return self.manifest_file_name
+
+    def _file_name(self) -> str:
+        return shard_file_name(self.output_file_name, len(self.shards))
+
+    def _file_lines(self) -> int:
+        return self.lines_written - sum(shard["line_count"] for shard in self.shards)
+
+    def _written_file_names(self) -> list[str]:
+        output_dir = os.path.dirname(self.output_file_name)
+        file_names = [os.path.join(output_dir, shard["path"]) for shard in self.shards]
+        return file_names + [self._file_name()]
+
+    def _restore(self, checkpoint: dict):
+        super()._restore(checkpoint)
+        self.shards = checkpoint["shards"]
+        self.shard_key_range = checkpoint["shard_key_range"]
+        for shard in self.shards:
+            shard_path = os.path.join(
+                os.path.dirname(self.output_file_name), shard["path"]
+            )
+            if os.path.getsize(shard_path) != shard["bytes"]:
+                raise RuntimeError(
+                    f"{shard_path} is not the size recorded in "
+                    f"{self.checkpoint_file_name}"
+                )
+
+    def _checkpoint_state(self) -> dict:
+        return {
+            **super()._checkpoint_state(),
+            "shards": self.shards,
+            "shard_key_range": self.shard_key_range,
+        }
+
+    def open(self, resume: bool = False) -> int:
+        """
+        Like `CheckpointedOutput.open`. When the output is written from the
+        beginning, the shards listed in an existing manifest are removed first.
+        """
+        if os.path.exists(self.manifest_file_name):
+            if not (resume and os.path.exists(self.checkpoint_file_name)):
+                for shard_path in read_manifest(self.manifest_file_name):
+                    if os.path.exists(shard_path):
+                        os.remove(shard_path)
+            os.remove(self.manifest_file_name)
+        return super().open(resume=resume)
+
+    def _chunk_written(self, line_count: int, record_ids: list | None):
+        self.shard_key_range = merge_key_ranges(
+            self.shard_key_range, key_range(record_ids or [])
+        )
+        if self.chunks_written % self.chunks_per_shard == 0:
+            self._finish_shard()
+            self.f = open(self._file_name(), "wb")
+
+    def _finish_shard(self):
+        self.f.close()
+        file_name = self._file_name()
+        line_count = self._file_lines()
+        self.shards.append(
+            {
+                "path": os.path.basename(file_name),
+                "first_line": self.lines_written - line_count,
+                "line_count": line_count,
+                "bytes": self.output_bytes,
+                "sha256": _sha256(file_name),
+                "key_range": self.shard_key_range,
+            }
+        )
+        self.output_bytes = 0
+        self.shard_key_range = None
+
+    def close(self):
+        """
+        Close the completed output, write its manifest and remove its checkpoint.
+        """
+        if self._file_lines():
+            self._finish_shard()
+        else:
+            # The shard opened after the last complete shard is empty
+            self.f.close()
+            os.remove(self._file_name())
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "input": self._input_description(),
+            "line_count": self.lines_written,
+            "shards": self.shards,
+            "errors_file": (
+                os.path.relpath(
+                    self.errors_file_name, os.path.dirname(self.manifest_file_name)
+                )
+                if self.errors_file_name
+                else None
+            ),
+        }
+        tmp_file_name = f"{self.manifest_file_name}.tmp"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_name, self.manifest_file_name)
+        super().close()
+        logger.info(
+            f"Wrote {len(self.shards)} shards listed in {self.manifest_file_name}"
+        )
+
+
+def read_manifest(manifest_file_name: str) -> list[str]:
+    """
+    Returns the paths of the shards listed in the manifest `manifest_file_name`,
+    in input order.
+    """
+    with open(manifest_file_name, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest_dir = os.path.dirname(manifest_file_name)
+    return [os.path.join(manifest_dir, shard["path"]) for shard in manifest["shards"]]
+
+
+def iter_output_lines(file_name: str) -> Iterator[str]:
+    """
+    Yields the lines of the GZIP output `file_name`, or of all the shards listed
+    in it if it is a manifest.
+    """
+    if file_name.endswith(MANIFEST_SUFFIX):
+        file_names = read_manifest(file_name)
+    else:
+        file_names = [file_name]
+    for name in file_names:
+        with open_gzip(name, "rt", encoding="utf-8") as f:
+            yield from f
@@ -0,0 +1,135 @@
+"""
+Upload of the output to GCS while it is being written (--output gs://...), so
+that the upload finishes shortly after the processing instead of starting then.
+
+The output is still written locally, which is what is checkpointed and resumed.
+As the chunks of an unsharded output are written, each `part_size` bytes of it
+are uploaded in the background as a part object `<output>.parts/<index>`, and
+when the output is complete the parts are composed into the output object,
+which is checked against the CRC32C checksum of the local file. A sharded output
+is uploaded a shard at a time as each shard is completed, and its manifest last,
+so that the manifest is only in the bucket once all of its shards are.
+"""
+
+import concurrent.futures
+import os
+
+from clinvar_gk_pilot import gcs
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput
+from clinvar_gk_pilot.index import index_file_name
+from clinvar_gk_pilot.logger import logger
+from clinvar_gk_pilot.shards import ShardedOutput, manifest_file_name, shard_file_name
+
+# Bytes of an unsharded output uploaded in each part
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+# Number of parts or shards uploaded concurrently
+UPLOAD_THREADS = 4
+
+
+class OutputUpload:
+    """
+    Uploads `output` to `output_uri` while it is written. `chunk_written` must be
+    called after each chunk is written to `output`, and `finish` once it has been
+    closed.
+    """
+
+    def __init__(
+        self,
+        output: CheckpointedOutput,
+        output_uri: str,
+        part_size: int = UPLOAD_PART_SIZE,
+        threads: int = UPLOAD_THREADS,
+    ):
+        self.output = output
+        self.output_uri = output_uri
+        self.part_size = part_size
+        self.sharded = isinstance(output, ShardedOutput)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="upload"
+        )
+        self.futures = []
+        self.part_uris = []
+        # Bytes of the unsharded output, or number of shards, submitted for upload
+        self.bytes_submitted = 0
+        self.shards_submitted = 0
+
+    @property
+    def result_uri(self) -> str:
+        """
+        The object to read the completed output from.
+        """
+        if self.sharded:
+            return manifest_file_name(self.output_uri)
+        return self.output_uri
+
+    def _submit(self, file_name: str, blob_uri: str, **kwargs):
+        self.futures.append(
+            self.executor.submit(gcs.upload_file, file_name, blob_uri, **kwargs)
+        )
+
+    def _raise_failed(self):
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _submit_part(self, end: int):
+        part_uri = f"{self.output_uri}.parts/{len(self.part_uris):05d}"
+        self.part_uris.append(part_uri)
+        self._submit(
+            self.output.output_file_name,
+            part_uri,
+            start=self.bytes_submitted,
+            end=end,
+        )
+        self.bytes_submitted = end
+
+    def _submit_shards(self):
+        while self.shards_submitted < len(self.output.shards):
+            self._submit(
+                os.path.join(
+                    os.path.dirname(self.output.output_file_name),
+                    self.output.shards[self.shards_submitted]["path"],
+                ),
+                shard_file_name(self.output_uri, self.shards_submitted),
+            )
+            self.shards_submitted += 1
+
+    def chunk_written(self):
+        """
+        Start uploading what has been completed of the output, and raise the
+        error of any upload that failed.
+        """
+        self._raise_failed()
+        if self.sharded:
+            self._submit_shards()
+        elif self.output.output_bytes - self.bytes_submitted >= self.part_size:
+            self._submit_part(self.output.output_bytes)
+
+    def finish(self):
+        """
+        Upload the rest of the closed output and wait for all the uploads, then
+        compose the parts of an unsharded output, or upload the manifest of a
+        sharded one, and upload the index if there is one.
+        """
+        if self.sharded:
+            self._submit_shards()
+        else:
+            file_bytes = os.path.getsize(self.output.output_file_name)
+            if file_bytes > self.bytes_submitted or not self.part_uris:
+                self._submit_part(file_bytes)
+        if self.output.index_file_name:
+            self._submit(self.output.index_file_name, index_file_name(self.output_uri))
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+        if self.sharded:
+            gcs.upload_file(self.output.manifest_file_name, self.result_uri)
+        else:
+            blob = gcs.compose_blobs(self.part_uris, self.output_uri)
+            gcs.verify_checksum(self.output.output_file_name, blob)
+            # Including any parts left by an earlier run that was interrupted
+            for part_uri in gcs.list_blobs(blob.bucket.name, f"{blob.name}.parts/"):
+                gcs.parse_blob_uri(part_uri).delete()
+        logger.info(f"Uploaded {self.output.result_file_name} to {self.result_uri}")
@@ -1,12 +1,13 @@
 import enum
 import os
 import pathlib
-import gzip
 import csv
 import json
 import sys
 import time
 
+from clinvar_gk_pilot.gzipio import open_gzip
+
 # increase csv field size limit
 csv.field_size_limit(sys.maxsize)
 
@@ -22,14 +23,14 @@ last_logged_output_count_value = 0
 
 output_file_name = "combined-catvar_output.json"
 f0 = pathlib.Path(directory) / file_names[0]
-with gzip.open(output_file_name, "wt", compresslevel=9) as f_out:
+with open_gzip(output_file_name, "wt", compresslevel=9) as f_out:
     f_out.write("{\n")
 
     for file_idx, file_name in enumerate(file_names):
         file_path = pathlib.Path(directory) / file_name
         print(f"Reading {file_path} ({file_idx + 1}/{len(file_names)})...")
         try:
-            with gzip.open(file_path, "rt") as f_in:
+            with open_gzip(file_path, "rt") as f_in:
                 reader = csv.reader(f_in)
                 is_first_row = True
                 for i, row in enumerate(reader):
@@ -1,7 +1,6 @@
 import enum
 import os
 import pathlib
-import gzip
 import csv
 import json
 import sys
@@ -14,6 +13,7 @@ from clinvar_gk_pilot.gcs import (
     download_to_local_file,
     _local_file_path_for,
 )
+from clinvar_gk_pilot.gzipio import open_gzip
 
 
 # increase csv field size limit
@@ -43,11 +43,11 @@ last_logged_output_count_time = time.time()
 last_logged_output_count_value = 0
 
 
-with gzip.open(output_file_name, "wt", compresslevel=9) as f_out:
+with open_gzip(output_file_name, "wt", compresslevel=9) as f_out:
     for file_idx, file_path in enumerate(local_paths):
         print(f"Reading {file_path} ({file_idx + 1}/{len(local_paths)})...")
         try:
-            with gzip.open(file_path, "rt") as f_in:
+            with open_gzip(file_path, "rt") as f_in:
                 for line in f_in:
                     rec = json.loads(line)
                     rec = rec["rec"]
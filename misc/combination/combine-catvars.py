@@ -1,5 +1,6 @@
 """
 This script is for combining newline-delimited JSON files from a Google Cloud Storage bucket into one file and uploading it back to the bucket.
+The files are either those in `folder_path` matching `file_pattern`, or the shards listed in the manifest at `manifest_blob_path` of a sharded output.
 
 The input JSON objects are also parsed and the values from .rec.<id> are used as the final output objects written to the output file.
 
@@ -11,15 +12,19 @@ becomes:
 {"key1": "value1", "key2": "value2"}
 """
 
-import gzip
 import json
 import os
+import posixpath
 import re
+import tempfile
 import time
 from dataclasses import dataclass
 
 from google.cloud import storage
 
+from clinvar_gk_pilot.gzipio import DEFAULT_COMPRESSLEVEL, open_gzip
+from clinvar_gk_pilot.shards import iter_output_lines, read_manifest
+
 
 @dataclass()
 class Env:
@@ -28,6 +33,8 @@ class Env:
     file_pattern: str
     output_file_path: str
     output_blob_path: str
+    compresslevel: int
+    manifest_blob_path: str
 
     def __init__(self):
         self.bucket_name = os.getenv("bucket_name")
@@ -35,6 +42,8 @@ class Env:
         self.file_pattern = os.getenv("file_pattern")
         self.output_file_path = os.getenv("output_file_path")
         self.output_blob_path = os.getenv("output_blob_path")
+        self.compresslevel = int(os.getenv("compresslevel", DEFAULT_COMPRESSLEVEL))
+        self.manifest_blob_path = os.getenv("manifest_blob_path")
 
 
 # def _open(file_path, mode):
@@ -46,8 +55,42 @@ class Env:
 #     return open(file_path, mode)
 
 
+def _blob_lines(blob):
+    with (
+        blob.open("rb") as f_blob,
+        open_gzip(f_blob, "rt", encoding="utf-8") as f_in,
+    ):
+        yield from f_in
+
+
+def _manifest_lines(bucket, manifest_blob_path):
+    """
+    Yields the lines of the shards listed in the manifest of a sharded output at
+    `manifest_blob_path` in `bucket`, in order, after downloading them.
+    """
+    with tempfile.TemporaryDirectory() as local_dir:
+        manifest_file_path = os.path.join(
+            local_dir, os.path.basename(manifest_blob_path)
+        )
+        bucket.blob(manifest_blob_path).download_to_filename(manifest_file_path)
+        for shard_file_path in read_manifest(manifest_file_path):
+            shard_blob_path = posixpath.join(
+                posixpath.dirname(manifest_blob_path),
+                os.path.relpath(shard_file_path, local_dir),
+            )
+            os.makedirs(os.path.dirname(shard_file_path), exist_ok=True)
+            bucket.blob(shard_blob_path).download_to_filename(shard_file_path)
+        yield from iter_output_lines(manifest_file_path)
+
+
 def combine_files(
-    bucket_name, folder_path, file_pattern, output_file_path, output_blob_path=None
+    bucket_name,
+    folder_path,
+    file_pattern,
+    output_file_path,
+    output_blob_path=None,
+    compresslevel=DEFAULT_COMPRESSLEVEL,
+    manifest_blob_path=None,
 ):
     # Initialize Google Cloud Storage client
     client = storage.Client()
@@ -59,63 +102,73 @@ def combine_files(
         print(f"{bucket_name} bucket not found.")
         return
 
-    # List all files in the folder matching the file pattern
-    blobs = bucket.list_blobs(prefix=folder_path)
-
-    if blobs is None:
-        print(f"No blobs found in {folder_path}.")
-        return
-
-    # log the blobs
-    blobs = list(blobs)
-    for blob in blobs:
-        print(f"Blob: {blob.name}")
-
-    files_to_combine = [
-        blob.name
-        for blob in blobs
-        if re.match(file_pattern, os.path.basename(blob.name))
-    ]
-
-    if len(files_to_combine) == 0:
-        print(f"No files found matching pattern {file_pattern} to combine.")
-        return
+    if manifest_blob_path:
+        # The shards of a sharded output, in order, instead of the files in folder_path
+        sources = [(manifest_blob_path, _manifest_lines(bucket, manifest_blob_path))]
+    else:
+        # List all files in the folder matching the file pattern
+        blobs = bucket.list_blobs(prefix=folder_path)
+
+        if blobs is None:
+            print(f"No blobs found in {folder_path}.")
+            return
+
+        # log the blobs
+        blobs = list(blobs)
+        for blob in blobs:
+            print(f"Blob: {blob.name}")
+
+        files_to_combine = [
+            blob.name
+            for blob in blobs
+            if re.match(file_pattern, os.path.basename(blob.name))
+        ]
+
+        if len(files_to_combine) == 0:
+            print(f"No files found matching pattern {file_pattern} to combine.")
+            return
+
+        sources = (
+            (file_name, _blob_lines(bucket.get_blob(file_name)))
+            for file_name in files_to_combine
+        )
 
     # Logging stuff
     output_keys_count = 0
     last_logged_output_count_time = time.time()
     last_logged_output_count_value = 0
 
-    with gzip.open(output_file_path, "wt") as f_out:
+    # Compressed and decompressed on several threads
+    with open_gzip(
+        output_file_path, "wt", compresslevel=compresslevel, encoding="utf-8"
+    ) as f_out:
         # Iterate over each file
-        for file_name in files_to_combine:
+        for file_name, lines in sources:
             print(f"Processing file: {file_name}")
-            blob = bucket.get_blob(file_name)
-            with gzip.open(blob.open("rb"), "rt") as f_in:
-                for i, line in enumerate(f_in):
-                    obj = json.loads(line)
-                    assert len(obj) == 1, (
-                        f"row {i} of file {file_name} had more than 1 key! ({len(obj)} keys) {obj}"
-                    )
-                    obj = obj["rec"]
-                    assert len(obj) == 1, (
-                        f"row {i} of file {file_name} had more than 1 key! ({len(obj)} keys) {obj}"
+            for i, line in enumerate(lines):
+                obj = json.loads(line)
+                assert len(obj) == 1, (
+                    f"row {i} of file {file_name} had more than 1 key! ({len(obj)} keys) {obj}"
+                )
+                obj = obj["rec"]
+                assert len(obj) == 1, (
+                    f"row {i} of file {file_name} had more than 1 key! ({len(obj)} keys) {obj}"
+                )
+                obj = obj[list(obj.keys())[0]]
+
+                f_out.write(json.dumps(obj))
+                f_out.write("\n")
+
+                # Progress logging
+                output_keys_count += 1
+                now = time.time()
+                if now - last_logged_output_count_time > 5:
+                    new_lines = output_keys_count - last_logged_output_count_value
+                    print(
+                        f"Output keys written: {output_keys_count} ({new_lines / 5:.2f} lines/s)"
                     )
-                    obj = obj[list(obj.keys())[0]]
-
-                    f_out.write(json.dumps(obj))
-                    f_out.write("\n")
-
-                    # Progress logging
-                    output_keys_count += 1
-                    now = time.time()
-                    if now - last_logged_output_count_time > 5:
-                        new_lines = output_keys_count - last_logged_output_count_value
-                        print(
-                            f"Output keys written: {output_keys_count} ({new_lines / 5:.2f} lines/s)"
-                        )
-                        last_logged_output_count_value = output_keys_count
-                        last_logged_output_count_time = now
+                    last_logged_output_count_value = output_keys_count
+                    last_logged_output_count_time = now
 
         f_out.write("\n")
 
@@ -137,7 +190,9 @@ if __name__ == "__main__":
         f"folder_path: {env.folder_path}, "
         f"file_pattern: {env.file_pattern}, "
         f"output_file_path: {env.output_file_path}, "
-        f"output_blob_path: {env.output_blob_path}"
+        f"output_blob_path: {env.output_blob_path}, "
+        f"compresslevel: {env.compresslevel}, "
+        f"manifest_blob_path: {env.manifest_blob_path}"
     )
 
     combine_files(
@@ -146,4 +201,6 @@ if __name__ == "__main__":
         file_pattern=env.file_pattern,
         output_file_path=env.output_file_path,
         output_blob_path=env.output_blob_path,
+        compresslevel=env.compresslevel,
+        manifest_blob_path=env.manifest_blob_path,
     )
@@ -2,13 +2,17 @@ import csv
 from dataclasses import dataclass
 import json
 import os
+import posixpath
 import re
-import gzip
 import sys
+import tempfile
 import time
 # from flask import Flask, request, jsonify
 from google.cloud import storage
 
+from clinvar_gk_pilot.gzipio import DEFAULT_COMPRESSLEVEL, open_gzip
+from clinvar_gk_pilot.shards import iter_output_lines, read_manifest
+
 # increase csv field size limit
 csv.field_size_limit(sys.maxsize)
 
@@ -22,6 +26,8 @@ class Env:
     file_pattern: str
     output_file_path: str
     output_blob_path: str
+    compresslevel: int
+    manifest_blob_path: str
 
     def __init__(self):
         self.bucket_name = os.getenv("bucket_name")
@@ -29,6 +35,8 @@ class Env:
         self.file_pattern = os.getenv("file_pattern")
         self.output_file_path = os.getenv("output_file_path")
         self.output_blob_path = os.getenv("output_blob_path")
+        self.compresslevel = int(os.getenv("compresslevel", DEFAULT_COMPRESSLEVEL))
+        self.manifest_blob_path = os.getenv("manifest_blob_path")
 
 
 def _open(file_path, mode):
@@ -36,7 +44,7 @@ def _open(file_path, mode):
         return storage.open(file_path, mode)
 
     if file_path.endswith(".gz"):
-        return gzip.open(file_path, mode)
+        return open_gzip(file_path, mode)
     return open(file_path, mode)
 
 
@@ -58,7 +66,29 @@ class NDJson:
         self.file.close()
 
 
-def combine_files(bucket_name, folder_path, file_pattern, output_file_path, output_blob_path=None):
+def _blob_lines(blob):
+    with blob.open("rb") as f_blob, open_gzip(f_blob, 'rt', encoding="utf-8") as f_in:
+        yield from f_in
+
+
+def _manifest_lines(bucket, manifest_blob_path):
+    """
+    Yields the lines of the shards listed in the manifest of a sharded output at
+    `manifest_blob_path` in `bucket`, in order, after downloading them.
+    """
+    with tempfile.TemporaryDirectory() as local_dir:
+        manifest_file_path = os.path.join(local_dir, os.path.basename(manifest_blob_path))
+        bucket.blob(manifest_blob_path).download_to_filename(manifest_file_path)
+        for shard_file_path in read_manifest(manifest_file_path):
+            shard_blob_path = posixpath.join(posixpath.dirname(manifest_blob_path),
+                                             os.path.relpath(shard_file_path, local_dir))
+            os.makedirs(os.path.dirname(shard_file_path), exist_ok=True)
+            bucket.blob(shard_blob_path).download_to_filename(shard_file_path)
+        yield from iter_output_lines(manifest_file_path)
+
+
+def combine_files(bucket_name, folder_path, file_pattern, output_file_path, output_blob_path=None,
+                  compresslevel=DEFAULT_COMPRESSLEVEL, manifest_blob_path=None):
 
     # Initialize Google Cloud Storage client
     client = storage.Client()
@@ -70,67 +100,73 @@ def combine_files(bucket_name, folder_path, file_pattern, output_file_path, outp
         print(f"{bucket_name} bucket not found.")
         return
 
-    # List all files in the folder matching the file pattern
-    blobs = bucket.list_blobs(prefix=folder_path)
+    if manifest_blob_path:
+        # The shards of a sharded output, in order, instead of the files in folder_path
+        sources = [(manifest_blob_path, _manifest_lines(bucket, manifest_blob_path))]
+    else:
+        # List all files in the folder matching the file pattern
+        blobs = bucket.list_blobs(prefix=folder_path)
 
-    if blobs is None:
-        print(f"No blobs found in {folder_path}.")
-        return
+        if blobs is None:
+            print(f"No blobs found in {folder_path}.")
+            return
 
-    files_to_combine = [blob.name for blob in blobs if re.match(
-        file_pattern, os.path.basename(blob.name))]
+        files_to_combine = [blob.name for blob in blobs if re.match(
+            file_pattern, os.path.basename(blob.name))]
 
-    if len(files_to_combine) == 0:
-        print(f"No files found matching pattern {file_pattern} to combine.")
-        return
+        if len(files_to_combine) == 0:
+            print(f"No files found matching pattern {file_pattern} to combine.")
+            return
+
+        sources = ((file_name, _blob_lines(bucket.get_blob(file_name)))
+                   for file_name in files_to_combine)
 
     # Logging stuff
     output_keys_count = 0
     last_logged_output_count_time = time.time()
     last_logged_output_count_value = 0
 
-    with gzip.open(output_file_path, 'wt') as f_out:
+    # Compressed and decompressed on several threads
+    with open_gzip(output_file_path, 'wt', compresslevel=compresslevel, encoding="utf-8") as f_out:
         f_out.write("{\n")
 
         # Iterate over each file
-        for file_name in files_to_combine:
+        for file_name, lines in sources:
             print(f"Processing file: {file_name}")
-            blob = bucket.get_blob(file_name)
-            with gzip.open(blob.open("rb"), 'rt') as f_in:
-                reader = csv.reader(f_in)
-                is_first_row = True
-                for i, row in enumerate(reader):
-                    assert (
-                        len(row) == 1
-                    ), f"row {i} of file {file_name} had more than 1 column! ({len(row)} columns) {row}"
-                    obj = json.loads(row[0])
-                    assert (
-                        len(obj) == 1
-                    ), f"row {i} of file {file_name} had more than 1 key! ({len(obj)} keys) {obj}"
-
-                    # Write key and value
-                    key, value = list(obj.items())[0]
-                    assert isinstance(
-                        key, str
-                    ), f"key {key} on line {i} of file {file_name} is not a string!"
-
-                    if not is_first_row:
-                        f_out.write(",\n")
-                    f_out.write("    ")
-                    f_out.write(f'"{key}": ')
-                    f_out.write(json.dumps(value))
-                    is_first_row = False
-
-                    # Progress logging
-                    output_keys_count += 1
-                    now = time.time()
-                    if now - last_logged_output_count_time > 5:
-                        new_lines = output_keys_count - last_logged_output_count_value
-                        print(
-                            f"Output keys written: {output_keys_count} ({new_lines/5:.2f} lines/s)"
-                        )
-                        last_logged_output_count_value = output_keys_count
-                        last_logged_output_count_time = now
+            reader = csv.reader(lines)
+            is_first_row = True
+            for i, row in enumerate(reader):
+                assert (
+                    len(row) == 1
+                ), f"row {i} of file {file_name} had more than 1 column! ({len(row)} columns) {row}"
+                obj = json.loads(row[0])
+                assert (
+                    len(obj) == 1
+                ), f"row {i} of file {file_name} had more than 1 key! ({len(obj)} keys) {obj}"
+
+                # Write key and value
+                key, value = list(obj.items())[0]
+                assert isinstance(
+                    key, str
+                ), f"key {key} on line {i} of file {file_name} is not a string!"
+
+                if not is_first_row:
+                    f_out.write(",\n")
+                f_out.write("    ")
+                f_out.write(f'"{key}": ')
+                f_out.write(json.dumps(value))
+                is_first_row = False
+
+                # Progress logging
+                output_keys_count += 1
+                now = time.time()
+                if now - last_logged_output_count_time > 5:
+                    new_lines = output_keys_count - last_logged_output_count_value
+                    print(
+                        f"Output keys written: {output_keys_count} ({new_lines/5:.2f} lines/s)"
+                    )
+                    last_logged_output_count_value = output_keys_count
+                    last_logged_output_count_time = now
 
         f_out.write("\n}\n")
 
@@ -180,12 +216,16 @@ if __name__ == '__main__':
           f"folder_path: {env.folder_path}, "
           f"file_pattern: {env.file_pattern}, "
           f"output_file_path: {env.output_file_path}, "
-          f"output_blob_path: {env.output_blob_path}")
+          f"output_blob_path: {env.output_blob_path}, "
+          f"compresslevel: {env.compresslevel}, "
+          f"manifest_blob_path: {env.manifest_blob_path}")
 
     combine_files(
         bucket_name=env.bucket_name,
         folder_path=env.folder_path,
         file_pattern=env.file_pattern,
         output_file_path=env.output_file_path,
-        output_blob_path=env.output_blob_path
+        output_blob_path=env.output_blob_path,
+        compresslevel=env.compresslevel,
+        manifest_blob_path=env.manifest_blob_path
     )
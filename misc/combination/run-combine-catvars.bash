@@ -18,5 +18,11 @@ export folder_path=2025-03-23/dev/final_out/json
 export file_pattern=".*.json.gz"
 export output_file_path="final_out-combined.ndjson.gz"
 export output_blob_path=2025-03-23/dev/final_out-combined.ndjson.gz
+# or, to combine the shards of a sharded output instead of the files above:
+# export manifest_blob_path=2025-03-23/dev/final_out/vi.manifest.json
 
-python ${script}
+# compression level of the output, 1 (fastest) to 9 (smallest)
+export compresslevel=9
+
+# combine-catvars.py imports the clinvar_gk_pilot package from the repository root
+PYTHONPATH="$(dirname "$(dirname "$(dirname "$script")")")${PYTHONPATH:+:$PYTHONPATH}" python ${script}
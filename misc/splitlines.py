@@ -1,25 +1,26 @@
 import argparse
 import contextlib
-import gzip
 import os
 import shutil
 import sys
 
+from clinvar_gk_pilot.gzipio import open_gzip
+from clinvar_gk_pilot.shards import iter_output_lines
+
 
 def split(input_filename, output_directory, partitions):
-    with gzip.open(input_filename, "rt", encoding="utf-8") as f:
-        filenames = [f"part-{i}.ndjson.gz" for i in range(partitions)]
-        file_paths = [
-            os.path.join(output_directory, filename) for filename in filenames
+    # input_filename can also be the manifest of a sharded output
+    lines = iter_output_lines(input_filename)
+    filenames = [f"part-{i}.ndjson.gz" for i in range(partitions)]
+    file_paths = [os.path.join(output_directory, filename) for filename in filenames]
+    with contextlib.ExitStack() as stack:
+        files = [
+            stack.enter_context(open_gzip(file_path, "wt"))
+            for file_path in file_paths
         ]
-        with contextlib.ExitStack() as stack:
-            files = [
-                stack.enter_context(gzip.open(file_path, "wt"))
-                for file_path in file_paths
-            ]
-            for i, line in enumerate(f):
-                file_idx = i % partitions
-                files[file_idx].write(line)
+        for i, line in enumerate(lines):
+            file_idx = i % partitions
+            files[file_idx].write(line)
 
 
 def main(args=sys.argv[1:]):
@@ -0,0 +1,37 @@
+import json
+import pathlib
+
+from benchmarks.run import main_benchmark
+
+
+def test_main_benchmark(tmp_path, monkeypatch):
+    # Each configuration runs in a new `python -m benchmarks.run` process
+    monkeypatch.chdir(pathlib.Path(__file__).parents[1])
+    output_file_name = tmp_path / "results.json"
+    main_benchmark(
+        [
+            "--records",
+            "200",
+            "--parallelism",
+            "0",
+            "2",
+            "--latency-ms",
+            "2",
+            "--failure-rate",
+            "0.1",
+            "--chunk-size",
+            "50",
+            "--output",
+            str(output_file_name),
+        ]
+    )
+
+    results = json.loads(output_file_name.read_text())
+    assert [result["parallelism"] for result in results] == [0, 2]
+    for result in results:
+        assert result["records"] == 200
+        assert 0 < result["error"] < 200
+        assert result["ok"] + result["error"] == 200
+        # Each stand-in normalization call takes 2 ms
+        assert 0.001 <= result["latency_p50_ms"] / 1000 <= 0.1
+        assert result["latency_p99_ms"] >= result["latency_p50_ms"]
@@ -0,0 +1,45 @@
+from clinvar_gk_pilot.cache import NormalizationCache, cache_key
+
+
+def test_cache_key():
+    record = {
+        "id": "1",
+        "vrs_class": "Allele",
+        "source": "NC_000001.11:100:A:T",
+        "fmt": "spdi",
+        "assembly_version": "38",
+    }
+    other_record = {**record, "id": "2", "name": "different name"}
+    assert cache_key(record, {}) == cache_key(other_record, {})
+    assert cache_key(record, {}) != cache_key(record, {"liftover": True})
+    assert cache_key(record, {}) != cache_key({**record, "source": "x"}, {})
+
+
+def test_normalization_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = NormalizationCache(path)
+    assert cache.get("a") is None
+    cache.put("a", {"id": "ga4gh:VA.a"})
+    assert cache.get("a") == {"id": "ga4gh:VA.a"}
+    assert cache.stats() == {"hits": 1, "misses": 1, "stores": 1, "evictions": 0}
+    cache.close()
+
+    # Results persist across connections
+    cache = NormalizationCache(path)
+    assert cache.get("a") == {"id": "ga4gh:VA.a"}
+    cache.clear()
+    assert cache.get("a") is None
+    cache.close()
+
+
+def test_normalization_cache_eviction(tmp_path):
+    cache = NormalizationCache(str(tmp_path / "cache.sqlite"), max_bytes=1000)
+    for i in range(100):
+        cache.put(f"key{i}", {"id": "x" * 20})
+    cache.evict()
+    assert cache.size_bytes() <= 1000
+    assert cache.stats()["evictions"] > 0
+    # The most recently stored results are kept
+    assert cache.get("key99") is not None
+    assert cache.get("key0") is None
+    cache.close()
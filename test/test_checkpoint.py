@@ -0,0 +1,146 @@
+import gzip
+import os
+
+import pytest
+
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput
+
+
+def test_checkpointed_output_resume(tmp_path):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 4)
+
+    output = CheckpointedOutput(output_file_name, input_file_name, chunk_size=2)
+    assert output.open() == 0
+    output.write_chunk(["a", "b"])
+    # Simulate a run interrupted while writing the second chunk
+    output.f.write(b"partial gzip member")
+    output.f.close()
+
+    output = CheckpointedOutput(output_file_name, input_file_name, chunk_size=2)
+    assert output.open(resume=True) == 1
+    output.write_chunk(["c", "d"])
+    output.close()
+
+    assert not os.path.exists(output.checkpoint_file_name)
+    with gzip.open(output_file_name, "rt") as f:
+        assert f.read() == "a\nb\nc\nd\n"
+
+
+def test_checkpointed_output_resume_mismatch(tmp_path):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 4)
+
+    output = CheckpointedOutput(output_file_name, input_file_name, chunk_size=2)
+    output.open()
+    output.write_chunk(["a", "b"])
+    output.f.close()
+
+    # A different chunk size would resume at the wrong input line
+    output = CheckpointedOutput(output_file_name, input_file_name, chunk_size=3)
+    with pytest.raises(RuntimeError):
+        output.open(resume=True)
+
+
+@pytest.mark.parametrize(
+    "changed_opts",
+    [
+        {"json_codec": "orjson"},
+        {"compresslevel": 1},
+        {"errors_compresslevel": 1},
+        {"options": {"output_shape": "keyed", "liftover": False}},
+        {"options": {"output_shape": "full", "liftover": True}},
+    ],
+)
+def test_checkpointed_output_resume_options_mismatch(tmp_path, changed_opts):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 4)
+    output_opts = {
+        "json_codec": "json",
+        "compresslevel": 9,
+        "options": {"output_shape": "full", "liftover": False},
+    }
+
+    output = CheckpointedOutput(output_file_name, input_file_name, 2, **output_opts)
+    output.open()
+    output.write_chunk(["a", "b"])
+    output.f.close()
+
+    # Lines written with other options would be mixed into the output
+    output = CheckpointedOutput(
+        output_file_name, input_file_name, 2, **{**output_opts, **changed_opts}
+    )
+    with pytest.raises(RuntimeError):
+        output.open(resume=True)
+    output = CheckpointedOutput(output_file_name, input_file_name, 2, **output_opts)
+    assert output.open(resume=True) == 1
+
+
+def test_checkpointed_output_errors_file(tmp_path):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    errors_file_name = str(tmp_path / "errors.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 4)
+    ok = '{"id": "1", "out": {"type": "Allele"}}'
+    error = '{"id": "2", "out": {"errors": "x"}}'
+
+    output = CheckpointedOutput(
+        output_file_name, input_file_name, 2, errors_file_name=errors_file_name
+    )
+    output.open()
+    output.write_chunk([ok, error])
+    # Simulate a run interrupted after writing the errors of the second chunk
+    output.errors_f.write(gzip.compress(f"{error}\n".encode("utf-8")))
+    output.errors_f.close()
+    output.f.close()
+
+    output = CheckpointedOutput(
+        output_file_name, input_file_name, 2, errors_file_name=errors_file_name
+    )
+    assert output.open(resume=True) == 1
+    output.write_chunk([error, ok])
+    output.close()
+
+    with gzip.open(errors_file_name, "rt") as f:
+        assert f.read() == f"{error}\n{error}\n"
+    assert output.errors_written == 2
+
+
+def test_checkpointed_output_append_chunk(tmp_path):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    errors_file_name = str(tmp_path / "errors.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 4)
+    chunk_file_name = str(tmp_path / "chunk.out")
+    errors_chunk_file_name = str(tmp_path / "chunk.errors")
+    with gzip.open(chunk_file_name, "wt") as f:
+        f.write("a\nb\n")
+    with gzip.open(errors_chunk_file_name, "wt") as f:
+        f.write("b\n")
+
+    output = CheckpointedOutput(
+        output_file_name, input_file_name, 2, errors_file_name=errors_file_name
+    )
+    output.open()
+    output.append_chunk(
+        chunk_file_name,
+        2,
+        errors_chunk_file_name=errors_chunk_file_name,
+        error_count=1,
+    )
+    output.write_chunk(["c", "d"])
+    output.close()
+
+    with gzip.open(output_file_name, "rt") as f:
+        assert f.read() == "a\nb\nc\nd\n"
+    with gzip.open(errors_file_name, "rt") as f:
+        assert f.read() == "b\n"
+    assert output.lines_written == 4
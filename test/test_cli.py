@@ -1,4 +1,6 @@
-from clinvar_gk_pilot.cli import parse_args
+import pytest
+
+from clinvar_gk_pilot.cli import parse_args, parse_lookup_args
 
 
 def test_parse_args():
@@ -7,4 +9,63 @@ def test_parse_args():
     assert opts["filename"] == "test.txt"
     assert opts["parallelism"] == 1
     assert opts["liftover"] is False
-    assert len(opts) == 3
+    assert opts["batch_size"] == 100
+    assert opts["chunk_size"] == 10000
+    assert opts["streaming"] is False
+    assert opts["stream_input"] is False
+    assert opts["output"] is None
+    assert opts["cache_ttl"] == 0
+    assert opts["offline"] is False
+    assert opts["normalization_cache"] is None
+    assert opts["normalization_cache_max_mb"] is None
+    assert opts["normalization_cache_clear"] is False
+    assert opts["previous_input"] is None
+    assert opts["previous_output"] is None
+    assert opts["resume"] is False
+    assert opts["dedup"] is False
+    assert opts["async_concurrency"] == 1
+    assert opts["warm_standby"] is False
+    assert opts["report_startup"] is False
+    assert opts["refdata_dir"] is None
+    assert opts["refdata_seed"] is None
+    assert opts["task_timeout"] == 10
+    assert opts["metrics_file"] is None
+    assert opts["prometheus_textfile"] is None
+    assert opts["record_log"] == "errors"
+    assert opts["record_log_buffer"] == 100
+    assert opts["json_codec"] == "json"
+    assert opts["output_shape"] == "full"
+    assert opts["errors_file"] is None
+    assert opts["compresslevel"] == 9
+    assert opts["gzip_threads"] is None
+    assert opts["output_format"] == "ndjson"
+    assert opts["shard_lines"] is None
+    assert opts["index"] is False
+    assert len(opts) == 35
+
+
+def test_parse_args_previous_release():
+    argv = ["--filename", "test.txt", "--previous-input", "prev.txt"]
+    with pytest.raises(SystemExit):
+        parse_args(argv)
+    opts = parse_args(argv + ["--previous-output", "prev-out.txt"])
+    assert opts["previous_input"] == "prev.txt"
+    assert opts["previous_output"] == "prev-out.txt"
+
+
+@pytest.mark.parametrize(
+    "option", ["--batch-size", "--chunk-size", "--task-timeout", "--async-concurrency"]
+)
+@pytest.mark.parametrize("value", ["0", "-1"])
+def test_parse_args_rejects_non_positive_sizes(option, value, capsys):
+    with pytest.raises(SystemExit):
+        parse_args(["--filename", "test.txt", option, value])
+    assert f"{option} must be greater than 0" in capsys.readouterr().err
+    assert parse_args(["--filename", "test.txt", option, "1"])
+
+
+def test_parse_lookup_args():
+    opts = parse_lookup_args(["out.json.gz", "12345", "67890"])
+    assert opts["output"] == "out.json.gz"
+    assert opts["ids"] == ["12345", "67890"]
+    assert opts["index_file"] is None
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from clinvar_gk_pilot.codec import RawJSON, get_codec, is_error_result
+
+
+def test_codecs_encode_same_output():
+    line = '{"id": "1", "source": "NC_000001.11:100:A:T", "name": "caf\\u00e9"}\n'
+    clinvar_json = json.loads(line)
+    result = {"type": "Allele", "digest": "abc", "state": {"sequence": "T"}}
+
+    output = get_codec("json").encode_output(line, clinvar_json, result)
+    assert output == json.dumps({"in": clinvar_json, "out": result})
+
+    pytest.importorskip("orjson")
+    codec = get_codec("orjson")
+    assert codec.loads(line) == clinvar_json
+    output = codec.encode_output(line, clinvar_json, RawJSON(json.dumps(result)))
+    assert output.startswith(f'{{"in": {line.strip()}, "out": ')
+    assert json.loads(output) == {"in": clinvar_json, "out": result}
+    output = codec.encode_output(line, clinvar_json, {"errors": "x"})
+    assert json.loads(output)["out"] == {"errors": "x"}
+
+
+def test_is_error_result():
+    assert is_error_result({"errors": "x"})
+    assert not is_error_result({"type": "Allele"})
+    assert not is_error_result(RawJSON('{"errors_in_name": 1}'))
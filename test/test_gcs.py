@@ -0,0 +1,193 @@
+import base64
+import hashlib
+import http.server
+import json
+import os
+import threading
+import urllib.parse
+
+import pytest
+
+storage = pytest.importorskip("google.cloud.storage")
+google_crc32c = pytest.importorskip("google_crc32c")
+
+from clinvar_gk_pilot import gcs  # noqa: E402
+
+
+class FakeGCSHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the objects of `server.objects` with the metadata and ranged media
+    requests of the GCS JSON API. The first request for each range listed in
+    `server.truncate_ranges` gets half of its bytes.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        download = url.path.startswith("/download")
+        # /storage/v1/b/{bucket}/o/{name}, under /download for media
+        path = url.path.removeprefix("/download")
+        _, _, _, _, bucket, _, name = path.split("/", 6)
+        name = urllib.parse.unquote(name)
+        if (bucket, name) not in self.server.objects:
+            self.send_error(404)
+            return
+        if download:
+            self._send_media(self.server.objects[(bucket, name)])
+        else:
+            self._send_metadata(bucket, name)
+
+    def _send_metadata(self, bucket, name):
+        self.server.metadata_requests += 1
+        data = self.server.objects[(bucket, name)]
+        crc32c = self.server.crc32c.get(name) or base64.b64encode(
+            google_crc32c.Checksum(data).digest()
+        ).decode("ascii")
+        quoted_name = urllib.parse.quote(name, safe="")
+        body = json.dumps(
+            {
+                "kind": "storage#object",
+                "bucket": bucket,
+                "name": name,
+                "generation": str(self.server.generations.get(name, 1)),
+                "size": str(len(data)),
+                "crc32c": crc32c,
+                "md5Hash": base64.b64encode(hashlib.md5(data).digest()).decode(),
+                "mediaLink": (
+                    f"{self.server.url}/download/storage/v1/b/{bucket}/o/"
+                    f"{quoted_name}?generation=1&alt=media"
+                ),
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_media(self, data):
+        byte_range = self.headers.get("Range")
+        with self.server.lock:
+            self.server.ranges.append(byte_range)
+            truncate = byte_range in self.server.truncate_ranges
+            self.server.truncate_ranges.discard(byte_range)
+        start, end = 0, len(data) - 1
+        if byte_range:
+            start, end = map(int, byte_range.removeprefix("bytes=").split("-"))
+        body = data[start : end + 1]
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        if truncate:
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def fake_gcs(monkeypatch, tmp_path):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeGCSHandler)
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    server.objects = {}
+    server.crc32c = {}
+    server.generations = {}
+    server.metadata_requests = 0
+    server.ranges = []
+    server.truncate_ranges = set()
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", server.url)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gcs.time, "sleep", lambda seconds: None)
+    server.client = storage.Client(project="test")
+    monkeypatch.setattr(gcs._get_gcs_client, "client", server.client, raising=False)
+    yield server
+    server.shutdown()
+
+
+def test_download_to_local_file_slices(fake_gcs):
+    data = os.urandom(10000)
+    fake_gcs.objects[("bucket", "dir/vi.json.gz")] = data
+    fake_gcs.truncate_ranges.add("bytes=4096-6143")
+
+    local_file_name = gcs.download_to_local_file(
+        "gs://bucket/dir/vi.json.gz", client=fake_gcs.client, slice_size=2048
+    )
+
+    assert local_file_name == "buckets/bucket/dir/vi.json.gz"
+    with open(local_file_name, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(f"{local_file_name}.download")
+    # The rest of the truncated slice is fetched again, by the client library
+    # resuming the range or by retrying the slice
+    ranges = [
+        tuple(map(int, byte_range.removeprefix("bytes=").split("-")))
+        for byte_range in fake_gcs.ranges
+    ]
+    assert len([1 for start, end in ranges if start <= 6143 and end >= 4096]) > 1
+
+
+def test_download_to_local_file_checksum_mismatch(fake_gcs):
+    fake_gcs.objects[("bucket", "vi.json.gz")] = b"records\n" * 100
+    fake_gcs.crc32c["vi.json.gz"] = base64.b64encode(b"\0\0\0\0").decode()
+
+    with pytest.raises(RuntimeError, match="crc32c"):
+        gcs.download_to_local_file(
+            "gs://bucket/vi.json.gz", client=fake_gcs.client, slice_size=256
+        )
+    assert os.listdir("buckets/bucket") == []
+
+
+def test_sliced_download_open(fake_gcs):
+    data = os.urandom(10000)
+    fake_gcs.objects[("bucket", "vi.json.gz")] = data
+
+    download = gcs.SlicedDownload(
+        "gs://bucket/vi.json.gz", client=fake_gcs.client, slice_size=1000, threads=2
+    ).start()
+    with download.open() as f:
+        assert f.read() == data
+    assert download.wait() == "buckets/bucket/vi.json.gz"
+    assert gcs.file_checksums(download.local_file_name)["md5_hash"] == (
+        base64.b64encode(hashlib.md5(data).digest()).decode()
+    )
+
+
+def test_already_downloaded_cache_metadata(fake_gcs):
+    uri = "gs://bucket/vi.json.gz"
+    fake_gcs.objects[("bucket", "vi.json.gz")] = b"a" * 1000
+    assert not gcs.already_downloaded(uri)
+    local_file_name = gcs.download_to_local_file(uri, client=fake_gcs.client)
+    assert gcs.read_cache_metadata(local_file_name)["size"] == 1000
+
+    requests_before = fake_gcs.metadata_requests
+    assert gcs.already_downloaded(uri, ttl=3600)
+    assert gcs.already_downloaded(uri, offline=True)
+    assert fake_gcs.metadata_requests == requests_before
+    assert gcs.already_downloaded(uri)
+    assert fake_gcs.metadata_requests == requests_before + 1
+
+    # A new generation of the same size is detected by its checksum
+    fake_gcs.objects[("bucket", "vi.json.gz")] = b"b" * 1000
+    fake_gcs.generations["vi.json.gz"] = 2
+    assert not gcs.already_downloaded(uri)
+
+
+def test_already_downloaded_offline_creates_no_client(fake_gcs, monkeypatch):
+    uri = "gs://bucket/vi.json.gz"
+    fake_gcs.objects[("bucket", "vi.json.gz")] = b"a" * 1000
+    gcs.download_to_local_file(uri, client=fake_gcs.client)
+
+    def no_client(*args, **kwargs):
+        raise AssertionError("A storage client was created offline")
+
+    monkeypatch.setattr(gcs._get_gcs_client, "client", None)
+    monkeypatch.setattr(gcs.storage, "Client", no_client)
+    assert gcs.already_downloaded(uri, offline=True)
+    with pytest.raises(RuntimeError, match="--offline"):
+        gcs.already_downloaded("gs://bucket/missing.json.gz", offline=True)
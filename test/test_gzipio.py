@@ -0,0 +1,49 @@
+import gzip
+
+import pytest
+
+from clinvar_gk_pilot.gzipio import (
+    BGZF_BLOCK_SIZE,
+    BGZF_EOF,
+    compress,
+    compress_bgzf,
+    open_gzip,
+)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_open_gzip_round_trip(tmp_path, threads):
+    file_name = str(tmp_path / "lines.json.gz")
+    lines = [f'{{"id": "{i}", "source": "{"A" * (i % 100)}"}}\n' for i in range(20000)]
+    with open_gzip(file_name, "wt", threads=threads, encoding="utf-8") as f:
+        f.writelines(lines)
+
+    with gzip.open(file_name, "rt", encoding="utf-8") as f:
+        assert f.readlines() == lines
+    with open_gzip(file_name, "rt", encoding="utf-8") as f:
+        assert f.readlines() == lines
+
+
+def test_compress_members(tmp_path):
+    data = b"x" * 2500
+    compressed = compress(data, threads=2, block_size=1000)
+    # One member for each block, each starting with the GZIP magic number
+    assert compressed.count(b"\x1f\x8b") == 3
+    assert gzip.decompress(compressed) == data
+
+    truncated_file_name = tmp_path / "truncated.gz"
+    truncated_file_name.write_bytes(compressed[:-4])
+    with pytest.raises(EOFError):
+        with open_gzip(truncated_file_name, "rb") as f:
+            f.read()
+
+
+def test_compress_bgzf():
+    data = bytes(range(256)) * 1000
+    blocks = compress_bgzf(data, threads=2)
+    assert len(blocks) == -(-len(data) // BGZF_BLOCK_SIZE)
+    for block in blocks:
+        # The BC extra subfield holds the block size minus 1
+        assert block[12:14] == b"BC"
+        assert int.from_bytes(block[16:18], "little") == len(block) - 1
+    assert gzip.decompress(b"".join(blocks) + BGZF_EOF) == data
@@ -0,0 +1,171 @@
+import os
+import random
+
+import pytest
+
+from benchmarks.records import make_record
+from clinvar_gk_pilot.codec import get_codec
+from clinvar_gk_pilot.gzipio import open_gzip
+from clinvar_gk_pilot.incremental import process_incremental, write_run_options
+from clinvar_gk_pilot.shards import ShardedOutput
+
+
+def _result(record: dict, failing: set) -> dict:
+    if record["source"] in failing:
+        return {"errors": f"Could not normalize {record['source']}"}
+    return {"id": f"ga4gh:VA.{record['source']}"}
+
+
+def _output_lines(records: list, json_codec: str, failing: set = frozenset()):
+    codec = get_codec(json_codec)
+    return [
+        codec.encode_output(codec.dumps(record), record, _result(record, failing))
+        + "\n"
+        for record in records
+    ]
+
+
+def _write_records(file_name: str, records: list, json_codec: str):
+    codec = get_codec(json_codec)
+    with open_gzip(file_name, "wt", threads=1, encoding="utf-8") as f:
+        f.writelines(codec.dumps(record) + "\n" for record in records)
+
+
+def _read_lines(file_name: str) -> list:
+    with open_gzip(file_name, "rt", encoding="utf-8") as f:
+        return f.readlines()
+
+
+def _stand_in_normalizer(normalized: list, json_codec: str, failing: set = frozenset()):
+    """
+    Returns a `process_fn` that writes a result derived from each record's
+    source, and appends the ID of each record it normalizes to `normalized`.
+    """
+    codec = get_codec(json_codec)
+
+    def process_fn(input_file_name: str, output_file_name: str):
+        with (
+            open_gzip(input_file_name, "rt", encoding="utf-8") as f_in,
+            open_gzip(output_file_name, "wt", threads=1, encoding="utf-8") as f_out,
+        ):
+            for line in f_in:
+                record = codec.loads(line)
+                normalized.append(record["id"])
+                result = _result(record, failing)
+                f_out.write(codec.encode_output(line, record, result) + "\n")
+
+    return process_fn
+
+
+@pytest.mark.parametrize(
+    "json_codec,sharded", [("json", False), ("orjson", False), ("json", True)]
+)
+def test_process_incremental_reuses_previous_results(tmp_path, json_codec, sharded):
+    if json_codec == "orjson":
+        pytest.importorskip("orjson")
+    rng = random.Random(0)
+    unchanged, changed, failed = [make_record(i, "spdi", rng) for i in range(3)]
+    previous_input = str(tmp_path / "previous.json.gz")
+    previous_output = str(tmp_path / "previous-output.json.gz")
+    _write_records(previous_input, [unchanged, changed, failed], json_codec)
+    process_fn = _stand_in_normalizer([], json_codec, failing={failed["source"]})
+    process_fn(previous_input, previous_output)
+    if sharded:
+        # The same output, written as shards of two lines
+        lines = _read_lines(previous_output)
+        output = ShardedOutput(
+            str(tmp_path / "previous-shards.json.gz"), previous_input, 1, 2
+        )
+        output.open()
+        for line in lines:
+            output.write_chunk([line])
+        output.close()
+        previous_output = output.result_file_name
+    write_run_options(previous_output, {})
+
+    records = [
+        unchanged,
+        {**changed, "source": changed["source"] + "A"},
+        failed,
+        make_record(3, "hgvs", rng),
+    ]
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    _write_records(input_file_name, records, json_codec)
+    normalized = []
+    counts = process_incremental(
+        input_file_name,
+        output_file_name,
+        _stand_in_normalizer(normalized, json_codec),
+        previous_input_file_name=previous_input,
+        previous_output_file_name=previous_output,
+        json_codec=json_codec,
+    )
+
+    # The record that failed in the previous release is normalized again
+    assert normalized == ["1", "2", "3"]
+    assert counts == {"reused": 1, "deduplicated": 0, "normalized": 3}
+    assert _read_lines(output_file_name) == _output_lines(records, json_codec)
+    assert not os.path.exists(f"{output_file_name}.previous.sqlite")
+
+
+@pytest.mark.parametrize("write_options", [True, False])
+def test_process_incremental_checks_previous_options(tmp_path, write_options):
+    rng = random.Random(0)
+    records = [make_record(i, "spdi", rng) for i in range(2)]
+    previous_input = str(tmp_path / "previous.json.gz")
+    previous_output = str(tmp_path / "previous-output.json.gz")
+    _write_records(previous_input, records, "json")
+    _stand_in_normalizer([], "json")(previous_input, previous_output)
+    if write_options:
+        write_run_options(previous_output, {"liftover": False})
+
+    output_file_name = str(tmp_path / "out.json.gz")
+    normalized = []
+    counts = process_incremental(
+        previous_input,
+        output_file_name,
+        _stand_in_normalizer(normalized, "json"),
+        previous_input_file_name=previous_input,
+        previous_output_file_name=previous_output,
+        liftover=True,
+    )
+
+    # Produced with different or unknown options, so nothing is reused
+    assert normalized == ["0", "1"]
+    assert counts == {"reused": 0, "deduplicated": 0, "normalized": 2}
+    assert _read_lines(output_file_name) == _output_lines(records, "json")
+
+
+def test_process_incremental_dedup(tmp_path):
+    rng = random.Random(0)
+    first = [make_record(i, kind, rng) for i, kind in enumerate(["spdi", "cnc"])]
+    # Later records with the same normalization input as the first two
+    records = [
+        first[0],
+        first[1],
+        {**first[0], "id": "10"},
+        make_record(2, "hgvs", rng),
+        {**first[1], "id": "11"},
+        {**first[0], "id": "12"},
+    ]
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    errors_file_name = str(tmp_path / "errors.json.gz")
+    _write_records(input_file_name, records, "json")
+    normalized = []
+    failing = {first[1]["source"]}
+    counts = process_incremental(
+        input_file_name,
+        output_file_name,
+        _stand_in_normalizer(normalized, "json", failing=failing),
+        dedup=True,
+        errors_file_name=errors_file_name,
+    )
+
+    assert normalized == ["0", "1", "2"]
+    assert counts == {"reused": 0, "deduplicated": 3, "normalized": 3}
+    # Each record has its own input, in input order
+    expected = _output_lines(records, "json", failing)
+    assert _read_lines(output_file_name) == expected
+    assert _read_lines(errors_file_name) == [expected[1], expected[4]]
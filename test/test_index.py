@@ -0,0 +1,57 @@
+import gzip
+import json
+
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput
+from clinvar_gk_pilot.gzipio import open_gzip
+from clinvar_gk_pilot.index import index_file_name, line_offsets, lookup
+
+
+def test_indexed_output_lookup(tmp_path):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 6)
+    # Long enough lines that records span BGZF blocks
+    lines = [
+        json.dumps({"id": str(i), "out": {"digest": "x" * 40000 * i}}) + "\n"
+        for i in range(6)
+    ]
+
+    output = CheckpointedOutput(
+        output_file_name,
+        input_file_name,
+        2,
+        index_file_name=index_file_name(output_file_name),
+    )
+    output.open()
+    output.write_chunk(lines[0:2], record_ids=["0", "1"])
+    # A worker's chunk file, appended as it is
+    chunk_file_name = str(tmp_path / "chunk.out")
+    with open_gzip(chunk_file_name, "wt", threads=1, bgzf=True) as f:
+        f.writelines(lines[2:4])
+        member_sizes = f.buffer.member_sizes
+    output.append_chunk(
+        chunk_file_name,
+        2,
+        record_ids=["2", "3"],
+        offsets=line_offsets(map(len, lines[2:4]), member_sizes),
+    )
+    # Simulate a run interrupted after indexing the third chunk
+    output.index.add_chunk(2, ["4"], [(0, 0)], base_offset=output.output_bytes)
+    output.f.close()
+
+    output = CheckpointedOutput(
+        output_file_name,
+        input_file_name,
+        2,
+        index_file_name=index_file_name(output_file_name),
+    )
+    assert output.open(resume=True) == 2
+    output.write_chunk(lines[4:6], record_ids=["4", "5"])
+    output.close()
+
+    with gzip.open(output_file_name, "rt") as f:
+        assert f.readlines() == lines
+    for i, line in enumerate(lines):
+        assert lookup(output_file_name, str(i)) == [line]
+    assert lookup(output_file_name, "6") == []
@@ -0,0 +1,318 @@
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.records import make_record
+from benchmarks.stub import make_stub_query_handler
+from clinvar_gk_pilot import main
+from clinvar_gk_pilot.main import iter_line_chunks
+from clinvar_gk_pilot.metrics import Metrics
+
+
+def test_import_does_not_load_heavy_dependencies():
+    code = (
+        "import sys\n"
+        "import clinvar_gk_pilot.main\n"
+        "heavy = ['google.cloud.storage', 'ga4gh.vrs', 'variation.query', 'requests']\n"
+        "print(sorted(m for m in heavy if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_iter_line_chunks():
+    lines = [f"{i}\n" for i in range(5)]
+    assert list(iter_line_chunks(lines, 2)) == [
+        (0, ["0\n", "1\n"]),
+        (1, ["2\n", "3\n"]),
+        (2, ["4\n"]),
+    ]
+    assert list(iter_line_chunks(lines, 2, first_chunk=2)) == [(2, ["4\n"])]
+
+
+@pytest.mark.parametrize(
+    "output_format,output_compresslevel", [("ndjson", 6), ("both", 6), ("parquet", 1)]
+)
+def test_make_output_keeps_the_errors_file_at_compresslevel(
+    output_format, output_compresslevel
+):
+    opts = {
+        "errors_file": "errors.json.gz",
+        "compresslevel": 6,
+        "output_format": output_format,
+    }
+    output = main._make_output("in.json.gz", "out.json.gz", opts)
+
+    # Only an NDJSON output removed after the Parquet file is complete is
+    # compressed at the fastest level
+    assert output.compresslevel == output_compresslevel
+    assert output.errors_compresslevel == 6
+
+
+def test_process_lines_concurrently_times_out_only_hanging_records(monkeypatch):
+    stub = make_stub_query_handler(hang_rate=0.1, hang_seconds=3)
+    event_loop = asyncio.new_event_loop()
+    monkeypatch.setattr(main, "query_handler", stub)
+    monkeypatch.setattr(main, "event_loop", event_loop)
+    rng = random.Random(0)
+    records = [make_record(i, "spdi", rng) for i in range(60)]
+    hanging = {
+        record["id"]
+        for record in records
+        if stub._delay(record["source"]) == stub.hang_seconds
+    }
+    assert hanging
+
+    batch = [(i, json.dumps(record)) for i, record in enumerate(records)]
+    results = list(
+        main.process_lines_concurrently(batch, {"async_concurrency": 8}, 8, 0.5)
+    )
+    event_loop.close()
+
+    assert [index for index, _, _ in results] == list(range(60))
+    timed_out = {
+        json.loads(result)["in"]["id"]
+        for _, result, _ in results
+        if "errors" in json.loads(result)["out"]
+    }
+    assert timed_out == hanging
+
+
+def test_finished_chunks_in_order_holds_back_chunks_that_finish_early():
+    done_queue = queue.Queue()
+    chunk_metrics = Metrics()
+    chunk_metrics.observe_stage("write", 0.01)
+    events = [
+        ("started", 0, 3, None),
+        ("started", 1, 4, None),
+        ("metrics", 1, 4, chunk_metrics.take_snapshot()),
+        ("finished", 1, 4, "chunk 4"),
+        ("started", 1, 5, None),
+        ("finished", 1, 5, "chunk 5"),
+        ("finished", 0, 3, "chunk 3"),
+    ]
+    for event in events:
+        done_queue.put(event)
+    producer = concurrent.futures.Future()
+    producer.set_result(6)
+    workers = [SimpleNamespace(is_alive=lambda: True, exitcode=None)] * 2
+    metrics = Metrics()
+
+    finished = main._finished_chunks_in_order(
+        done_queue, workers, producer, first_chunk=3, metrics=metrics
+    )
+    # Chunks 4 and 5 finished first, but are yielded after chunk 3
+    assert list(finished) == [(3, "chunk 3"), (4, "chunk 4"), (5, "chunk 5")]
+    assert metrics.stages["write"].count == 1
+
+
+def _hangs(stub, record: dict) -> bool:
+    return stub._delay(record["source"]) == stub.hang_seconds
+
+
+def test_background_processor_logs_records_that_came_back_before_a_timeout():
+    stub_kwargs = {"hang_rate": 0.1, "hang_seconds": 30}
+    stub = make_stub_query_handler(**stub_kwargs)
+    rng = random.Random(0)
+    records = [make_record(i, "spdi", rng) for i in range(200)]
+    hanging = next(r for r in records[5:] if _hangs(stub, r))
+    # Only the one hanging record, with records in flight after it
+    records = [r for r in records if not _hangs(stub, r)]
+    records = records[:5] + [hanging] + records[5:40]
+    lines = [json.dumps(record) + "\n" for record in records]
+
+    messages = []
+    file_logger = logging.getLogger("test_record_log")
+    handler = logging.Handler()
+    handler.emit = lambda record: messages.append(json.loads(record.getMessage()))
+    file_logger.addHandler(handler)
+    processor = main.BackgroundProcessor(
+        {"query_handler_factory": partial(make_stub_query_handler, **stub_kwargs)},
+        task_timeout=1,
+        batch_size=10,
+        file_logger=file_logger,
+        record_log_buffer=3,
+    )
+    processor.start()
+    try:
+        outputs = list(processor.process(lines))
+    finally:
+        processor.stop()
+        file_logger.removeHandler(handler)
+
+    assert len(outputs) == len(lines)
+    assert [json.loads(output)["in"]["id"] for output in outputs] == [
+        record["id"] for record in records
+    ]
+    assert "errors" in json.loads(outputs[5])["out"]
+    events = [m for m in messages if m.get("event") != "recent_records"]
+    assert events[0]["event"] == "timeout"
+    assert events[0]["index"] == 5
+    assert events[0]["record"] == lines[5].rstrip("\n")
+    assert [m["index"] for m in events[1:] if m["event"] == "recent_record"] == [
+        2,
+        3,
+        4,
+    ]
+
+
+def _slow_stub_query_handler(init_seconds: float, **kwargs):
+    time.sleep(init_seconds)
+    return make_stub_query_handler(**kwargs)
+
+
+def test_background_processor_switches_to_a_ready_standby_after_a_timeout():
+    stub_kwargs = {"hang_rate": 0.1, "hang_seconds": 30}
+    stub = make_stub_query_handler(**stub_kwargs)
+    rng = random.Random(0)
+    records = [make_record(i, "spdi", rng) for i in range(200)]
+    hanging = next(r for r in records if _hangs(stub, r))
+    records = [r for r in records if not _hangs(stub, r)][:10]
+    records = records[:5] + [hanging] + records[5:]
+    lines = [json.dumps(record) + "\n" for record in records]
+
+    processor = main.BackgroundProcessor(
+        {"query_handler_factory": partial(_slow_stub_query_handler, 1, **stub_kwargs)},
+        task_timeout=2,
+        batch_size=10,
+        warm_standby=True,
+    )
+    processor.start()
+    try:
+        outputs = list(processor.process(lines))
+    finally:
+        processor.stop()
+
+    assert len(outputs) == len(lines)
+    assert "errors" in json.loads(outputs[5])["out"]
+    counters = processor.metrics.take_snapshot()["counters"]
+    assert counters["background_restarts"] == 1
+    # Both processes took a second to initialize, but the standby was ready by
+    # the time of the timeout, so only the first one was waited for
+    assert counters["background_init_seconds"] >= 2
+    assert (
+        counters["background_init_wait_seconds"]
+        < counters["background_init_seconds"] - 0.5
+    )
+
+
+@pytest.mark.parametrize(
+    "process_fn, opts",
+    [
+        pytest.param(main.process_as_json, {}, id="chunk-files"),
+        pytest.param(main.process_as_json_streaming, {}, id="streaming"),
+        pytest.param(main.process_as_json, {"warm_standby": True}, id="warm-standby"),
+        pytest.param(
+            main.process_as_json_streaming,
+            {"async_concurrency": 4, "task_timeout": 2},
+            id="async",
+        ),
+    ],
+)
+def test_process_as_json_with_a_hanging_record(tmp_path, process_fn, opts):
+    stub_kwargs = {"hang_rate": 0.1, "hang_seconds": 30}
+    stub = make_stub_query_handler(**stub_kwargs)
+    rng = random.Random(0)
+    records = [make_record(i, "spdi", rng) for i in range(100)]
+    hanging = next(r for r in records if _hangs(stub, r))
+    # In the third batch of the first chunk, which finishes after the second chunk
+    records = [r for r in records if not _hangs(stub, r)][:40]
+    records.insert(12, hanging)
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt", encoding="utf-8") as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+
+    process_fn(
+        input_file_name,
+        output_file_name,
+        2,
+        {
+            "chunk_size": 20,
+            "batch_size": 5,
+            "task_timeout": 1,
+            "query_handler_factory": partial(make_stub_query_handler, **stub_kwargs),
+            **opts,
+        },
+    )
+
+    with gzip.open(output_file_name, "rt", encoding="utf-8") as f:
+        outputs = [json.loads(line) for line in f]
+    assert [output["in"] for output in outputs] == records
+    assert outputs[12]["out"] == {"errors": "Task did not complete in 1 seconds."}
+    assert all("errors" not in output["out"] for output in outputs[:12] + outputs[13:])
+
+
+def test_process_as_json_streaming_writes_only_the_output(tmp_path):
+    rng = random.Random(0)
+    records = [make_record(i, kind, rng) for i, kind in enumerate(["spdi"] * 50)]
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt", encoding="utf-8") as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+
+    main.process_as_json_streaming(
+        input_file_name,
+        output_file_name,
+        3,
+        {"chunk_size": 7, "query_handler_factory": make_stub_query_handler},
+    )
+
+    with gzip.open(output_file_name, "rt", encoding="utf-8") as f:
+        outputs = [json.loads(line) for line in f]
+    assert [output["in"] for output in outputs] == records
+    assert all("errors" not in output["out"] for output in outputs)
+    # Besides the worker logs, no chunk files, and the checkpoint is removed
+    # once the output is complete
+    files = [name for name in os.listdir(tmp_path) if not name.endswith(".log")]
+    assert sorted(files) == ["in.json.gz", "out.json.gz"]
+
+
+def test_process_as_json_streaming_fails_when_a_worker_dies(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LIVENESS_CHECK_SECONDS", 0.5)
+    rng = random.Random(0)
+    input_file_name = str(tmp_path / "in.json.gz")
+    with gzip.open(input_file_name, "wt", encoding="utf-8") as f:
+        for i in range(2000):
+            f.write(json.dumps(make_record(i, "spdi", rng)) + "\n")
+
+    def kill_a_worker():
+        while len(multiprocessing.active_children()) < 2:
+            time.sleep(0.1)
+        time.sleep(1)
+        # e.g. killed for running out of memory
+        os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+
+    killer = threading.Thread(target=kill_a_worker)
+    killer.start()
+    start = time.perf_counter()
+    with pytest.raises(RuntimeError, match="Worker"):
+        main.process_as_json_streaming(
+            input_file_name,
+            str(tmp_path / "out.json.gz"),
+            2,
+            {
+                "chunk_size": 100,
+                "query_handler_factory": partial(make_stub_query_handler, latency=0.01),
+            },
+        )
+    killer.join()
+    # Without the worker, the run would otherwise wait for it forever
+    assert time.perf_counter() - start < 10
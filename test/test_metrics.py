@@ -0,0 +1,45 @@
+import json
+
+from clinvar_gk_pilot.metrics import Metrics, record_labels
+
+
+def test_metrics_merge_and_write(tmp_path):
+    labels = record_labels({"vrs_class": "Allele", "fmt": "spdi"}, "ok")
+    assert labels == ("Allele", "spdi", "", "ok")
+
+    worker_metrics = Metrics()
+    worker_metrics.add_observations(
+        [("record", labels, 0.002), ("record", labels, 0.3), ("stage", "decode", 0.001)]
+    )
+    run_metrics = Metrics()
+    worker_metrics.count("background_restarts")
+    worker_metrics.count("background_init_wait_seconds", 1.5)
+    run_metrics.merge(worker_metrics.take_snapshot())
+    worker_metrics.count("background_restarts")
+    run_metrics.merge(worker_metrics.take_snapshot())
+    run_metrics.observe_stage("write_chunk", 0.01)
+
+    summary_file = tmp_path / "metrics.json"
+    run_metrics.write_summary(str(summary_file))
+    summary = json.loads(summary_file.read_text())
+    (record,) = summary["records"]
+    assert record["vrs_class"] == "Allele"
+    assert record["count"] == 2
+    assert record["p50_seconds"] == 0.0025
+    assert record["max_seconds"] == 0.3
+    assert [stage["stage"] for stage in summary["stages"]] == ["decode", "write_chunk"]
+    assert summary["counters"] == {
+        "background_restarts": 2,
+        "background_init_seconds": 0,
+        "background_init_wait_seconds": 1.5,
+    }
+
+    prometheus_file = tmp_path / "metrics.prom"
+    run_metrics.write_prometheus(str(prometheus_file))
+    lines = prometheus_file.read_text().splitlines()
+    assert (
+        'clinvar_gk_record_seconds_bucket{vrs_class="Allele",fmt="spdi",'
+        'assembly_version="",outcome="ok",le="+Inf"} 2'
+    ) in lines
+    assert 'clinvar_gk_stage_seconds_count{stage="decode"} 1' in lines
+    assert "clinvar_gk_background_restarts_total 2" in lines
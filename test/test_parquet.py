@@ -0,0 +1,115 @@
+import gzip
+import json
+
+import pytest
+
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput
+from clinvar_gk_pilot.codec import get_codec
+from clinvar_gk_pilot.gzipio import open_gzip
+from clinvar_gk_pilot.parquet import ParquetOutputWriter, parquet_file_name, record_row
+from clinvar_gk_pilot.shards import ShardedOutput
+
+CLINVAR_JSON = {"id": "12345", "vrs_class": "Allele", "fmt": "spdi"}
+ALLELE = {
+    "id": "ga4gh:VA.abc",
+    "type": "Allele",
+    "location": {
+        "id": "ga4gh:SL.def",
+        "sequenceReference": {"refgetAccession": "SQ.ghi"},
+        "start": 100,
+        "end": 101,
+    },
+}
+
+
+def test_record_row():
+    line = get_codec("json").encode_output("", CLINVAR_JSON, ALLELE) + "\n"
+    row = record_row(line)
+    assert row["variation_id"] == "12345"
+    assert row["vrs_class"] == "Allele"
+    assert row["vrs_id"] == "ga4gh:VA.abc"
+    assert row["location_id"] == "ga4gh:SL.def"
+    assert row["sequence_accession"] == "SQ.ghi"
+    assert (row["start"], row["end"]) == (100, 101)
+    assert row["errors"] is None
+    assert json.loads(row["out_json"]) == ALLELE
+    assert json.loads(row["in_json"]) == CLINVAR_JSON
+
+    line = get_codec("json").encode_output(
+        "", CLINVAR_JSON, {"errors": "Unexpected error"}, shape="keyed"
+    )
+    row = record_row(line)
+    assert row["variation_id"] == "12345"
+    assert row["vrs_class"] is None
+    assert row["errors"] == "Unexpected error"
+    assert row["in_json"] is None
+
+    assert parquet_file_name("output/vi.json.gz") == "output/vi.parquet"
+
+
+def test_parquet_output_writer(tmp_path):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    file_name = str(tmp_path / "out.parquet")
+    line = get_codec("json").encode_output("", CLINVAR_JSON, ALLELE)
+    writer = ParquetOutputWriter(file_name, row_group_size=2)
+    for _ in range(5):
+        writer.write(line)
+    writer.close()
+
+    parquet_file = pyarrow_parquet.ParquetFile(file_name)
+    assert parquet_file.metadata.num_rows == 5
+    assert parquet_file.metadata.num_row_groups == 3
+    assert (
+        parquet_file.read(columns=["vrs_id"]).column(0).to_pylist()
+        == ["ga4gh:VA.abc"] * 5
+    )
+
+
+@pytest.mark.parametrize("shard_lines", [None, 2])
+def test_parquet_written_with_checkpointed_output(tmp_path, shard_lines):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 6)
+    lines = [
+        get_codec("json").encode_output("", {**CLINVAR_JSON, "id": str(i)}, ALLELE)
+        + "\n"
+        for i in range(6)
+    ]
+
+    def make_output():
+        if shard_lines:
+            return ShardedOutput(
+                output_file_name,
+                input_file_name,
+                2,
+                shard_lines,
+                parquet_file_name=parquet_file_name(output_file_name),
+            )
+        return CheckpointedOutput(
+            output_file_name,
+            input_file_name,
+            2,
+            parquet_file_name=parquet_file_name(output_file_name),
+        )
+
+    output = make_output()
+    output.open()
+    output.write_chunk(lines[0:2])
+    # A worker's chunk file, appended as it is
+    chunk_file_name = str(tmp_path / "chunk.out")
+    with open_gzip(chunk_file_name, "wt", threads=1) as f:
+        f.writelines(lines[2:4])
+    output.append_chunk(chunk_file_name, 2)
+    # Simulate a run interrupted before the Parquet file was complete
+    output.f.close()
+    output.parquet.writer.close()
+
+    output = make_output()
+    assert output.open(resume=True) == 2
+    output.write_chunk(lines[4:6])
+    output.close()
+
+    table = pyarrow_parquet.read_table(parquet_file_name(output_file_name))
+    assert table.column("variation_id").to_pylist() == [str(i) for i in range(6)]
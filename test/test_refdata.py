@@ -0,0 +1,121 @@
+import hashlib
+import os
+import tarfile
+
+import pytest
+
+from clinvar_gk_pilot import refdata
+
+# Stand-in for the reference data script, which writes a data file into the
+# directory it is run for and counts its runs
+FAKE_SCRIPT = """
+import os
+from pathlib import Path
+
+def download_cool_seq_tool_files(is_docker_env=False):
+    data_dir = Path(os.environ["WAGS_TAILS_DIR"])
+    (data_dir / "mane").mkdir(exist_ok=True)
+    (data_dir / "mane" / "summary.txt").write_text("MANE summary")
+    runs = data_dir.parent / "runs.txt"
+    runs.write_text(runs.read_text() + "x" if runs.exists() else "x")
+"""
+
+
+def _install_fake_script(refdata_dir, monkeypatch):
+    monkeypatch.setenv("WAGS_TAILS_DIR", str(refdata_dir))
+    refdata_dir.mkdir(exist_ok=True)
+    (refdata_dir / refdata.SCRIPT_FILE_NAME).write_text(FAKE_SCRIPT)
+    # Make the cached script valid, so no download is attempted
+    refdata._write_manifest(
+        str(refdata_dir),
+        {
+            "script_url": refdata.REFDATA_SCRIPT_URL,
+            "script_sha256": hashlib.sha256(FAKE_SCRIPT.encode()).hexdigest(),
+            "files": {"missing.txt": {"size": 0, "mtime_ns": 0, "sha256": ""}},
+        },
+    )
+
+
+def test_ensure_refdata(tmp_path, monkeypatch):
+    refdata_dir = tmp_path / "wags_tails"
+    runs = tmp_path / "runs.txt"
+    _install_fake_script(refdata_dir, monkeypatch)
+
+    manifest = refdata.ensure_refdata()
+    assert runs.read_text() == "x"
+    assert list(manifest["files"]) == ["mane/summary.txt"]
+    assert (
+        manifest["files"]["mane/summary.txt"]["sha256"]
+        == hashlib.sha256(b"MANE summary").hexdigest()
+    )
+
+    # A valid cache is used without running the script
+    assert refdata.ensure_refdata() == manifest
+    assert runs.read_text() == "x"
+
+    # Changed files are fetched again
+    (refdata_dir / "mane" / "summary.txt").write_text("MANE summarY")
+    refdata.ensure_refdata()
+    assert runs.read_text() == "xx"
+
+
+def test_ensure_refdata_seed(tmp_path, monkeypatch):
+    refdata_dir = tmp_path / "wags_tails"
+    runs = tmp_path / "runs.txt"
+    _install_fake_script(refdata_dir, monkeypatch)
+    manifest = refdata.ensure_refdata()
+
+    seed_path = tmp_path / "refdata.tar.gz"
+    with tarfile.open(seed_path, "w:gz") as tar:
+        tar.add(refdata_dir, arcname=".")
+
+    seeded_dir = tmp_path / "seeded"
+    seeded = refdata.ensure_refdata(str(seeded_dir), seed_path=str(seed_path))
+    assert seeded["files"].keys() == manifest["files"].keys()
+    assert (seeded_dir / "mane" / "summary.txt").read_text() == "MANE summary"
+    assert runs.read_text() == "x"
+
+
+def test_seed_refdata_without_extraction_filters(tmp_path, monkeypatch):
+    # As on Python 3.11.0 to 3.11.3
+    monkeypatch.delattr(tarfile, "data_filter")
+    source_dir = tmp_path / "source"
+    (source_dir / "mane").mkdir(parents=True)
+    (source_dir / "mane" / "summary.txt").write_text("MANE summary")
+    seed_path = tmp_path / "refdata.tar.gz"
+    with tarfile.open(seed_path, "w:gz") as tar:
+        tar.add(source_dir, arcname=".")
+
+    refdata.seed_refdata(str(seed_path), str(tmp_path / "seeded"))
+    assert (tmp_path / "seeded" / "mane" / "summary.txt").read_text() == "MANE summary"
+
+    with tarfile.open(seed_path, "w:gz") as tar:
+        tar.add(source_dir / "mane" / "summary.txt", arcname="../outside.txt")
+    with pytest.raises(ValueError):
+        refdata.seed_refdata(str(seed_path), str(tmp_path / "seeded"))
+    assert not (tmp_path / "outside.txt").exists()
+
+
+def test_ensure_refdata_records_files_already_present(tmp_path, monkeypatch):
+    refdata_dir = tmp_path / "wags_tails"
+    _install_fake_script(refdata_dir, monkeypatch)
+    # e.g. fetched by an earlier run of the script, or copied in by hand
+    (refdata_dir / "seqrepo.txt").write_text("sequences")
+
+    manifest = refdata.ensure_refdata()
+    assert sorted(manifest["files"]) == ["mane/summary.txt", "seqrepo.txt"]
+    assert (
+        manifest["files"]["seqrepo.txt"]["sha256"]
+        == hashlib.sha256(b"sequences").hexdigest()
+    )
+
+
+def test_ensure_refdata_exports_refdata_dir(tmp_path, monkeypatch):
+    refdata_dir = tmp_path / "wags_tails"
+    _install_fake_script(refdata_dir, monkeypatch)
+    monkeypatch.delenv("WAGS_TAILS_DIR")
+
+    # The fake script reads the directory from WAGS_TAILS_DIR
+    manifest = refdata.ensure_refdata(str(refdata_dir))
+    assert list(manifest["files"]) == ["mane/summary.txt"]
+    assert os.environ["WAGS_TAILS_DIR"] == str(refdata_dir)
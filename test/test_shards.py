@@ -0,0 +1,57 @@
+import gzip
+import json
+import os
+
+from clinvar_gk_pilot.shards import (
+    ShardedOutput,
+    iter_output_lines,
+    key_range,
+    manifest_file_name,
+)
+
+
+def test_sharded_output_resume(tmp_path):
+    input_file_name = str(tmp_path / "in.json.gz")
+    output_file_name = str(tmp_path / "out.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 10)
+
+    output = ShardedOutput(output_file_name, input_file_name, 2, shard_lines=4)
+    assert output.open() == 0
+    output.write_chunk(["1", "2"], record_ids=["1", "2"])
+    output.write_chunk(["3", "10"], record_ids=["3", "10"])
+    output.write_chunk(["5", "6"], record_ids=["5", "6"])
+    # Simulate a run interrupted while writing the fourth chunk
+    output.f.write(b"partial gzip member")
+    output.f.close()
+
+    output = ShardedOutput(output_file_name, input_file_name, 2, shard_lines=4)
+    assert output.open(resume=True) == 3
+    output.write_chunk(["7", "8"], record_ids=["7", "8"])
+    output.write_chunk(["9"], record_ids=["9"])
+    output.close()
+
+    assert not os.path.exists(output.checkpoint_file_name)
+    with open(manifest_file_name(output_file_name)) as f:
+        manifest = json.load(f)
+    assert manifest["line_count"] == 9
+    assert [shard["path"] for shard in manifest["shards"]] == [
+        "out-00000.json.gz",
+        "out-00001.json.gz",
+        "out-00002.json.gz",
+    ]
+    assert [shard["first_line"] for shard in manifest["shards"]] == [0, 4, 8]
+    assert [shard["key_range"] for shard in manifest["shards"]] == [
+        ["1", "10"],
+        ["5", "8"],
+        ["9", "9"],
+    ]
+    with gzip.open(tmp_path / "out-00001.json.gz", "rt") as f:
+        assert f.read() == "5\n6\n7\n8\n"
+    lines = list(iter_output_lines(manifest_file_name(output_file_name)))
+    assert lines == [f"{i}\n" for i in ["1", "2", "3", "10", "5", "6", "7", "8", "9"]]
+
+
+def test_key_range():
+    assert key_range(["12", "9", None, "100"]) == ["9", "100"]
+    assert key_range([None]) is None
@@ -0,0 +1,48 @@
+import gzip
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.cloud.storage")
+
+from clinvar_gk_pilot import gcs  # noqa: E402
+from clinvar_gk_pilot.checkpoint import CheckpointedOutput  # noqa: E402
+from clinvar_gk_pilot.upload import OutputUpload  # noqa: E402
+
+
+def test_output_upload_parts(tmp_path, monkeypatch):
+    objects = {}
+    composed = []
+
+    def upload_file(file_name, blob_uri, client=None, start=0, end=None):
+        with open(file_name, "rb") as f:
+            f.seek(start)
+            objects[blob_uri] = f.read() if end is None else f.read(end - start)
+
+    def compose_blobs(source_uris, blob_uri, client=None):
+        composed.append(source_uris)
+        objects[blob_uri] = b"".join(objects[uri] for uri in source_uris)
+        bucket_name, name = blob_uri.removeprefix("gs://").split("/", 1)
+        return SimpleNamespace(bucket=SimpleNamespace(name=bucket_name), name=name)
+
+    monkeypatch.setattr(gcs, "upload_file", upload_file)
+    monkeypatch.setattr(gcs, "compose_blobs", compose_blobs)
+    monkeypatch.setattr(gcs, "verify_checksum", lambda file_name, blob: None)
+    monkeypatch.setattr(gcs, "list_blobs", lambda bucket_name, prefix: [])
+
+    input_file_name = str(tmp_path / "in.json.gz")
+    with gzip.open(input_file_name, "wt") as f:
+        f.write("{}\n" * 6)
+    output = CheckpointedOutput(str(tmp_path / "out.json.gz"), input_file_name, 2)
+    output.open()
+    upload = OutputUpload(output, "gs://bucket/out.json.gz", part_size=1)
+    for lines in (["1", "2"], ["3", "4"], ["5", "6"]):
+        output.write_chunk(lines)
+        upload.chunk_written()
+    output.close()
+    upload.finish()
+
+    assert composed == [[f"gs://bucket/out.json.gz.parts/{i:05d}" for i in range(3)]]
+    with open(output.output_file_name, "rb") as f:
+        assert objects["gs://bucket/out.json.gz"] == f.read()
+    assert gzip.decompress(objects["gs://bucket/out.json.gz"]) == b"1\n2\n3\n4\n5\n6\n"